@@ -3,6 +3,7 @@ from werkzeug.utils import secure_filename
 import os
 import logging
 import doc_calls as dc 
+from chunk_store import ingest, load_chunks, list_chunk_stores, purge_chunks
 from constants import (
     MODEL_ID,
     MODEL_BASENAME,
@@ -17,17 +18,27 @@ app = Flask(__name__)
 processed_docs={}
 recent_log=""
 
-def _process_docs_helper(data):
-    try:
-        if not data['path'] in processed_docs.keys():
-            small_texts, large_texts=dc.process_documents(data)
-            processed_docs[data["path"]]={"small_texts":small_texts,"large_texts":large_texts}
-        return True
-    except Exception as e:
-        logging.error(e)
-        print(e)
-        return False
+def _chunk_params(data):
+    # the chunk sizes of a request, None unless it has all of them
+    keys=("small_chunk_size","small_chunk_overlap","large_chunk_size","large_chunk_overlap")
+    return {key:int(data[key]) for key in keys} if all(key in data for key in keys) else None
 
+# brings a folder's chunk store up to date with its files and opens it. Only new and changed files are loaded
+# and split (see chunk_store.ingest), the chunk sizes default to the ones the folder was processed with.
+# Returns the ingestion delta.
+def _ingest(data):
+    path=data["path"]
+    params=_chunk_params(data)
+    if params is None:
+        stored=load_chunks(path)
+        if stored is None:
+            raise ValueError(f"{path} is not processed, call /process_documents first")
+        params=stored["params"]
+    data={**data,**params}
+    delta=ingest(path,dc.list_source_files(f"{SOURCE_DIRECTORY}/{path}"),params,lambda ignored_files: dc.process_documents(data,ignored_files))
+    if delta["updated"] or not path in processed_docs.keys():
+        processed_docs[path]=load_chunks(path)
+    return delta
 
 def _allowed_file(filename):
     return '.' in filename and \
@@ -80,24 +91,42 @@ def process_documents():
             if not req_key in data.keys():
                 return jsonify({'status': 'error', 'message': f"missing the {req_key} key"})
         try:
-            # List contents of the folder
-            #TODO, add state files for saving and loading information like this. State should be purgable as well.
-            if _process_docs_helper(data):
-                #processed_docs[data["path"]]
-                small_texts_cnt=str(len(processed_docs[data["path"]]['small_texts']))
-                large_texts_cnt=str(len(processed_docs[data["path"]]['large_texts']))
-                logging.info(f"num_small_docs:{small_texts_cnt}, num_large_docs: {large_texts_cnt}")
-                return jsonify({'status': 'success', 'message': {'num_small_docs':small_texts_cnt,'num_large_docs':large_texts_cnt}})
-                #f"small and large chunks created for {data['path']}"})
-            else:
-                logging.error( "Unable to process docs")
-                return jsonify({'status': 'error', 'message': "Unable to process docs"})
+            # List contents of the folder, the chunks are kept in the folder's chunk store (see /purge_chunks) and
+            # only files that are new or changed since the last call are loaded
+            delta=_ingest(data)
+            small_texts_cnt=str(delta['small_texts'])
+            large_texts_cnt=str(delta['large_texts'])
+            logging.info(f"num_small_docs:{small_texts_cnt}, num_large_docs: {large_texts_cnt}, delta: {delta}")
+            return jsonify({'status': 'success', 'message': {'num_small_docs':small_texts_cnt,'num_large_docs':large_texts_cnt,'delta':delta}})
+        except Exception as e:
+            logging.error(e)
+            return jsonify({'status': 'error', 'message': str(e)})
+    except Exception as e:
+        logging.error(e)
+
+# delete stored chunks - 'path' for one folder, every folder without it
+@app.route('/purge_chunks', methods=['POST'])
+def purge_chunks_route():
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            path=data.get("path")
+            purged=purge_chunks(path)
+            for purged_path in list(processed_docs.keys()) if path is None else [path]:
+                processed_docs.pop(purged_path,None)
+            logging.info(f"purged chunk stores {purged}")
+            return jsonify({'status': 'success', 'message': {"purged":purged}})
         except Exception as e:
             logging.error(e)
             return jsonify({'status': 'error', 'message': str(e)})
     except Exception as e:
         logging.error(e)
 
+# the stored folders with the chunk sizes they were processed with and their chunk counts
+@app.route('/chunk_stores', methods=['GET'])
+def chunk_stores():
+    return jsonify({'status': 'success', 'message': list_chunk_stores()})
+
 if __name__ == "__main__":
     port = int(os.getenv('PORT', '5006'))
     app.run(debug=True, port=port)
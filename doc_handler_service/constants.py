@@ -1,9 +1,5 @@
 import os
 
-# https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/excel.html?highlight=xlsx#microsoft-excel
-from langchain.document_loaders import CSVLoader, PDFMinerLoader, TextLoader, UnstructuredExcelLoader, Docx2txtLoader
-from langchain.document_loaders import UnstructuredFileLoader, UnstructuredMarkdownLoader
-
 
 #QUESTION_DIRECTORY = os.environ.get('QUESTION_DIRECTORY', '/var/log/thoth-ke')
 # load_dotenv()
@@ -12,21 +8,27 @@ ROOT_DIRECTORY = f"{os.path.dirname(os.path.realpath(__file__))}/workspace"
 # Define the folder for storing database
 SOURCE_DIRECTORY = f"{ROOT_DIRECTORY}/SOURCE_DOCUMENTS"
 
+# Processed folders' chunks, a memory-mapped store per folder (see chunk_store)
+CHUNK_STORE_DIRECTORY = f"{ROOT_DIRECTORY}/chunks"
+# Updates append to a store, it is rewritten with only its live chunks once this share of its bytes is dead
+CHUNK_STORE_COMPACT_RATIO = float(os.environ.get('CHUNK_STORE_COMPACT_RATIO', 0.5))
+
 # Can be changed to a specific number
 INGEST_THREADS = os.cpu_count() or 8
 
 # https://python.langchain.com/en/latest/_modules/langchain/document_loaders/excel.html#UnstructuredExcelLoader
+# loader class names in langchain.document_loaders, imported on first use
 DOCUMENT_MAP = {
-    ".txt": TextLoader,
-    ".md": UnstructuredMarkdownLoader,
-    ".py": TextLoader,
-    # ".pdf": PDFMinerLoader,
-    ".pdf": UnstructuredFileLoader,
-    ".csv": CSVLoader,
-    ".xls": UnstructuredExcelLoader,
-    ".xlsx": UnstructuredExcelLoader,
-    ".docx": Docx2txtLoader,
-    ".doc": Docx2txtLoader,
+    ".txt": "TextLoader",
+    ".md": "UnstructuredMarkdownLoader",
+    ".py": "TextLoader",
+    # ".pdf": "PDFMinerLoader",
+    ".pdf": "UnstructuredFileLoader",
+    ".csv": "CSVLoader",
+    ".xls": "UnstructuredExcelLoader",
+    ".xlsx": "UnstructuredExcelLoader",
+    ".docx": "Docx2txtLoader",
+    ".doc": "Docx2txtLoader",
 }
 
 
@@ -1,6 +1,7 @@
 import os
 import glob
 import logging
+import importlib
 from multiprocessing import Pool
 from tqdm import tqdm
 import json
@@ -8,50 +9,44 @@ from typing import List
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from langchain.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PDFMinerLoader,
-    TextLoader,
-    UnstructuredEmailLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredODTLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredWordDocumentLoader,
-)
-
 from constants import (
     DOCUMENT_MAP,
     SOURCE_DIRECTORY,
 )
 
-# Map file extensions to document loaders and their arguments
+# Map file extensions to document loaders (class names in langchain.document_loaders) and their arguments.
+# A loader is only imported the first time a file with its extension is seen.
 LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    # ".docx": (Docx2txtLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    #".eml": (MyElmLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PDFMinerLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
+    ".csv": ("CSVLoader", {}),
+    # ".docx": ("Docx2txtLoader", {}),
+    ".doc": ("UnstructuredWordDocumentLoader", {}),
+    ".docx": ("UnstructuredWordDocumentLoader", {}),
+    ".enex": ("EverNoteLoader", {}),
+    #".eml": ("MyElmLoader", {}),
+    ".epub": ("UnstructuredEPubLoader", {}),
+    ".html": ("UnstructuredHTMLLoader", {}),
+    ".md": ("UnstructuredMarkdownLoader", {}),
+    ".odt": ("UnstructuredODTLoader", {}),
+    ".pdf": ("PDFMinerLoader", {}),
+    ".ppt": ("UnstructuredPowerPointLoader", {}),
+    ".pptx": ("UnstructuredPowerPointLoader", {}),
+    ".txt": ("TextLoader", {"encoding": "utf8"}),
     # Add more mappings for other file extensions and loaders as needed
 }
+_loader_classes = {}
+
+
+def get_loader_class(name):
+    if name not in _loader_classes:
+        _loader_classes[name] = getattr(importlib.import_module("langchain.document_loaders"), name)
+    return _loader_classes[name]
 
 
 def load_single_document(file_path: str) -> Document:
     ext = "." + file_path.rsplit(".", 1)[-1]
     if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
+        loader_name, loader_args = LOADER_MAPPING[ext]
+        loader = get_loader_class(loader_name)(file_path, **loader_args)
         try:
             return loader.load()[0]
         except Exception as e:
@@ -61,15 +56,20 @@ def load_single_document(file_path: str) -> Document:
     raise ValueError(f"Unsupported file extension '{ext}'")
 
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
-    """
-    Loads all documents from the source documents directory, ignoring specified files
-    """
+def list_source_files(source_dir: str) -> List[str]:
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(
             glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
         )
+    return all_files
+
+
+def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+    """
+    Loads all documents from the source documents directory, ignoring specified files
+    """
+    all_files = list_source_files(source_dir)
     filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
 
     with Pool(processes=os.cpu_count()) as pool:
@@ -99,10 +99,6 @@ def process_documents(data, ignored_files: List[str] = []) -> List[Document]:
     return texts, [[lg_text] for lg_text in lg_texts]
 
 def docs_to_strings(text_docs):
-    context=""
-    metadata_string=""
-    for i, doc in enumerate(text_docs):
-        doc_pieces=f"{doc}".split("metadata=")
-        metadata_string+=f"{i}: {doc_pieces[1]}\n"
-        context+=doc_pieces[0].strip().replace("page_content=","")+"\n"
+    context="".join(f"{doc.page_content.strip()}\n" for doc in text_docs)
+    metadata_string="".join(f"{i}: {doc.metadata}\n" for i, doc in enumerate(text_docs))
     return {"context":context,"metadata":metadata_string}
\ No newline at end of file
@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as _file:
+        for block in iter(lambda: _file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(source, index):
+    # stable id of a source file's index-th chunk, a changed file's chunks replace its old ones under the same ids
+    return f"{hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]}-{index}"
+
+
+def scan_files(files, file_paths):
+    """
+    Compare files on disk with manifest entries (path -> size, mtime, hash). Files whose size and mtime
+    match are not re-hashed.
+
+    Returns:
+    - dict: new, changed, unchanged and removed file lists, hashes (path -> hash of new/changed files) and
+      touched (unchanged files whose mtime was updated in their entry).
+    """
+    delta = {"new": [], "changed": [], "unchanged": [], "removed": [], "hashes": {}, "touched": []}
+    for path in file_paths:
+        stat = os.stat(path)
+        entry = files.get(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            delta["unchanged"].append(path)
+            continue
+        digest = file_hash(path)
+        if entry and entry["hash"] == digest:
+            # touched but not edited, only the stat is refreshed
+            entry["mtime"] = stat.st_mtime
+            delta["unchanged"].append(path)
+            delta["touched"].append(path)
+            continue
+        delta["hashes"][path] = digest
+        delta["changed" if entry else "new"].append(path)
+    on_disk = set(file_paths)
+    delta["removed"] = [path for path in files if path not in on_disk]
+    return delta
+
+
+class CollectionManifest:
+    """
+    Source file -> size, mtime, content hash and chunk ids of one Chroma collection, kept as manifest.json
+    in the collection's persist directory.
+
+    The chunking parameters the collection was built with are kept too, chunks made with other parameters
+    can not be updated file by file.
+
+    Parameters:
+    - persist_dir (str): The collection's persist directory.
+    """
+
+    def __init__(self, persist_dir):
+        self.path = os.path.join(persist_dir, MANIFEST_NAME)
+        self.files = {}
+        self.chunking = None
+        self.exists = os.path.exists(self.path)
+        if self.exists:
+            with open(self.path) as _file:
+                manifest = json.load(_file)
+            self.files = manifest["files"]
+            self.chunking = manifest.get("chunking")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as _file:
+            json.dump({"chunking": self.chunking, "files": self.files}, _file)
+        os.replace(tmp_path, self.path)
+        self.exists = True
+
+    def scan(self, file_paths):
+        return scan_files(self.files, file_paths)
+
+    def set_file(self, path, digest, chunk_ids):
+        stat = os.stat(path)
+        self.files[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": digest, "chunk_ids": chunk_ids}
+
+    def remove_file(self, path):
+        entry = self.files.pop(path, None)
+        return entry["chunk_ids"] if entry else []
+
+    def chunk_ids(self, paths):
+        return [chunk_id for path in paths for chunk_id in self.files.get(path, {}).get("chunk_ids", [])]
@@ -1,37 +1,24 @@
 import os
 import glob
+import queue
+import shutil
 import logging
+import importlib
 from multiprocessing import Pool
 from tqdm import tqdm
 import json
 from typing import List
 from langchain.docstore.document import Document
-from langchain.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import RetrievalQA
-
-from langchain.callbacks.manager import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-
-from langchain.prompts import PromptTemplate
-from langchain.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PDFMinerLoader,
-    TextLoader,
-    UnstructuredEmailLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredODTLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredWordDocumentLoader,
-)
-# Summarizer we'll use for Map Reduce
-from langchain.chains.summarize import load_summarize_chain
-from langchain.embeddings import HuggingFaceInstructEmbeddings
-from langchain.llms import HuggingFacePipeline
 
+from streaming import sse_event, stream_generations
+from index_manifest import CollectionManifest, file_hash, chunk_id
+import retrieval
+from lexical_index import BM25Index, lexical_index_dir
+from context_builder import ContextBuilder
+from semantic_cache import CACHEABLE_FINISH_REASONS
+from vector_store import ChromaStore, IVFStore
+from jobs import JobCancelled
 from load_models import (
     load_quantized_model_gguf_ggml,
     load_quantized_model_qptq,
@@ -39,51 +26,76 @@ from load_models import (
 )
 
 from constants import (
-    CHROMA_SETTINGS,
+    CHROMA_SETTINGS_KWARGS,
     DOCUMENT_MAP,
     EMBEDDING_MODEL_NAME,
     PERSIST_DIRECTORY,
     MODEL_ID,
     MODEL_BASENAME,
     MAX_NEW_TOKENS,
+    CONTEXT_WINDOW_SIZE,
+    CONTEXT_TOKEN_MARGIN,
     MODELS_PATH,
-    CHROMA_SETTINGS,
     INGEST_THREADS,
     PERSIST_DIRECTORY,
     SOURCE_DIRECTORY,
     NUMBER_OF_CLUSTERS,
     CLUSTER_SAMPLES,
+    MINIBATCH_KMEANS_THRESHOLD,
+    VECTOR_QUANTIZATION,
+    EMBEDDING_BACKEND,
+    REFRESH_BATCH_SIZE,
+    RETRIEVAL_MODE,
+    VECTOR_STORE,
     QUESTION_DIRECTORY,
 )
 # Data Science
 import numpy as np
-from sklearn.cluster import KMeans
 
-# Map file extensions to document loaders and their arguments
+# Map file extensions to document loaders (class names in langchain.document_loaders) and their arguments.
+# A loader is only imported the first time a file with its extension is seen.
 LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    # ".docx": (Docx2txtLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    #".eml": (MyElmLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PDFMinerLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
+    ".csv": ("CSVLoader", {}),
+    # ".docx": ("Docx2txtLoader", {}),
+    ".doc": ("UnstructuredWordDocumentLoader", {}),
+    ".docx": ("UnstructuredWordDocumentLoader", {}),
+    ".enex": ("EverNoteLoader", {}),
+    #".eml": ("MyElmLoader", {}),
+    ".epub": ("UnstructuredEPubLoader", {}),
+    ".html": ("UnstructuredHTMLLoader", {}),
+    ".md": ("UnstructuredMarkdownLoader", {}),
+    ".odt": ("UnstructuredODTLoader", {}),
+    ".pdf": ("PDFMinerLoader", {}),
+    ".ppt": ("UnstructuredPowerPointLoader", {}),
+    ".pptx": ("UnstructuredPowerPointLoader", {}),
+    ".txt": ("TextLoader", {"encoding": "utf8"}),
     # Add more mappings for other file extensions and loaders as needed
 }
+_loader_classes = {}
+_chroma_settings = None
+
+
+def get_loader_class(name):
+    if name not in _loader_classes:
+        _loader_classes[name] = getattr(importlib.import_module("langchain.document_loaders"), name)
+    return _loader_classes[name]
+
+
+def get_chroma_settings():
+    # chromadb is only imported once a vector db is opened
+    global _chroma_settings
+    if _chroma_settings is None:
+        from chromadb.config import Settings
+
+        _chroma_settings = Settings(**CHROMA_SETTINGS_KWARGS)
+    return _chroma_settings
 
 
 def load_single_document(file_path: str) -> Document:
     ext = "." + file_path.rsplit(".", 1)[-1]
     if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
+        loader_name, loader_args = LOADER_MAPPING[ext]
+        loader = get_loader_class(loader_name)(file_path, **loader_args)
         try:
             return loader.load()[0]
         except Exception as e:
@@ -93,135 +105,394 @@ def load_single_document(file_path: str) -> Document:
     raise ValueError(f"Unsupported file extension '{ext}'")
 
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
-    """
-    Loads all documents from the source documents directory, ignoring specified files
-    """
+def list_source_files(source_dir: str) -> List[str]:
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(
             glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
         )
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
+    return all_files
+
 
-    with Pool(processes=os.cpu_count()) as pool:
+def load_files(file_paths: List[str], check_cancelled=None) -> List[Document]:
+    if not file_paths:
+        return []
+    with Pool(processes=min(os.cpu_count(), len(file_paths))) as pool:
         results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, doc in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
+        with tqdm(total=len(file_paths), desc='Loading new documents', ncols=80) as pbar:
+            for i, doc in enumerate(pool.imap_unordered(load_single_document, file_paths)):
+                # leaving the with block terminates the pool's workers
+                if check_cancelled:
+                    check_cancelled()
                 results.append(doc)
                 pbar.update()
 
     return results
 
-def process_documents(data, ignored_files: List[str] = []) -> List[Document]:
+
+def load_documents(source_dir: str, ignored_files: List[str] = [], check_cancelled=None) -> List[Document]:
+    """
+    Loads all documents from the source documents directory, ignoring specified files
+    """
+    all_files = list_source_files(source_dir)
+    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
+    return load_files(filtered_files, check_cancelled)
+
+def process_documents(data, ignored_files: List[str] = [], check_cancelled=None) -> List[Document]:
     """
     Load documents and split in chunks
     """
     print(f"Loading documents from {data['path']}")
-    documents = load_documents(f"{SOURCE_DIRECTORY}/{data['path']}", ignored_files)
+    documents = load_documents(f"{SOURCE_DIRECTORY}/{data['path']}", ignored_files, check_cancelled)
     if not documents:
         print("No new documents to load")
         return [],[]
     print(f"Loaded {len(documents)} new documents from {SOURCE_DIRECTORY}/{data['path']}")
     # "small_chunk_size","small_chunk_overlap","large_chunk_size","large_chunk_overlap"
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=data["small_chunk_size"], chunk_overlap=data["small_chunk_overlap"])
+    # start_index - the chunk's offset in its document, lets the context builder merge overlapping chunks
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=data["small_chunk_size"], chunk_overlap=data["small_chunk_overlap"], add_start_index=True)
     texts = text_splitter.split_documents(documents)
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=data["large_chunk_size"], chunk_overlap=data["large_chunk_overlap"])
+    if check_cancelled:
+        check_cancelled()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=data["large_chunk_size"], chunk_overlap=data["large_chunk_overlap"], add_start_index=True)
     lg_texts = text_splitter.split_documents(documents)
     return texts, [[lg_text] for lg_text in lg_texts]
 
 def docs_to_strings(text_docs):
-    context=""
-    metadata_string=""
-    for i, doc in enumerate(text_docs):
-        doc_pieces=f"{doc}".split("metadata=")
-        metadata_string+=f"{i}: {doc_pieces[1]}\n"
-        context+=doc_pieces[0].strip().replace("page_content=","")+"\n"
+    context, metadata_string=pack_docs(text_docs).build()
     return {"context":context,"metadata":metadata_string}
 
 
-# gets a prompt from client and returns response
-def call_llm(llm,prompt):
-    return llm(prompt)
+# gets a prompt from client and returns response, params are per-request limits (max_tokens, stop, timeout)
+def call_llm(llm,prompt,**params):
+    return llm(prompt,**params)
+
+# merges the docs into a context_builder.ContextBuilder, highest ranked first. Only the text a doc adds to the
+# context (not its overlap with docs already in) counts against the token budget, a doc that does not fit is
+# skipped so a smaller one further down can still be used
+def pack_docs(docs,count_tokens=None,token_budget=None):
+    builder=ContextBuilder()
+    used=0
+    for doc in docs:
+        if count_tokens is not None and token_budget is not None:
+            added=builder.new_text(doc)
+            if not added:
+                continue
+            doc_tokens=count_tokens(added)+1
+            if used+doc_tokens>token_budget:
+                continue
+            used+=doc_tokens
+        builder.add(doc)
+    return builder
+
+# tokens left for the context once the template and the answer are accounted for
+def context_token_budget(llm,template,gen_params=None):
+    max_tokens=(gen_params or {}).get("max_tokens",MAX_NEW_TOKENS)
+    return CONTEXT_WINDOW_SIZE-max_tokens-llm.count_tokens(template.replace("|context|","").replace("|question|",""))-CONTEXT_TOKEN_MARGIN
+
+# fills a doc prompt template with the docs that fit in the token budget
+def build_doc_prompt(llm,text_docs,template,gen_params=None):
+    context, metadata_string=pack_docs(text_docs,llm.count_tokens,context_token_budget(llm,template,gen_params)).build()
+    doc_strings={"context":context,"metadata":metadata_string}
+    return template.replace("|context|",doc_strings['context']), doc_strings
+
+# fills in the template with a question's retrieved chunks, overlapping and adjacent chunks of a document
+# merged into one passage. With a llm the chunks are packed to the token budget left in the context window.
+def fill_rag_prompt(r_docs,question,template,llm=None,token_budget=None):
+    if llm is not None and token_budget is not None:
+        builder=pack_docs(r_docs,llm.count_tokens,token_budget-llm.count_tokens(question))
+    else:
+        builder=pack_docs(r_docs)
+    # out_dir=os.environ.get('OUTPUT_DIR','/var/log/ai_gate/')
+    # with open(os.path.join(out_dir,f"ai_rag.txt"), "a") as _file:
+    #     for r_doc in r_docs:
+    #         _file.write(r_doc)
+    context, metadata_string=builder.build()
+    return template.replace("|question|",question).replace("|context|",context), context, metadata_string
+
+# retrieves the context for one question and fills in the template
+def build_rag_prompt(retriever,question,template,llm=None,token_budget=None):
+    return fill_rag_prompt(retriever.get_relevant_documents(question),question,template,llm,token_budget)
+
+# a retriever (get_relevant_documents) over a vector db, searching the quantized vectors when
+# VECTOR_QUANTIZATION is set
+def get_retriever(db,k=4):
+    return retrieval.StoreRetriever(db,k)
+
+# embeds all questions in one batch and runs one multi-query search, returns the k docs of every question.
+# The lexical and hybrid modes also need the folder's BM25 index.
+def retrieve_batch(db,questions,k=4,retrieval_mode=RETRIEVAL_MODE,lexical_index=None):
+    return [[doc for doc, _, _ in matches] for matches in retrieval.search(db,questions,k,mode=retrieval_mode,lexical_index=lexical_index)]
+
+# (prompt, context, metadata_string) of every question, retrieved together
+def build_rag_prompts(db,questions,template,llm=None,token_budget=None,k=4,retrieval_mode=RETRIEVAL_MODE,lexical_index=None):
+    return [
+        fill_rag_prompt(r_docs,question,template,llm,token_budget)
+        for r_docs, question in zip(retrieve_batch(db,questions,k,retrieval_mode,lexical_index),questions)
+    ]
+
+# answers of questions close enough to an earlier one from the semantic cache (None when answer_cache is not
+# given), with the question vectors the generated answers are cached under
+def cached_answers(db,questions,answer_cache=None,cache_key=None):
+    if answer_cache is None:
+        return [None]*len(questions), None
+    vectors=retrieval.embed_queries(db,questions)
+    return answer_cache.lookup(cache_key,vectors), vectors
+
+def cached_result(hit):
+    return {**hit["answer"],"cache":{"question":hit["question"],"similarity":hit["similarity"]}}
 
-# gets a vector_db name, template and list of questions and returns a list of responses
-def get_rag_qa_list(llm,db,questions,template):
+# gets a vector_db name, template and list of questions and returns a list of responses. The generations
+# are all queued at once, so the scheduler decodes as many in parallel as it has batch slots. With an
+# answer_cache (semantic_cache.SemanticCache) paraphrases of earlier questions are answered from it.
+def get_rag_qa_list(llm,db,questions,template,check_cancelled=None,gen_params=None,retrieval_mode=RETRIEVAL_MODE,lexical_index=None,answer_cache=None,cache_key=None):
     # TODO - make this an arg that comes in 
-    retriever = db.as_retriever(search_kwargs={'k':4},return_source_documents=True)
-    qa_list=[]
-    for question in questions:  
-        r_docs=retriever.get_relevant_documents(question)
-        # out_dir=os.environ.get('OUTPUT_DIR','/var/log/ai_gate/')
-        # with open(os.path.join(out_dir,f"ai_rag.txt"), "a") as _file:
-        #     for r_doc in r_docs:
-        #         _file.write(r_doc)
-        context=""
-        metadata_string=""
-        for i, doc in enumerate(r_docs):
-            doc_pieces=f"{doc}".split("metadata=")
-            metadata_string+=f"{i}: {doc_pieces[1]}\n"
-            context+=doc_pieces[0].strip().replace("page_content=","")+"\n"
-        resp=call_llm(llm,template.replace("|question|",question).replace("|context|",context))
-        qa_list.append({"response":resp,"context":context,"metadata":metadata_string})
-    return qa_list
+    k=4
+    gen_params=gen_params or {}
+    hits, vectors=cached_answers(db,questions,answer_cache,cache_key)
+    missed=[i for i, hit in enumerate(hits) if hit is None]
+    token_budget=context_token_budget(llm,template,gen_params)
+    prompts=build_rag_prompts(db,[questions[i] for i in missed],template,llm,token_budget,k,retrieval_mode,lexical_index)
+    gen_requests=[llm.submit(prompt,**gen_params) for prompt, _, _ in prompts]
+    try:
+        for gen_request in gen_requests:
+            while True:
+                try:
+                    gen_request.result(timeout=0.5)
+                    break
+                except TimeoutError:
+                    if check_cancelled:
+                        check_cancelled()
+    finally:
+        for gen_request in gen_requests:
+            if not gen_request.done():
+                gen_request.cancel()
+    results=[cached_result(hit) if hit is not None else None for hit in hits]
+    for i, gen_request, (_, context, metadata_string) in zip(missed,gen_requests,prompts):
+        results[i]={"response":gen_request.text,"context":context,"metadata":metadata_string}
+        if answer_cache is not None and gen_request.finish_reason in CACHEABLE_FINISH_REASONS:
+            answer_cache.add(cache_key,vectors[i],questions[i],results[i])
+    return results
+
+# same as get_rag_qa_list but yields server-sent events. Answers are generated concurrently, token events of
+# different questions interleave (question_index tells them apart) and each answer's done event is sent
+# as soon as it completes. Cached answers are sent first, as done events without token events.
+def stream_rag_qa_list(llm,db,questions,template,gen_params=None,retrieval_mode=RETRIEVAL_MODE,lexical_index=None,answer_cache=None,cache_key=None):
+    gen_params=gen_params or {}
+    hits, vectors=cached_answers(db,questions,answer_cache,cache_key)
+    for i, hit in enumerate(hits):
+        if hit is not None:
+            yield sse_event("done",{"question_index":i,"question":questions[i],**cached_result(hit),"usage":None})
+    missed=[i for i, hit in enumerate(hits) if hit is None]
+    if not missed:
+        return
+    token_budget=context_token_budget(llm,template,gen_params)
+    prompts=build_rag_prompts(db,[questions[i] for i in missed],template,llm,token_budget,retrieval_mode=retrieval_mode,lexical_index=lexical_index)
+
+    def remember(j, gen_request):
+        if answer_cache is not None and gen_request.finish_reason in CACHEABLE_FINISH_REASONS:
+            _, context, metadata_string=prompts[j]
+            answer_cache.add(cache_key,vectors[missed[j]],questions[missed[j]],{"response":gen_request.text,"context":context,"metadata":metadata_string})
+
+    merged=queue.Queue()
+    yield from stream_generations(
+        [llm.submit(prompt,sink=merged,**gen_params) for prompt, _, _ in prompts],
+        merged,
+        done_extras=[{"context":context,"metadata":metadata_string} for _, context, metadata_string in prompts],
+        event_extras=[{"question_index":i,"question":questions[i]} for i in missed],
+        on_done=remember,
+    )
 
 # creates a list of list of lists of documents that are clusted. Texts should already exist server side but client may choose by name
 # client can pick number of clusters and cluster sizes, server may cache clustered collections - memoize calls.
-def get_cluster_docs(embed,inputs):
-    num_clusters=inputs['num_clusters']
-    cluster_samples=inputs['cluster_samples']
+def nearest_to_centers(vectors, centers, n_samples):
+    """
+    Indices of the n_samples vectors closest to every center, closest first.
+
+    All center to vector distances come from one matrix product and only the n_samples smallest per center
+    are sorted (argpartition), instead of a full argsort per cluster.
+
+    Returns:
+    - numpy.ndarray: int array of shape (len(centers), n_samples).
+    """
+    n_samples = min(int(n_samples), vectors.shape[0])
+    # |c - v|^2 = |c|^2 - 2 c.v + |v|^2, the |c|^2 term does not change the order within a row
+    distances = (vectors * vectors).sum(axis=1)[None, :] - 2.0 * (centers @ vectors.T)
+    nearest = np.argpartition(distances, n_samples - 1, axis=1)[:, :n_samples]
+    order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+def get_cluster_docs(embed,inputs,check_cancelled=None):
+    """
+    Cluster the chunks and pick the cluster_samples chunks closest to every cluster center.
+
+    Corpora over MINIBATCH_KMEANS_THRESHOLD chunks use MiniBatchKMeans, which fits on small random batches
+    and stays in seconds for 100k chunks where full KMeans takes minutes. The chunks are embedded
+    REFRESH_BATCH_SIZE at a time, check_cancelled is called between the batches and around the fit.
+
+    Returns:
+    - list: One list of documents per cluster, closest to the center first.
+    """
     texts=inputs["texts"]
-    vectors = embed.embed_documents([x.page_content for x in texts])
-
-    # Perform K-means clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42).fit(vectors)
-    # not sure what this does
-    kmeans.labels_
-    closest_indices_per_cluster=[]
-    # Loop through the number of clusters you have
-    for i in range(num_clusters):
-        closest_indices = []
-        # Get the list of distances from that particular cluster center
-        distances = np.linalg.norm(vectors - kmeans.cluster_centers_[i], axis=1)
-        # Find the indices of the eight closest points
-        closest_indices = np.argsort(distances)[:cluster_samples]
-        # Append the list of indices to the main list
-        closest_indices_per_cluster.append(closest_indices)
-
-    # Flatten the list of lists and sort it to get a list of unique indices
-    selected_indices = sorted(set(np.concatenate(closest_indices_per_cluster)))
-    selected_docs = [texts[doc] for doc in selected_indices]
-    # To organize selected_docs as a list of lists for each cluster
+    num_clusters=min(int(inputs['num_clusters']), len(texts))
+    cluster_samples=int(inputs['cluster_samples'])
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    page_contents = [x.page_content for x in texts]
+    encode = embed.encode if hasattr(embed, "encode") else embed.embed_documents
+    batches = []
+    for start in range(0, len(page_contents), REFRESH_BATCH_SIZE):
+        if check_cancelled:
+            check_cancelled()
+        batches.append(np.asarray(encode(page_contents[start:start + REFRESH_BATCH_SIZE]), dtype=np.float32))
+    vectors = np.concatenate(batches)
+    if check_cancelled:
+        check_cancelled()
+
+    if len(texts) > MINIBATCH_KMEANS_THRESHOLD:
+        kmeans = MiniBatchKMeans(n_clusters=num_clusters, random_state=42, batch_size=max(4096, num_clusters * 8), n_init=3).fit(vectors)
+    else:
+        kmeans = KMeans(n_clusters=num_clusters, random_state=42).fit(vectors)
+    if check_cancelled:
+        check_cancelled()
+    closest_indices_per_cluster = nearest_to_centers(vectors, kmeans.cluster_centers_.astype(np.float32), cluster_samples)
     organized_docs = [[texts[doc] for doc in cluster_indices] for cluster_indices in closest_indices_per_cluster]
     return organized_docs
 
-# done when server boots up
-def get_doc_vectordb(per_dir,texts,embeddings):
+def chunk_ids_by_source(texts):
+    # ids of every chunk, numbered per source file, and the ids each source got
+    ids=[]
+    ids_by_source={}
+    for text in texts:
+        source=text.metadata.get("source","")
+        source_ids=ids_by_source.setdefault(source,[])
+        source_ids.append(chunk_id(source,len(source_ids)))
+        ids.append(source_ids[-1])
+    return ids, ids_by_source
+
+# whether a vector db was built for per_dir, it can then be opened without the chunks
+def vectordb_exists(per_dir):
+    persist_dir=f"{PERSIST_DIRECTORY}/{per_dir}"
+    return os.path.exists(os.path.join(persist_dir,'chroma.sqlite3')) or IVFStore.exists(persist_dir)
+
+# the chunk size and overlap a collection was built with, None for collections built before manifests
+def collection_chunking(per_dir):
+    return CollectionManifest(f"{PERSIST_DIRECTORY}/{per_dir}").chunking
+
+# done when server boots up. Returns a vector_store.VectorStore, a new db uses the VECTOR_STORE backend and an
+# existing one keeps the backend it was built with. A new db gets a manifest of its source files and chunk
+# ids, so it can later be updated file by file with refresh_doc_vectordb. check_cancelled is called between
+# embedding batches, a cancelled new db is removed so the next call builds it again
+def get_doc_vectordb(per_dir,texts,embeddings,chunking=None,backend=VECTOR_STORE,check_cancelled=None):
+    persist_dir=f"{PERSIST_DIRECTORY}/{per_dir}"
+    is_new=False
     try:
         state="db found"
-        if not os.path.exists(os.path.join(f"{PERSIST_DIRECTORY}/{per_dir}",'chroma.sqlite3')):
+        chroma_exists=os.path.exists(os.path.join(persist_dir,'chroma.sqlite3'))
+        is_new=not (chroma_exists or IVFStore.exists(persist_dir))
+        if IVFStore.exists(persist_dir) or (is_new and backend=="ivf"):
+            db=IVFStore(persist_dir,embeddings)
+        else:
+            from langchain.vectorstores import Chroma
+
+            db=ChromaStore(Chroma(
+                persist_directory=persist_dir,
+                embedding_function=embeddings,
+                client_settings=get_chroma_settings()
+            ))
+        if is_new:
             state="db created"
-            Chroma.from_documents(
-                texts,
-                embeddings,
-                persist_directory=f"{PERSIST_DIRECTORY}/{per_dir}",
-                client_settings=CHROMA_SETTINGS,
-            )
-        db = Chroma(
-            persist_directory=f"{PERSIST_DIRECTORY}/{per_dir}",
-            embedding_function=embeddings,
-            client_settings=CHROMA_SETTINGS
-        )
+            ids, ids_by_source=chunk_ids_by_source(texts)
+            for start in range(0,len(texts),REFRESH_BATCH_SIZE):
+                if check_cancelled:
+                    check_cancelled()
+                db.add_documents(texts[start:start+REFRESH_BATCH_SIZE],ids[start:start+REFRESH_BATCH_SIZE])
+            manifest=CollectionManifest(persist_dir)
+            manifest.chunking=chunking
+            for source, source_ids in ids_by_source.items():
+                if os.path.exists(source):
+                    manifest.set_file(source,file_hash(source),source_ids)
+            manifest.save()
         return db, state
+    except JobCancelled:
+        if is_new:
+            shutil.rmtree(persist_dir,ignore_errors=True)
+        raise
     except Exception as e:
         return None, f"db retrieval Error - {e}"
 
+# BM25 index over a folder's small chunks, with the chunk ids its vector db uses, saved next to the vector dbs
+def build_lexical_index(path,texts):
+    ids, _=chunk_ids_by_source(texts)
+    index=BM25Index.build(ids,[text.page_content for text in texts])
+    index.save(lexical_index_dir(path))
+    return index
+
+# brings a collection up to date with its source folder: chunks of new and changed files are embedded and
+# upserted, chunks of changed and removed files are deleted. Unchanged files (same size and mtime, or same
+# content hash) are not read. check_cancelled is called between files and embedding batches, the manifest is
+# only saved by a finished refresh so a cancelled one is redone by the next refresh.
+def refresh_doc_vectordb(db,per_dir,data,check_cancelled=None):
+    persist_dir=f"{PERSIST_DIRECTORY}/{per_dir}"
+    manifest=CollectionManifest(persist_dir)
+    chunking=manifest.chunking
+    if "small_chunk_size" in data:
+        chunking={"chunk_size":data["small_chunk_size"],"chunk_overlap":data["small_chunk_overlap"]}
+    elif chunking is None:
+        raise ValueError(f"{per_dir} has no recorded chunking, pass small_chunk_size and small_chunk_overlap")
+    rebuilt=False
+    if not manifest.exists or manifest.chunking!=chunking:
+        # built before manifests or with other chunking, every chunk is replaced
+        existing=db.get(include=[])["ids"]
+        if existing:
+            db.delete(existing)
+        manifest.files={}
+        manifest.chunking=chunking
+        rebuilt=True
+    delta=manifest.scan(list_source_files(f"{SOURCE_DIRECTORY}/{data['path']}"))
+    stale_ids=manifest.chunk_ids(delta["changed"]+delta["removed"])
+    if stale_ids:
+        db.delete(stale_ids)
+    for path in delta["removed"]:
+        manifest.remove_file(path)
+    to_load=delta["new"]+delta["changed"]
+    documents=[doc for doc in load_files(to_load,check_cancelled) if doc is not None]
+    chunks=RecursiveCharacterTextSplitter(**chunking,add_start_index=True).split_documents(documents)
+    ids, ids_by_source=chunk_ids_by_source(chunks)
+    for start in range(0,len(chunks),REFRESH_BATCH_SIZE):
+        if check_cancelled:
+            check_cancelled()
+        db.add_documents(chunks[start:start+REFRESH_BATCH_SIZE],ids[start:start+REFRESH_BATCH_SIZE])
+    for path in to_load:
+        manifest.set_file(path,delta["hashes"][path],ids_by_source.get(path,[]))
+    manifest.save()
+    return {
+        "rebuilt":rebuilt,
+        "new":len(delta["new"]),
+        "changed":len(delta["changed"]),
+        "removed":len(delta["removed"]),
+        "unchanged":len(delta["unchanged"]),
+        "chunks_upserted":len(chunks),
+        "chunks_deleted":len(stale_ids),
+    }
+
 
 def get_llm(model_id, model_basename, device, LOGGING):
     return load_quantized_model_gguf_ggml(model_id, model_basename, device, LOGGING)
 
-def get_embeddings(e_model_name,device,_cache_folder):
+def get_embeddings(e_model_name,device,_cache_folder,backend=EMBEDDING_BACKEND):
     print(f"embeddings model name - {e_model_name}")
     print(f"device - {device}")
     print(f"cache_folder - {_cache_folder}")
+    print(f"backend - {backend}")
+    if backend=="onnx":
+        from onnx_embeddings import load_onnx_embeddings
+
+        try:
+            return load_onnx_embeddings(e_model_name,_cache_folder)
+        except Exception as e:
+            # an export that fails or drifts from the torch output is not used
+            logging.error(f"onnx embeddings unavailable, using torch - {e}")
+    from langchain.embeddings import HuggingFaceInstructEmbeddings
+
     return HuggingFaceInstructEmbeddings(model_name=e_model_name, model_kwargs={"device": device}, cache_folder=_cache_folder)
\ No newline at end of file
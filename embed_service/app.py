@@ -1,13 +1,34 @@
-from flask import Flask, request, jsonify, redirect, url_for, render_template_string
+import time
+_import_started=time.time()
+from flask import Flask, request, jsonify, redirect, url_for, render_template_string, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
+import shutil
 import logging
 import ai_calls as ac 
+import retrieval
+from lexical_index import BM25Index, lexical_index_dir
+from scheduler import InferenceScheduler, request_params
+from completion_cache import CompletionCache
+from jobs import JobManager, JobCancelled, check_cancelled
+from model_loader import BackgroundLoader
+from load_models import import_backend
+from embed_batcher import EmbedBatcher
+from embedding_cache import CachedEmbeddings
+from semantic_cache import SemanticCache, cache_key
+from resource_cache import ResourceCache, documents_bytes
+from chunk_store import INDEX_ENTRY, ingest, load_chunks, list_chunk_stores, purge_chunks
+import numpy as np
+from streaming import stream_generation
 from constants import (
     MODEL_ID,
     MODEL_BASENAME,
     EMBEDDING_MODEL_NAME,
     EMBEDDING_MODEL_PATH,
+    EMBEDDING_BACKEND,
+    RETRIEVAL_MODE,
+    VECTOR_DB_CACHE_BYTES,
+    PROCESSED_DOCS_CACHE_BYTES,
     SOURCE_DIRECTORY,
     PERSIST_DIRECTORY,
 )
@@ -15,31 +36,164 @@ ALLOWED_EXTENSIONS = ["csv","doc","docx","enex","epub","html","md","odt","pdf","
 
 app = Flask(__name__)
 device=os.getenv('DEVICE','cuda')
-llm=ac.get_llm(MODEL_ID, MODEL_BASENAME, device, logging)
-embeddings=ac.get_embeddings(EMBEDDING_MODEL_NAME,device,EMBEDDING_MODEL_PATH)
-vector_dbs={}
-processed_docs={}
+
+# the scheduler owns the model, all llm calls from the routes are queued and batched through it
+def _load_llm(progress):
+    progress(0.0, "importing llm backend")
+    import_backend("gguf")
+    progress(0.1, "loading llm")
+    base_llm=ac.get_llm(MODEL_ID, MODEL_BASENAME, device, logging)
+    if base_llm is None:
+        raise RuntimeError(f"unable to load {MODEL_BASENAME}")
+    progress(0.9, "starting scheduler")
+    completion_cache=CompletionCache(MODEL_ID, MODEL_BASENAME, getattr(base_llm, "model_path", None))
+    return InferenceScheduler(base_llm, completion_cache=completion_cache, logging=logging)
+
+def _load_embeddings(progress):
+    progress(0.0, "importing embedding backend")
+    import_backend("onnx" if EMBEDDING_BACKEND=="onnx" else "instructor")
+    progress(0.3, "loading embedding model")
+    embeddings=ac.get_embeddings(EMBEDDING_MODEL_NAME,device,EMBEDDING_MODEL_PATH)
+    progress(0.9, "opening embedding cache")
+    # clustering, the vector dbs and /embed all embed through the cache, a chunk is only embedded once
+    # keyed on the backend's model name, onnx vectors are not mixed with torch ones
+    return CachedEmbeddings(embeddings, embeddings.model_name, logging=logging)
+
+# the llm and the embedder load in parallel in the background, routes use models.get(...) which errors until
+# the model they need is ready. Poll /readyz instead of sleeping, /healthz also reports the startup time
+# split into module imports, backend imports and model loading.
+models=BackgroundLoader(import_seconds=time.time()-_import_started, logging=logging)
+models.start("llm", _load_llm)
+models.start("embeddings", _load_embeddings)
+embed_batcher=EmbedBatcher(lambda: models.get("embeddings"), logging=logging)
+def _vector_db_bytes(db):
+    quantized=getattr(db,"_quantized_retriever",None)
+    return db.resident_bytes()+(quantized.index.vectors.nbytes if quantized is not None else 0)
+
+def _processed_docs_bytes(entry):
+    # the chunk lists are memory-mapped, only cluster samples are held as Documents
+    clusters=[doc for result in entry.get("cluster_results",{}).values() for docs in result for doc in docs]
+    return INDEX_ENTRY.size*(len(entry["small_texts"])+len(entry["large_texts"]))+documents_bytes(clusters)
+
+# open vector dbs and processed folders, least recently used ones are dropped past their byte budget and
+# reopened on their next use (the /stats caches entry reports their sizes)
+vector_dbs=ResourceCache("vector_dbs",VECTOR_DB_CACHE_BYTES,_vector_db_bytes,logging=logging)
+processed_docs=ResourceCache("processed_docs",PROCESSED_DOCS_CACHE_BYTES,_processed_docs_bytes,logging=logging)
+lexical_indexes={}
+# answers of /call_rag by question similarity, per collection and template
+rag_cache=SemanticCache(logging=logging)
 recent_log=""
 
+def _chunk_params(data):
+    # the chunk sizes of a request, None unless it has all of them
+    keys=("small_chunk_size","small_chunk_overlap","large_chunk_size","large_chunk_overlap")
+    return {key:int(data[key]) for key in keys} if all(key in data for key in keys) else None
+
+# brings a folder's chunk store up to date with its files and opens it. Only new and changed files are loaded
+# and split (see chunk_store.ingest), the chunk sizes default to the ones the folder was processed with.
+# A job cancelled while ingesting stops between files and keeps the store as it was. Returns the ingestion delta.
+def _ingest(data):
+    path=data["path"]
+    params=_chunk_params(data)
+    if params is None:
+        stored=load_chunks(path)
+        if stored is None:
+            raise ValueError(f"{path} is not processed, call /process_documents first")
+        params=stored["params"]
+    data={**data,**params}
+    delta=ingest(path,ac.list_source_files(f"{SOURCE_DIRECTORY}/{path}"),params,lambda ignored_files: ac.process_documents(data,ignored_files,check_cancelled),check_cancelled)
+    if delta["updated"]:
+        # the BM25 index is rebuilt from the new chunks when it is next used
+        lexical_indexes.pop(path,None)
+        shutil.rmtree(lexical_index_dir(path),ignore_errors=True)
+    if delta["updated"] or not path in processed_docs:
+        processed_docs[path]=load_chunks(path)
+    return delta
+
+# folders already open are used as they are, /process_documents picks up changes to their files
 def _process_docs_helper(data):
     try:
-        if not data['path'] in processed_docs.keys():
-            small_texts, large_texts=ac.process_documents(data)
-            processed_docs[data["path"]]={"small_texts":small_texts,"large_texts":large_texts}
+        if not data['path'] in processed_docs:
+            _ingest(data)
         return True
+    except JobCancelled:
+        raise
     except Exception as e:
         logging.error(e)
         print(e)
         return False
 
+def _processed_docs(data):
+    if not _process_docs_helper(data):
+        raise RuntimeError("processed docs failed")
+    return processed_docs[data["path"]]
+
+# the folder's BM25 index, from memory, from disk (saved when the folder was last processed) or built by
+# processing the folder
+def _lexical_index_helper(data):
+    path=data["path"]
+    if not path in lexical_indexes:
+        index_dir=lexical_index_dir(path)
+        if os.path.exists(index_dir):
+            lexical_indexes[path]=BM25Index.load(index_dir)
+        else:
+            small_texts=_processed_docs(data)["small_texts"]
+            if not path in lexical_indexes:
+                lexical_indexes[path]=ac.build_lexical_index(path,small_texts)
+    return lexical_indexes[path]
+
+def _small_chunking(params):
+    # the chunking of the small chunks the vector dbs and lexical indexes are built from
+    return {"chunk_size":params["small_chunk_size"],"chunk_overlap":params["small_chunk_overlap"]}
+
+def _retrieval_args(data):
+    # retrieval_mode of the request and the lexical index it needs. The lexical index is built from the
+    # folder's chunk store, its chunk ids only match the collection's when both used the same chunking
+    mode=data.get("retrieval_mode",RETRIEVAL_MODE)
+    if mode=="vector":
+        return {"retrieval_mode":mode,"lexical_index":None}
+    lexical_index=_lexical_index_helper(data)
+    chunking=ac.collection_chunking(data["dir_name"])
+    stored=processed_docs.get(data["path"]) or load_chunks(data["path"])
+    if chunking is None or stored is None:
+        logging.warning(f"unable to check that {data['dir_name']} and the lexical index of {data['path']} have the same chunking")
+    elif _small_chunking(stored["params"])!=chunking:
+        raise ValueError(f"{data['dir_name']} was built with chunking {chunking} but {data['path']} is processed with {_small_chunking(stored['params'])}, {mode} retrieval needs both the same - refresh the collection or process the folder with its chunk sizes")
+    return {"retrieval_mode":mode,"lexical_index":lexical_index}
+
+def _rag_cache_args(data):
+    # the semantic cache and the request's partition of it, 'semantic_cache': false skips the cache
+    if not data.get("semantic_cache",True):
+        return {}
+    key=cache_key(data["dir_name"],data["template"],data.get("retrieval_mode",RETRIEVAL_MODE),request_params(data))
+    return {"answer_cache":rag_cache,"cache_key":key}
+
+def _cache_vector_db(dir_name,db):
+    # the db is re-measured when it builds its quantized index
+    db.on_resize=lambda: vector_dbs.resize(dir_name)
+    vector_dbs[dir_name]=db
+
 def _set_db_kv_helper(data):
-    if not data["dir_name"] in vector_dbs.keys():
+    # recent_log keeps why the last load failed, _set_db_kv_task reports it
+    global recent_log
+    if not data["dir_name"] in vector_dbs:
         try:
+            if ac.vectordb_exists(data["dir_name"]):
+                # built before (or dropped from the cache), opened from disk without chunking the folder
+                db, state=ac.get_doc_vectordb(data["dir_name"],[],models.get("embeddings"))
+                if db is None:
+                    logging.error(state)
+                    recent_log=state
+                    return False
+                _cache_vector_db(data["dir_name"],db)
+                return True
             if _process_docs_helper(data):
-                db, state=ac.get_doc_vectordb(data["dir_name"],processed_docs[data["path"]]["small_texts"],embeddings)
+                # the chunk sizes the folder's chunks were made with, the request's or the chunk store's own
+                chunking=_small_chunking(processed_docs[data["path"]]["params"])
+                db, state=ac.get_doc_vectordb(data["dir_name"],processed_docs[data["path"]]["small_texts"],models.get("embeddings"),chunking,check_cancelled=check_cancelled)
                 recent_log=state
                 if not (db is None):
-                    vector_dbs[data["dir_name"]]=db
+                    _cache_vector_db(data["dir_name"],db)
                     logging.info("vector db value set")
                     return True
                 else:
@@ -49,6 +203,8 @@ def _set_db_kv_helper(data):
                 logging.warning("Process docs helper failed")
                 recent_log="Process docs helper failed"
                 return False
+        except JobCancelled:
+            raise
         except Exception as e:
             logging.error(e)
             recent_log=f"Error - {e}"
@@ -64,7 +220,7 @@ def _allowed_file(filename):
 # Root path
 @app.route('/')
 def welcome():
-    return 'Welcome to the AI Gateway! Use /process_documents, /call_llm, /cluster_docs with a json message.'
+    return 'Welcome to the AI Gateway! Use /process_documents, /call_llm, /cluster_docs with a json message, or submit them to /jobs.'
 
 #SOURCE_DIRECTORY
 @app.route('/upload_form')
@@ -98,31 +254,148 @@ def upload_file():
             file.save(os.path.join(target_folder, filename))
     return redirect(url_for('upload_form'))
 
+# the work behind each route, shared by the synchronous routes and the /jobs api. Each returns the
+# success message or raises with the error message.
+def _process_documents_task(data):
+    req_keys=['path',"small_chunk_size","small_chunk_overlap","large_chunk_size","large_chunk_overlap"]
+    for req_key in req_keys:
+        if not req_key in data.keys():
+            raise ValueError(f"missing the {req_key} key")
+    # List contents of the folder, the chunks are kept in the folder's chunk store (see /purge_chunks) and
+    # only files that are new or changed since the last call are loaded
+    delta=_ingest(data)
+    small_texts_cnt=str(delta['small_texts'])
+    large_texts_cnt=str(delta['large_texts'])
+    logging.info(f"num_small_docs:{small_texts_cnt}, num_large_docs: {large_texts_cnt}, delta: {delta}")
+    return {'num_small_docs':small_texts_cnt,'num_large_docs':large_texts_cnt,'delta':delta}
+
+def _doc_prompt_task(data):
+    # needs path, text_type, doc_number and template
+    text_docs=_processed_docs(data)[data['text_type']][int(data['doc_number'])]
+    llm=models.get("llm")
+    prompt, doc_strings=ac.build_doc_prompt(llm,text_docs,data["template"],request_params(data))
+    resp=ac.call_llm(llm,prompt,**request_params(data))
+    logging.info(resp)
+    return {"response":resp,"context":doc_strings['context'], "metadata":doc_strings["metadata"]}
+
+def _call_llm_task(data):
+    resp=ac.call_llm(models.get("llm"),data["prompt"],**request_params(data))
+    logging.info(resp)
+    return resp
+
+def _cluster_docs_task(data):
+    #TODO, can be done from list of docs sent in message, should also be done server side only.
+    # data needs "texts","num_clusters","cluster_samples"
+    if not _process_docs_helper(data):
+        raise RuntimeError("processed docs failed")
+    docs=processed_docs[data["path"]]
+    tmp_data={}
+    tmp_data["texts"]=docs["small_texts"]
+    tmp_data['num_clusters']=int(data['num_clusters'])
+    tmp_data['cluster_samples']=int(data['cluster_samples'])
+    # memoized per parameters and embedding model, "clusters" holds the latest result for /doc_prompt
+    cluster_key=(tmp_data['num_clusters'],tmp_data['cluster_samples'],models.get("embeddings").model_name)
+    cluster_results=docs.setdefault("cluster_results",{})
+    if not cluster_key in cluster_results:
+        cluster_results[cluster_key]=ac.get_cluster_docs(models.get("embeddings"),tmp_data,check_cancelled)
+        processed_docs.resize(data["path"])
+    docs["clusters"]=cluster_results[cluster_key]
+    #processed_docs[data["path"]]["clusters"]=ac.get_cluster_docs(embeddings,data)
+    #TODO return length of clusters if theses can be different than num_clusters
+    logging.info("clustered docs successfully")
+    return "clustered docs successfully"
+
+def _purge_chunks_task(data):
+    # 'path' purges one folder's stored chunks, no path purges every folder's
+    path=data.get("path")
+    purged=purge_chunks(path)
+    for purged_path in processed_docs.keys() if path is None else [path]:
+        processed_docs.pop(purged_path,None)
+    logging.info(f"purged chunk stores {purged}")
+    return {"purged":purged}
+
+def _set_db_kv_task(data):
+    if not _set_db_kv_helper(data):
+        raise RuntimeError(f"db kv unable to load - {recent_log}")
+    logging.info("db kv successfully loaded")
+    return "db kv successfully loaded"
+
+def _refresh_db_task(data):
+    # needs dir_name and path, small_chunk_size and small_chunk_overlap default to the collection's own
+    if not _set_db_kv_helper(data):
+        raise RuntimeError("refresh failed due to - db kv unable to load")
+    db=vector_dbs[data["dir_name"]]
+    try:
+        summary=ac.refresh_doc_vectordb(db,data["dir_name"],data,check_cancelled)
+    finally:
+        # the processed chunks, clusters and quantized index of the folder no longer match the collection
+        # (a cancelled refresh may have changed part of it), the chunks are brought up to date on their next use
+        processed_docs.pop(data["path"],None)
+        lexical_indexes.pop(data["path"],None)
+        shutil.rmtree(lexical_index_dir(data["path"]),ignore_errors=True)
+        if hasattr(db,"_quantized_retriever"):
+            del db._quantized_retriever
+        vector_dbs.resize(data["dir_name"])
+        rag_cache.invalidate(data["dir_name"])
+    logging.info(f"refreshed {data['dir_name']} - {summary}")
+    return summary
+
+def _search_task(data):
+    # needs dir_name (and path, chunk sizes if the db is not loaded yet) and "query" or "queries". Optional
+    # k, score_threshold, filter (chroma where), mmr, fetch_k, lambda_mult and retrieval_mode
+    if not _set_db_kv_helper(data):
+        raise RuntimeError("search failed due to - db kv unable to load")
+    queries=data["queries"] if "queries" in data else [data["query"]]
+    retrieval_args=_retrieval_args(data)
+    results=retrieval.search(
+        vector_dbs[data["dir_name"]],
+        queries,
+        mode=retrieval_args["retrieval_mode"],
+        lexical_index=retrieval_args["lexical_index"],
+        k=data.get("k",4),
+        score_threshold=data.get("score_threshold"),
+        where=data.get("filter"),
+        mmr=data.get("mmr",False),
+        fetch_k=data.get("fetch_k"),
+        lambda_mult=data.get("lambda_mult",0.5),
+    )
+    return [
+        {"query":query,"matches":[{"content":doc.page_content,"metadata":doc.metadata,"score":score,"distance":distance} for doc, score, distance in matches]}
+        for query, matches in zip(queries,results)
+    ]
+
+def _call_rag_task(data):
+    if not _set_db_kv_helper(data):
+        raise RuntimeError("get rag failed due to - db kv unable to load")
+    qa_list=ac.get_rag_qa_list(models.get("llm"),vector_dbs[data["dir_name"]],data['questions'],data['template'],check_cancelled=check_cancelled,gen_params=request_params(data),**_retrieval_args(data),**_rag_cache_args(data))
+    logging.info(qa_list)
+    return qa_list
+
+job_manager=JobManager({
+    "process_documents":_process_documents_task,
+    "doc_prompt":_doc_prompt_task,
+    "call_llm":_call_llm_task,
+    "cluster_docs":_cluster_docs_task,
+    "purge_chunks":_purge_chunks_task,
+    "set_db_kv":_set_db_kv_task,
+    "refresh_db":_refresh_db_task,
+    "search":_search_task,
+    "call_rag":_call_rag_task,
+}, logging=logging)
+
+def _run_task(task, data):
+    try:
+        return jsonify({'status': 'success', 'message': task(data)})
+    except Exception as e:
+        logging.error(e)
+        return jsonify({'status': 'error', 'message': str(e)})
+
 # process_documents
 @app.route('/process_documents', methods=['POST'])
 def process_documents():
     try:
         data = request.json
-        req_keys=['path',"small_chunk_size","small_chunk_overlap","large_chunk_size","large_chunk_overlap"]
-        for req_key in req_keys:
-            if not req_key in data.keys():
-                return jsonify({'status': 'error', 'message': f"missing the {req_key} key"})
-        try:
-            # List contents of the folder
-            #TODO, add state files for saving and loading information like this. State should be purgable as well.
-            if _process_docs_helper(data):
-                #processed_docs[data["path"]]
-                small_texts_cnt=str(len(processed_docs[data["path"]]['small_texts']))
-                large_texts_cnt=str(len(processed_docs[data["path"]]['large_texts']))
-                logging.info(f"num_small_docs:{small_texts_cnt}, num_large_docs: {large_texts_cnt}")
-                return jsonify({'status': 'success', 'message': {'num_small_docs':small_texts_cnt,'num_large_docs':large_texts_cnt}})
-                #f"small and large chunks created for {data['path']}"})
-            else:
-                logging.error( "Unable to process docs")
-                return jsonify({'status': 'error', 'message': "Unable to process docs"})
-        except Exception as e:
-            logging.error(e)
-            return jsonify({'status': 'error', 'message': str(e)})
+        return _run_task(_process_documents_task, data)
     except Exception as e:
         logging.error(e)
 
@@ -132,15 +405,18 @@ def doc_prompt():
     try:
         # needs path, text_type, doc_number and template
         data = request.json
-        try:
-            text_docs=processed_docs[data['path']][data['text_type']][int(data['doc_number'])]
-            doc_strings=ac.docs_to_strings(text_docs)
-            resp=ac.call_llm(llm,data["template"].replace("|context|",doc_strings['context']))
-            logging.info(resp)
-            return jsonify({'status': 'success', 'message': {"response":resp,"context":doc_strings['context'], "metadata":doc_strings["metadata"]}})
-        except Exception as e:
-            logging.error(e)
-            return jsonify({'status': 'error', 'message': str(e)})
+        if data.get("stream"):
+            try:
+                text_docs=_processed_docs(data)[data['text_type']][int(data['doc_number'])]
+                llm=models.get("llm")
+                prompt, doc_strings=ac.build_doc_prompt(llm,text_docs,data["template"],request_params(data))
+                gen_request=llm.submit(prompt,**request_params(data))
+                events=stream_generation(gen_request, done_extra={"context":doc_strings['context'], "metadata":doc_strings["metadata"]})
+                return Response(stream_with_context(events), mimetype="text/event-stream")
+            except Exception as e:
+                logging.error(e)
+                return jsonify({'status': 'error', 'message': str(e)})
+        return _run_task(_doc_prompt_task, data)
     except Exception as e:
         logging.error(e)
 
@@ -149,80 +425,170 @@ def doc_prompt():
 def call_llm():
     try:
         data = request.json
-        try:
-            resp=ac.call_llm(llm,data["prompt"])
-            logging.info(resp)
-            return jsonify({'status': 'success', 'message': resp})
-        except Exception as e:
-            logging.error(e)
-            return jsonify({'status': 'error', 'message': str(e)})
+        if data.get("stream"):
+            try:
+                return Response(stream_with_context(stream_generation(models.get("llm").submit(data["prompt"],**request_params(data)))), mimetype="text/event-stream")
+            except Exception as e:
+                logging.error(e)
+                return jsonify({'status': 'error', 'message': str(e)})
+        return _run_task(_call_llm_task, data)
     except Exception as e:
         logging.error(e)
 
 # call get cluster docs
 @app.route('/cluster_docs', methods=['POST'])
 def cluster_docs():
-    #TODO, can be done from list of docs sent in message, should also be done server side only.
-    # data needs "texts","num_clusters","cluster_samples"
     try:
         data = request.json
-        try: 
-            if _process_docs_helper(data):
-                tmp_data={}
-                tmp_data["texts"]=processed_docs[data["path"]]["small_texts"]
-                tmp_data['num_clusters']=data['num_clusters']
-                tmp_data['cluster_samples']=data['cluster_samples']
-                if not "clusters" in processed_docs[data["path"]].keys():
-                    processed_docs[data["path"]]["clusters"]=ac.get_cluster_docs(embeddings,tmp_data)
-                #processed_docs[data["path"]]["clusters"]=ac.get_cluster_docs(embeddings,data)
-                #TODO return length of clusters if theses can be different than num_clusters
-                logging.info("clustered docs successfully")
-                return jsonify({'status': 'success', 'message': "clustered docs successfully"})
-            else:
-                return jsonify({'status': 'error', 'message': "processed docs failed"})
-        except Exception as e:
-            logging.error(e)
-            return jsonify({'status': 'error', 'message': str(e)})
+        return _run_task(_cluster_docs_task, data)
+    except Exception as e:
+        logging.error(e)
+
+# delete stored chunks - 'path' for one folder, every folder without it. The folders are processed again on
+# their next use.
+@app.route('/purge_chunks', methods=['POST'])
+def purge_chunks_route():
+    try:
+        data = request.get_json(silent=True) or {}
+        return _run_task(_purge_chunks_task, data)
     except Exception as e:
         logging.error(e)
 
+# the stored folders with the chunk sizes they were processed with and their chunk counts
+@app.route('/chunk_stores', methods=['GET'])
+def chunk_stores():
+    return jsonify({'status': 'success', 'message': list_chunk_stores()})
+
 # call set db key value
 @app.route('/set_db_kv', methods=['POST'])
 def set_db_kv():
+    try:
+        data = request.json
+        return _run_task(_set_db_kv_task, data)
+    except Exception as e:
+        logging.error(e)
+
+# update a vector db with the new, changed and removed files of its folder
+@app.route('/refresh_db', methods=['POST'])
+def refresh_db():
+    try:
+        data = request.json
+        return _run_task(_refresh_db_task, data)
+    except Exception as e:
+        logging.error(e)
+
+# top chunks with scores for one or more queries, no llm call
+@app.route('/search', methods=['POST'])
+def search():
+    try:
+        data = request.json
+        return _run_task(_search_task, data)
+    except Exception as e:
+        logging.error(e)
+
+# call get_rag_qa_list
+@app.route('/call_rag', methods=['POST'])
+def call_rag():
+    try:
+        data = request.json
+        if data.get("stream"):
+            try:
+                if not _set_db_kv_helper(data):
+                    raise RuntimeError("get rag failed due to - db kv unable to load")
+                events=ac.stream_rag_qa_list(models.get("llm"),vector_dbs[data["dir_name"]],data['questions'],data['template'],gen_params=request_params(data),**_retrieval_args(data),**_rag_cache_args(data))
+                return Response(stream_with_context(events), mimetype="text/event-stream")
+            except Exception as e:
+                logging.error(e)
+                return jsonify({'status': 'error', 'message': str(e)})
+        return _run_task(_call_rag_task, data)
+    except Exception as e:
+        logging.error(e)
+
+# embed texts - needs 'texts', optional 'instruction' ("document", "query" or an instruction string),
+# 'dtype' ("float32" or "float16") and 'format'. By default the vectors come back as raw little-endian
+# row-major bytes with the shape in the X-Embedding-Count / X-Embedding-Dim headers, 'format': 'json' returns lists.
+@app.route('/embed', methods=['POST'])
+def embed():
     try:
         data = request.json
         try:
-            if _set_db_kv_helper(data):
-                logging.info("db kv successfully loaded")
-                return jsonify({'status': 'success', 'message': "db kv successfully loaded"})
-            else:
-                logging.error(recent_log)
-                return jsonify({'status': 'error', 'message': recent_log})
+            texts=data['texts']
+            if isinstance(texts, str):
+                texts=[texts]
+            if not texts:
+                raise ValueError("texts is empty")
+            vectors=embed_batcher.embed(texts, data.get('instruction'))
+            if data.get('dtype', 'float32') not in ('float32', 'float16'):
+                raise ValueError("dtype must be float32 or float16")
+            dtype=np.dtype(data.get('dtype', 'float32')).newbyteorder('<')
+            if data.get('format') == 'json':
+                return jsonify({'status': 'success', 'message': vectors.tolist()})
+            return Response(vectors.astype(dtype).tobytes(), mimetype="application/octet-stream", headers={
+                "X-Embedding-Count": str(vectors.shape[0]),
+                "X-Embedding-Dim": str(vectors.shape[1]),
+                "X-Embedding-Dtype": dtype.name,
+            })
         except Exception as e:
             logging.error(e)
             return jsonify({'status': 'error', 'message': str(e)})
     except Exception as e:
         logging.error(e)
 
-# call get_rag_qa_list
-@app.route('/call_rag', methods=['POST'])
-def call_rag():
+# submit a job - needs 'kind' (one of the route names above) and 'payload' (the json that route takes)
+@app.route('/jobs', methods=['POST'])
+def submit_job():
     try:
         data = request.json
         try:
-            if _set_db_kv_helper(data):
-                qa_list=ac.get_rag_qa_list(llm,vector_dbs[data["dir_name"]],data['questions'],data['template'])
-                logging.info(qa_list)
-                return jsonify({'status': 'success', 'message': qa_list})
-            else:
-                logging.error("get rag failed due to - db kv unable to load")
-                return jsonify({'status': 'error', 'message': "get rag failed due to - db kv unable to load"})
+            job=job_manager.submit(data['kind'], data.get('payload', {}))
+            return jsonify({'status': 'success', 'message': job.to_dict()})
         except Exception as e:
             logging.error(e)
             return jsonify({'status': 'error', 'message': str(e)})
     except Exception as e:
         logging.error(e)
 
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'status': 'success', 'message': job_manager.list()})
+
+# poll a job, the result is kept for JOB_RESULT_TTL seconds after it finishes
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job=job_manager.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f"no job {job_id}"}), 404
+    return jsonify({'status': 'success', 'message': job.to_dict()})
+
+# cancel a job, queued jobs are dropped and running jobs stop at their next checkpoint
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job=job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f"no job {job_id}"}), 404
+    return jsonify({'status': 'success', 'message': job.to_dict()})
+
+# scheduler and cache counters
+@app.route('/stats', methods=['GET'])
+def stats():
+    try:
+        return jsonify({'status': 'success', 'message': {"llm":models.get("llm").stats(),"embed_batcher":embed_batcher.stats(),"embedding_cache":models.get("embeddings").stats(),"rag_cache":rag_cache.stats(),"vector_dbs":vector_dbs.report(),"processed_docs":processed_docs.report()}})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+
+# liveness - the process is up, with per model load state
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'success', 'message': models.report()})
+
+# readiness - 503 until every model has loaded
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    report=models.report()
+    if report["ready"]:
+        return jsonify({'status': 'success', 'message': report})
+    return jsonify({'status': 'error', 'message': report}), 503
+
 if __name__ == "__main__":
     port = int(os.getenv('PORT', '5000'))
     app.run(debug=True, port=port)
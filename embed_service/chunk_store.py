@@ -0,0 +1,398 @@
+import os
+import json
+import mmap
+import time
+import shutil
+import struct
+import operator
+import threading
+from collections.abc import Sequence
+
+from constants import CHUNK_STORE_DIRECTORY, CHUNK_STORE_COMPACT_RATIO
+from index_manifest import scan_files
+
+# per chunk: text offset, text length, metadata offset, metadata length
+INDEX_ENTRY = struct.Struct("<QQQQ")
+STORE_FILE = "store.json"
+KINDS = ("small_texts", "large_texts")
+# one ingestion at a time, they share the stores' temporary folders
+_ingest_lock = threading.Lock()
+
+
+def chunk_store_dir(path):
+    # keyed by the source folder the chunks came from, like the lexical indexes
+    return os.path.join(CHUNK_STORE_DIRECTORY, path.strip("/").replace("/", "__") or "root")
+
+
+def _map(file_path):
+    # an empty file can not be mapped
+    if not os.path.getsize(file_path):
+        return b""
+    with open(file_path, "rb") as _file:
+        return mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _ChunkWriter:
+    """
+    Writes one kind of chunks of a store: new Documents, byte ranges copied from an older store, or index
+    entries kept as they are when the blobs are appended to in place.
+
+    A fresh writer creates kind_dir. An appending writer (text_bytes and meta_bytes given) first cuts the
+    blobs back to those committed lengths, dropping what a crashed ingestion appended, and writes after
+    them. Either way the index is a new file, the old one stays valid for the ChunkLists still using it.
+    """
+
+    def __init__(self, kind_dir, index_name, text_bytes=None, meta_bytes=None):
+        append = text_bytes is not None
+        if not append:
+            os.makedirs(kind_dir)
+        self.text_file = open(os.path.join(kind_dir, "text.bin"), "r+b" if append else "wb")
+        self.meta_file = open(os.path.join(kind_dir, "meta.bin"), "r+b" if append else "wb")
+        self.index_file = open(os.path.join(kind_dir, index_name), "wb")
+        self.text_offset = text_bytes or 0
+        self.meta_offset = meta_bytes or 0
+        if append:
+            for _file, size in ((self.text_file, self.text_offset), (self.meta_file, self.meta_offset)):
+                _file.truncate(size)
+                _file.seek(size)
+        self.count = 0
+        self.live_bytes = 0
+
+    def add(self, doc):
+        text = doc.page_content.encode("utf-8")
+        meta = json.dumps(doc.metadata, default=str).encode("utf-8")
+        self.text_file.write(text)
+        self.meta_file.write(meta)
+        self.index_file.write(INDEX_ENTRY.pack(self.text_offset, len(text), self.meta_offset, len(meta)))
+        self.text_offset += len(text)
+        self.meta_offset += len(meta)
+        self.live_bytes += len(text) + len(meta)
+        self.count += 1
+
+    def keep(self, chunks, start, count):
+        # the chunks stay where they are in the blobs, only their index entries are carried over
+        if not count:
+            return
+        entries = chunks._index[start * INDEX_ENTRY.size:(start + count) * INDEX_ENTRY.size]
+        self.index_file.write(entries)
+        self.live_bytes += sum(text_len + meta_len for _, text_len, _, meta_len in INDEX_ENTRY.iter_unpack(entries))
+        self.count += count
+
+    def copy(self, chunks, start, count):
+        # a file's chunks are written together, so their text and metadata are contiguous in the old blobs
+        if not count:
+            return
+        entries = [INDEX_ENTRY.unpack_from(chunks._index, i * INDEX_ENTRY.size) for i in range(start, start + count)]
+        text_start, meta_start = entries[0][0], entries[0][2]
+        text_end, meta_end = entries[-1][0] + entries[-1][1], entries[-1][2] + entries[-1][3]
+        self.text_file.write(chunks._text[text_start:text_end])
+        self.meta_file.write(chunks._meta[meta_start:meta_end])
+        self.index_file.write(b"".join(
+            INDEX_ENTRY.pack(text_offset - text_start + self.text_offset, text_len, meta_offset - meta_start + self.meta_offset, meta_len)
+            for text_offset, text_len, meta_offset, meta_len in entries
+        ))
+        self.text_offset += text_end - text_start
+        self.meta_offset += meta_end - meta_start
+        self.live_bytes += (text_end - text_start) + (meta_end - meta_start)
+        self.count += count
+
+    def close(self):
+        for _file in (self.text_file, self.meta_file, self.index_file):
+            _file.close()
+
+    def blob_stats(self):
+        return {"text_bytes": self.text_offset, "meta_bytes": self.meta_offset, "live_bytes": self.live_bytes}
+
+
+class ChunkList(Sequence):
+    """
+    Read-only list of the chunks of one processed folder, memory-mapped from its chunk store.
+
+    A chunk is only decoded into a Document when it is indexed, so fetching chunk n reads one index
+    entry, its text and its metadata and nothing else.
+
+    Parameters:
+    - kind_dir (str): The folder of one kind of chunks (small_texts or large_texts) in a chunk store.
+    - grouped (bool): Return every chunk wrapped in a list, the shape processed large_texts have.
+    - index_name (str): The store's current index file, see _index_name.
+    """
+
+    def __init__(self, kind_dir, grouped=False, index_name="index.bin"):
+        self.grouped = grouped
+        self._text = _map(os.path.join(kind_dir, "text.bin"))
+        self._meta = _map(os.path.join(kind_dir, "meta.bin"))
+        self._index = _map(os.path.join(kind_dir, index_name))
+        self._count = len(self._index) // INDEX_ENTRY.size
+
+    def __len__(self):
+        return self._count
+
+    def _doc(self, i):
+        from langchain.docstore.document import Document
+
+        text_offset, text_len, meta_offset, meta_len = INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)
+        return Document(
+            page_content=self._text[text_offset:text_offset + text_len].decode("utf-8"),
+            metadata=json.loads(self._meta[meta_offset:meta_offset + meta_len]),
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        i = operator.index(i)
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(f"chunk {i} out of range, {self._count} chunks")
+        doc = self._doc(i)
+        return [doc] if self.grouped else doc
+
+    @property
+    def nbytes(self):
+        # mapped bytes, in the page cache rather than the heap and shared between processes
+        return len(self._text) + len(self._meta) + len(self._index)
+
+
+def _read_store(path):
+    try:
+        with open(os.path.join(chunk_store_dir(path), STORE_FILE)) as _file:
+            return json.load(_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _by_source(docs):
+    # chunks grouped by the file they came from, in order
+    grouped = {}
+    for doc in docs:
+        grouped.setdefault(doc.metadata.get("source", ""), []).append(doc)
+    return grouped
+
+
+def _index_name(generation):
+    # stores written before generations have a single index.bin
+    return "index.bin" if generation is None else f"index-{generation}.bin"
+
+
+def ingest(path, file_paths, params, process, check_cancelled=None):
+    """
+    Bring a folder's chunk store up to date with its files, only new and changed files are loaded and split.
+
+    The store keeps an ingestion manifest, every file's size, mtime, content hash and the range of its
+    chunks. Files whose size and mtime (or hash) match the manifest keep their chunks. The chunks of new
+    and changed files are appended to the text and metadata blobs, and a new index (32 bytes per chunk)
+    lists the live chunks, so an update writes the new chunks and the index, not the corpus. The chunks of
+    changed and removed files stay in the blobs as dead bytes until they are more than CHUNK_STORE_COMPACT_RATIO
+    of them, then the live chunks are copied into a new store. A store made with other chunk sizes is
+    rebuilt. Files that give no chunks (a loader that failed) are left out of the manifest so the next
+    ingestion tries them again.
+
+    Parameters:
+    - path (str): The folder under SOURCE_DIRECTORY.
+    - file_paths (list): The folder's files.
+    - params (dict): The chunk sizes and overlaps.
+    - process (callable): Takes the set of files to skip and returns (small_texts, large_texts) of the
+      other files, as process_documents does.
+    - check_cancelled (callable): Called once the files are processed and before every file's chunks are
+      written, raises to stop the ingestion. A store cut short keeps its last committed version.
+
+    Returns:
+    - dict: The delta - new, changed, removed and unchanged file counts, whether the store was rebuilt,
+      updated or compacted, and its chunk counts.
+    """
+    with _ingest_lock:
+        return _ingest(path, file_paths, params, process, check_cancelled or (lambda: None))
+
+
+def _ingest(path, file_paths, params, process, check_cancelled):
+    store = _read_store(path)
+    rebuilt = store is None or store.get("params") != params or "files" not in store
+    files = {} if rebuilt else store["files"]
+    delta = scan_files(files, file_paths)
+    parsed = delta["new"] + delta["changed"]
+    summary = {
+        "new": len(delta["new"]),
+        "changed": len(delta["changed"]),
+        "removed": len(delta["removed"]),
+        "unchanged": len(delta["unchanged"]),
+        "rebuilt": rebuilt,
+        "compacted": False,
+    }
+    store_dir = chunk_store_dir(path)
+    small_texts, large_texts = process(set(delta["unchanged"])) if parsed else ([], [])
+    check_cancelled()
+    new_chunks = {"small_texts": _by_source(small_texts), "large_texts": _by_source([docs[0] for docs in large_texts])}
+    # files that gave no chunks are not recorded, they are parsed again next time
+    parsed = [file_path for file_path in parsed if any(file_path in new_chunks[kind] for kind in KINDS)]
+    summary["updated"] = rebuilt or bool(parsed or delta["changed"] or delta["removed"])
+    if not summary["updated"]:
+        if delta["touched"]:
+            # touched files got their new mtime in scan_files
+            _write_store_file(store_dir, store)
+        summary.update({kind: store[kind] for kind in KINDS})
+        return summary
+    old_chunks = None if rebuilt else load_chunks(path)
+    new_files = {}
+    for file_path in delta["unchanged"]:
+        new_files[file_path] = dict(files[file_path])
+    for file_path in parsed:
+        stat = os.stat(file_path)
+        new_files[file_path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": delta["hashes"][file_path]}
+    if rebuilt or "blobs" not in store:
+        # new stores and stores written before in place updates are written whole
+        _write_store(path, params, old_chunks, files, new_files, delta["unchanged"], parsed, new_chunks, summary, check_cancelled)
+        return summary
+    generation = store["generation"] + 1
+    blobs = {}
+    for kind in KINDS:
+        kind_dir = os.path.join(store_dir, kind)
+        writer = _ChunkWriter(kind_dir, _index_name(generation), store["blobs"][kind]["text_bytes"], store["blobs"][kind]["meta_bytes"])
+        try:
+            for file_path in delta["unchanged"]:
+                check_cancelled()
+                start, count = files[file_path][kind]
+                new_files[file_path][kind] = [writer.count, count]
+                writer.keep(old_chunks[kind], start, count)
+            for file_path in parsed:
+                check_cancelled()
+                docs = new_chunks[kind].get(file_path, [])
+                new_files[file_path][kind] = [writer.count, len(docs)]
+                for doc in docs:
+                    writer.add(doc)
+        finally:
+            writer.close()
+        summary[kind] = writer.count
+        blobs[kind] = writer.blob_stats()
+    # the new store.json is the commit, until it is written the store is the old one
+    _write_store_file(store_dir, {
+        "path": path,
+        "params": params,
+        "small_texts": summary["small_texts"],
+        "large_texts": summary["large_texts"],
+        "created": store["created"],
+        "updated": time.time(),
+        "generation": generation,
+        "blobs": blobs,
+        "files": new_files,
+    })
+    for kind in KINDS:
+        # open ChunkLists keep reading the old index through their mapping
+        _remove_stale_indexes(os.path.join(store_dir, kind), _index_name(generation))
+    total = sum(blob["text_bytes"] + blob["meta_bytes"] for blob in blobs.values())
+    dead = total - sum(blob["live_bytes"] for blob in blobs.values())
+    if total and dead > CHUNK_STORE_COMPACT_RATIO * total:
+        _write_store(path, params, load_chunks(path), new_files, {file_path: dict(entry) for file_path, entry in new_files.items()}, list(new_files), [], None, summary, check_cancelled)
+        summary["compacted"] = True
+    return summary
+
+
+def _remove_stale_indexes(kind_dir, index_name):
+    for name in os.listdir(kind_dir):
+        if name.startswith("index") and name != index_name:
+            os.remove(os.path.join(kind_dir, name))
+
+
+def _write_store(path, params, old_chunks, files, new_files, kept, parsed, new_chunks, summary, check_cancelled):
+    # writes the whole store into a temporary folder and swaps it in: the kept files' chunks copied byte for
+    # byte from old_chunks, then the parsed files' new chunks. A cancelled write removes the temporary folder.
+    store_dir = chunk_store_dir(path)
+    tmp_dir = f"{store_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    blobs = {}
+    try:
+        for kind in KINDS:
+            writer = _ChunkWriter(os.path.join(tmp_dir, kind), _index_name(0))
+            try:
+                for file_path in kept:
+                    check_cancelled()
+                    start, count = files[file_path][kind]
+                    new_files[file_path][kind] = [writer.count, count]
+                    writer.copy(old_chunks[kind], start, count)
+                for file_path in parsed:
+                    check_cancelled()
+                    docs = new_chunks[kind].get(file_path, [])
+                    new_files[file_path][kind] = [writer.count, len(docs)]
+                    for doc in docs:
+                        writer.add(doc)
+            finally:
+                writer.close()
+            summary[kind] = writer.count
+            blobs[kind] = writer.blob_stats()
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    now = time.time()
+    _write_store_file(tmp_dir, {
+        "path": path,
+        "params": params,
+        "small_texts": summary["small_texts"],
+        "large_texts": summary["large_texts"],
+        "created": now,
+        "updated": now,
+        "generation": 0,
+        "blobs": blobs,
+        "files": new_files,
+    })
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+
+
+def _write_store_file(store_dir, store):
+    tmp_path = os.path.join(store_dir, f"{STORE_FILE}.tmp")
+    with open(tmp_path, "w") as _file:
+        json.dump(store, _file)
+    os.replace(tmp_path, os.path.join(store_dir, STORE_FILE))
+
+
+def load_chunks(path):
+    """
+    Returns:
+    - dict: small_texts and large_texts as ChunkLists and the params they were made with, None if the
+      folder has no chunk store.
+    """
+    store_dir = chunk_store_dir(path)
+    store = _read_store(path)
+    if store is None:
+        return None
+    index_name = _index_name(store.get("generation"))
+    return {
+        "small_texts": ChunkList(os.path.join(store_dir, "small_texts"), index_name=index_name),
+        "large_texts": ChunkList(os.path.join(store_dir, "large_texts"), grouped=True, index_name=index_name),
+        "params": store["params"],
+    }
+
+
+def list_chunk_stores():
+    # the summary (path, params, chunk counts, creation and update time, generation) of every stored folder
+    stores = []
+    if not os.path.isdir(CHUNK_STORE_DIRECTORY):
+        return stores
+    for name in sorted(os.listdir(CHUNK_STORE_DIRECTORY)):
+        try:
+            with open(os.path.join(CHUNK_STORE_DIRECTORY, name, STORE_FILE)) as _file:
+                store = json.load(_file)
+        except (OSError, ValueError):
+            continue
+        store.pop("files", None)
+        store.pop("blobs", None)
+        stores.append(store)
+    return stores
+
+
+def purge_chunks(path=None):
+    """
+    Delete the chunk store of a folder, or of every folder when path is None. Lists already open keep
+    reading their mapped files until they are dropped.
+
+    Returns:
+    - list: The purged folder paths.
+    """
+    stores = list_chunk_stores()
+    if path is not None:
+        stores = [store for store in stores if store["path"] == path]
+    for store in stores:
+        shutil.rmtree(chunk_store_dir(store["path"]), ignore_errors=True)
+    if path is None:
+        shutil.rmtree(CHUNK_STORE_DIRECTORY, ignore_errors=True)
+    return [store["path"] for store in stores]
@@ -1,16 +1,13 @@
 import os
 
 # from dotenv import load_dotenv
-from chromadb.config import Settings
-
-# https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/excel.html?highlight=xlsx#microsoft-excel
-from langchain.document_loaders import CSVLoader, PDFMinerLoader, TextLoader, UnstructuredExcelLoader, Docx2txtLoader
-from langchain.document_loaders import UnstructuredFileLoader, UnstructuredMarkdownLoader
 
 
 PERSONA =os.environ.get("PERSONA","none")
 NUMBER_OF_CLUSTERS=os.environ.get('NUMBER_OF_CLUSTERS',100)
 CLUSTER_SAMPLES=os.environ.get('CLUSTER_SAMPLES', 8)
+# corpora with more chunks than this are clustered with MiniBatchKMeans instead of full KMeans
+MINIBATCH_KMEANS_THRESHOLD=int(os.environ.get('MINIBATCH_KMEANS_THRESHOLD', 10000))
 #QUESTION_DIRECTORY = os.environ.get('QUESTION_DIRECTORY', '/var/log/thoth-ke')
 # load_dotenv()
 ROOT_DIRECTORY = f"{os.path.dirname(os.path.realpath(__file__))}/workspace"
@@ -21,20 +18,90 @@ SOURCE_DIRECTORY = f"{ROOT_DIRECTORY}/SOURCE_DOCUMENTS"
 
 PERSIST_DIRECTORY = f"{ROOT_DIRECTORY}/DB"
 
+# Processed folders' chunks, a memory-mapped store per folder (see chunk_store)
+CHUNK_STORE_DIRECTORY = f"{ROOT_DIRECTORY}/chunks"
+# Updates append to a store, it is rewritten with only its live chunks once this share of its bytes is dead
+CHUNK_STORE_COMPACT_RATIO = float(os.environ.get('CHUNK_STORE_COMPACT_RATIO', 0.5))
+
 MODELS_PATH = f"{ROOT_DIRECTORY}/models"
 
 # Can be changed to a specific number
 INGEST_THREADS = os.cpu_count() or 8
 
-# Define the Chroma settings
-CHROMA_SETTINGS = Settings(
+# Number of sequences the inference scheduler decodes together, each batch slot holds its own llama context
+MAX_BATCH_SLOTS = int(os.environ.get('MAX_BATCH_SLOTS', 4))
+
+# Byte budget of the prompt-prefix KV state cache, and the shortest prefix worth restoring from it
+PREFIX_CACHE_BYTES = int(os.environ.get('PREFIX_CACHE_BYTES', 2 * 1024**3))
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get('PREFIX_CACHE_MIN_TOKENS', 32))
+
+# Cache of deterministic (temperature 0) completions, in-memory entries and the on-disk tier under the workspace
+COMPLETION_CACHE_ENTRIES = int(os.environ.get('COMPLETION_CACHE_ENTRIES', 1024))
+COMPLETION_CACHE_DIR = f"{ROOT_DIRECTORY}/completion_cache"
+
+# Background job api - concurrent jobs, max jobs waiting and seconds a finished job's result is kept
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 64))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))
+
+# /embed micro-batching - most texts per forward pass and how long a batch waits to fill (milliseconds)
+EMBED_MAX_BATCH = int(os.environ.get('EMBED_MAX_BATCH', 64))
+EMBED_BATCH_WINDOW_MS = float(os.environ.get('EMBED_BATCH_WINDOW_MS', 10))
+
+# Content-addressed embedding cache, one memmapped vector store per embedding model under the workspace
+EMBEDDING_CACHE_DIR = f"{ROOT_DIRECTORY}/embedding_cache"
+# float32 or float16, the dtype new embedding stores are written in (an existing store keeps its own)
+EMBEDDING_STORE_DTYPE = os.environ.get('EMBEDDING_STORE_DTYPE', 'float32')
+
+# Retrieval on quantized vectors - none (plain vector store search), float16 or int8. The best RESCORE_FACTOR * k
+# candidates are reranked on their full precision vectors.
+VECTOR_QUANTIZATION = os.environ.get('VECTOR_QUANTIZATION', 'none')
+RESCORE_FACTOR = int(os.environ.get('RESCORE_FACTOR', 4))
+# most results (and mmr candidates) /search returns per query
+SEARCH_MAX_K = int(os.environ.get('SEARCH_MAX_K', 100))
+
+# Retrieval mode of the rag path and /search - vector, lexical (BM25) or hybrid (both, fused by reciprocal
+# rank with constant RRF_K). The BM25 index is built when a folder is processed.
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'vector')
+RRF_K = int(os.environ.get('RRF_K', 60))
+BM25_K1 = float(os.environ.get('BM25_K1', 1.5))
+BM25_B = float(os.environ.get('BM25_B', 0.75))
+
+# chunks embedded and upserted per vector store call when a collection is built or refreshed, see ai_calls.get_doc_vectordb
+REFRESH_BATCH_SIZE = int(os.environ.get('REFRESH_BATCH_SIZE', 5000))
+
+# Byte budgets of the open vector dbs and of the processed (chunked) folders kept in memory, the least
+# recently used ones are dropped past the budget and reopened from disk when next used
+VECTOR_DB_CACHE_BYTES = int(os.environ.get('VECTOR_DB_CACHE_BYTES', 4 * 1024**3))
+PROCESSED_DOCS_CACHE_BYTES = int(os.environ.get('PROCESSED_DOCS_CACHE_BYTES', 2 * 1024**3))
+
+# Semantic cache of /call_rag answers - a question within SEMANTIC_CACHE_THRESHOLD cosine similarity of an
+# earlier one to the same collection and template gets its answer. Answers are kept SEMANTIC_CACHE_TTL
+# seconds (0 for no expiry), SEMANTIC_CACHE_ENTRIES per collection and template.
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.95))
+SEMANTIC_CACHE_TTL = float(os.environ.get('SEMANTIC_CACHE_TTL', 3600))
+SEMANTIC_CACHE_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_ENTRIES', 512))
+
+# Vector db backend - chroma, or ivf (vector_store.IVFStore, an in-process IVF index over memory-mapped
+# vectors). IVF_MIN_TRAIN rows before queries stop scanning every vector, IVF_NPROBE lists scanned per query,
+# lists retrained once the store grew IVF_RETRAIN_GROWTH times.
+VECTOR_STORE = os.environ.get('VECTOR_STORE', 'chroma')
+IVF_MIN_TRAIN = int(os.environ.get('IVF_MIN_TRAIN', 10000))
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', 16))
+IVF_RETRAIN_GROWTH = float(os.environ.get('IVF_RETRAIN_GROWTH', 2.0))
+
+# Define the Chroma settings, chromadb.config.Settings is built from these when the first vector db is opened
+CHROMA_SETTINGS_KWARGS = dict(
     anonymized_telemetry=False,
     is_persistent=True,
 )
 
 # Context Window and Max New Tokens
 CONTEXT_WINDOW_SIZE = 8192 #4096
-MAX_NEW_TOKENS = CONTEXT_WINDOW_SIZE  # int(CONTEXT_WINDOW_SIZE/4)
+# default generation limit, requests may ask for a different max_tokens
+MAX_NEW_TOKENS = int(os.environ.get('MAX_NEW_TOKENS', int(CONTEXT_WINDOW_SIZE/4)))
+# tokens kept free when packing retrieved context into a prompt, covers special tokens and tokenizer drift
+CONTEXT_TOKEN_MARGIN = 16
 
 #### If you get a "not enough space in the buffer" error, you should reduce the values below, start with half of the original values and keep halving the value until the error stops appearing
 
@@ -47,22 +114,30 @@ N_BATCH = 512
 
 
 # https://python.langchain.com/en/latest/_modules/langchain/document_loaders/excel.html#UnstructuredExcelLoader
+# loader class names in langchain.document_loaders, imported on first use
 DOCUMENT_MAP = {
-    ".txt": TextLoader,
-    ".md": UnstructuredMarkdownLoader,
-    ".py": TextLoader,
-    # ".pdf": PDFMinerLoader,
-    ".pdf": UnstructuredFileLoader,
-    ".csv": CSVLoader,
-    ".xls": UnstructuredExcelLoader,
-    ".xlsx": UnstructuredExcelLoader,
-    ".docx": Docx2txtLoader,
-    ".doc": Docx2txtLoader,
+    ".txt": "TextLoader",
+    ".md": "UnstructuredMarkdownLoader",
+    ".py": "TextLoader",
+    # ".pdf": "PDFMinerLoader",
+    ".pdf": "UnstructuredFileLoader",
+    ".csv": "CSVLoader",
+    ".xls": "UnstructuredExcelLoader",
+    ".xlsx": "UnstructuredExcelLoader",
+    ".docx": "Docx2txtLoader",
+    ".doc": "Docx2txtLoader",
 }
 
 # Default Instructor Model
 EMBEDDING_MODEL_NAME = "hkunlp/instructor-large"  # Uses 1.5 GB of VRAM (High Accuracy with lower VRAM usage)
 EMBEDDING_MODEL_PATH = f"{ROOT_DIRECTORY}/embed_models"
+# torch (HuggingFaceInstructEmbeddings) or onnx - the encoder exported once to ONNX under EMBEDDING_MODEL_PATH
+# and run on ONNX Runtime, int8 quantized unless EMBEDDING_ONNX_INT8=0. The export is checked against the
+# torch model and not used if any test embedding's cosine similarity is below EMBEDDING_ONNX_MIN_COSINE.
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+EMBEDDING_ONNX_INT8 = os.environ.get('EMBEDDING_ONNX_INT8', '1') == '1'
+EMBEDDING_ONNX_THREADS = int(os.environ.get('EMBEDDING_ONNX_THREADS', INGEST_THREADS))
+EMBEDDING_ONNX_MIN_COSINE = float(os.environ.get('EMBEDDING_ONNX_MIN_COSINE', 0.99))
 ####
 #### OTHER EMBEDDING MODEL OPTIONS
 ####
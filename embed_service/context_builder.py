@@ -0,0 +1,105 @@
+import json
+
+# chunks of the same document this many characters apart or less are joined into one passage, the gap is
+# the whitespace the splitter stripped between them
+MERGE_GAP = 2
+
+
+def _group_key(metadata):
+    # chunks can only be merged within one loaded document: the same source (and page or row)
+    return json.dumps({k: v for k, v in metadata.items() if k != "start_index"}, sort_keys=True, default=str)
+
+
+class _Passage:
+    def __init__(self, text, start, metadata, rank):
+        self.text = text
+        self.start = start
+        self.end = None if start is None else start + len(text)
+        self.metadata = metadata
+        self.rank = rank
+
+
+class ContextBuilder:
+    """
+    Builds a rag context from ranked chunks without repeating text.
+
+    Chunks split with add_start_index carry their offset in the source document (metadata start_index).
+    Chunks of the same document that overlap or touch are merged into one passage, keeping the overlap
+    once, and a chunk already covered by a passage adds nothing. Chunks without an offset (collections
+    built before offsets were stored) are only dropped when their text is already in a passage of the
+    same document.
+
+    Passages are ordered by the rank of their best chunk, the text within a passage in document order.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.n_chunks = 0
+
+    def _passages(self, doc):
+        return self.groups.get(_group_key(doc.metadata), [])
+
+    def new_text(self, doc):
+        """
+        Returns:
+        - str: The part of the chunk's text that is not in the context yet, "" for a duplicate.
+        """
+        text = doc.page_content
+        start = doc.metadata.get("start_index")
+        passages = self._passages(doc)
+        if start is None:
+            return "" if any(text in passage.text for passage in passages) else text
+        end = start + len(text)
+        covered = sorted((p.start, p.end) for p in passages if p.start is not None and p.start < end and p.end > start)
+        pieces, position = [], start
+        for span_start, span_end in covered:
+            if span_start > position:
+                pieces.append(text[position - start:span_start - start])
+            position = max(position, span_end)
+        if position < end:
+            pieces.append(text[position - start:])
+        return "".join(pieces)
+
+    def add(self, doc):
+        rank = self.n_chunks
+        self.n_chunks += 1
+        text = doc.page_content
+        start = doc.metadata.get("start_index")
+        passages = self.groups.setdefault(_group_key(doc.metadata), [])
+        if start is None:
+            if not any(text in passage.text for passage in passages):
+                passages.append(_Passage(text, None, doc.metadata, rank))
+            return
+        new = _Passage(text, start, doc.metadata, rank)
+        touching = [p for p in passages if p.start is not None and p.start <= new.end + MERGE_GAP and p.end + MERGE_GAP >= new.start]
+        if not touching:
+            passages.append(new)
+            return
+        members = sorted(touching + [new], key=lambda p: p.start)
+        pieces, end = [members[0].text], members[0].end
+        for member in members[1:]:
+            if member.end <= end:
+                continue
+            if member.start > end:
+                pieces.append("\n")
+                pieces.append(member.text)
+            else:
+                pieces.append(member.text[end - member.start:])
+            end = member.end
+        merged = _Passage("".join(pieces), members[0].start, members[0].metadata, min(p.rank for p in members))
+        # offsets past a filled gap are approximate, only the start and end are used for further merges
+        merged.end = end
+        self.groups[_group_key(doc.metadata)] = [p for p in passages if p not in touching] + [merged]
+
+    def passages(self):
+        return sorted((p for group in self.groups.values() for p in group), key=lambda p: p.rank)
+
+    def build(self):
+        """
+        Returns:
+        - tuple: (context, metadata_string) - the passages one per line, and "i: metadata" of every passage.
+        """
+        passages = self.passages()
+        context = "".join(f"{passage.text.strip()}\n" for passage in passages)
+        metadata_string = "".join(f"{i}: {passage.metadata}\n" for i, passage in enumerate(passages))
+        return context, metadata_string
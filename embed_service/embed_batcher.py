@@ -0,0 +1,115 @@
+import time
+import queue
+import logging
+import threading
+
+import numpy as np
+
+from constants import EMBED_MAX_BATCH, EMBED_BATCH_WINDOW_MS
+
+
+class _EmbedRequest:
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbedBatcher:
+    """
+    Collects concurrent embedding requests into batches for the Instructor model.
+
+    A batch is closed when it holds max_batch texts or max_wait_ms after its first request arrived,
+    whichever comes first, and is run as one forward pass. Requests bigger than max_batch are run on
+    their own.
+
+    Parameters:
+    - get_embeddings: Returns the HuggingFaceInstructEmbeddings instance (called per batch, so it can be loading).
+    - max_batch (int): Most texts in one forward pass.
+    - max_wait_ms (float): How long the first request of a batch waits for company.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+
+    def __init__(self, get_embeddings, max_batch=EMBED_MAX_BATCH, max_wait_ms=EMBED_BATCH_WINDOW_MS, logging=logging):
+        self.get_embeddings = get_embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.logging = logging
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.texts = 0
+        threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def instruction_for(self, instruction):
+        # "document" (default) and "query" use the model's own instructions, anything else is used as given
+        embeddings = self.get_embeddings()
+        if instruction in (None, "document"):
+            return embeddings.embed_instruction
+        if instruction == "query":
+            return embeddings.query_instruction
+        return instruction
+
+    def embed(self, texts, instruction=None):
+        """
+        Embed texts, waiting for the batch they are put in.
+
+        Returns:
+        - numpy.ndarray: float32 array of shape (len(texts), dim).
+        """
+        instruction = self.instruction_for(instruction)
+        request = _EmbedRequest([[instruction, text] for text in texts])
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else None,
+            "queued": self.pending.qsize(),
+        }
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        size = len(batch[0].pairs)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.pairs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            pairs = [pair for request in batch for pair in request.pairs]
+            try:
+                embeddings = self.get_embeddings()
+                if hasattr(embeddings, "encode_pairs"):
+                    # CachedEmbeddings only runs the texts it has not seen through the model
+                    vectors = embeddings.encode_pairs(pairs)
+                else:
+                    encode_kwargs = {"batch_size": self.max_batch, **getattr(embeddings, "encode_kwargs", {})}
+                    vectors = np.asarray(embeddings.client.encode(pairs, **encode_kwargs), dtype=np.float32)
+                self.batches += 1
+                self.texts += len(pairs)
+                start = 0
+                for request in batch:
+                    request.vectors = vectors[start:start + len(request.pairs)]
+                    start += len(request.pairs)
+            except Exception as e:
+                self.logging.error(e)
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from constants import EMBEDDING_CACHE_DIR, EMBEDDING_STORE_DTYPE
+
+DIGEST_SIZE = 16
+
+
+def text_digest(instruction, text):
+    # the content address of one embedding, the model is part of the store path
+    return hashlib.sha256(f"{instruction}\0{text}".encode("utf-8")).digest()[:DIGEST_SIZE]
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk embedding store: a raw float32 (or float16, half the disk and page cache) vector
+    file read through np.memmap and a key file holding the digest of every row, in row order.
+
+    Rows are only ever appended, vectors first and keys second, so a crash mid-write leaves at most a
+    tail of vectors without keys, which is truncated away on the next open.
+
+    Parameters:
+    - path (str): Folder of the store, one per embedding model.
+    - dtype (str): float32 or float16, only used when the store is created.
+    """
+
+    def __init__(self, path, dtype=EMBEDDING_STORE_DTYPE, logging=logging):
+        self.path = path
+        self.logging = logging
+        self.vectors_path = os.path.join(path, "vectors.bin")
+        self.keys_path = os.path.join(path, "keys.bin")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.index = {}
+        self.dim = None
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with open(self.meta_path) as _file:
+            meta = json.load(_file)
+        self.dim = meta["dim"]
+        # stores written before the dtype was configurable are float32, in vectors.f32
+        self.dtype = np.dtype(meta.get("dtype", "float32"))
+        legacy_path = os.path.join(self.path, "vectors.f32")
+        if not os.path.exists(self.vectors_path) and os.path.exists(legacy_path):
+            self.logging.info(f"embedding store {self.path} - renaming vectors.f32 to vectors.bin")
+            os.replace(legacy_path, self.vectors_path)
+            with open(self.meta_path, "w") as _file:
+                json.dump({"dim": self.dim, "dtype": self.dtype.name}, _file)
+        keys = b""
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "rb") as _file:
+                keys = _file.read()
+        row_bytes = self.dim * self.dtype.itemsize
+        vector_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        self.rows = min(len(keys) // DIGEST_SIZE, vector_rows)
+        # cut the tail a crash left behind (vectors without keys, a partial row), later appends must start
+        # exactly at row self.rows in both files
+        for file_path, size in ((self.vectors_path, self.rows * row_bytes), (self.keys_path, self.rows * DIGEST_SIZE)):
+            if os.path.exists(file_path) and os.path.getsize(file_path) > size:
+                self.logging.warning(f"embedding store {self.path} - truncating {file_path} to {self.rows} rows")
+                os.truncate(file_path, size)
+        for row in range(self.rows):
+            self.index[keys[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE]] = row
+        self.logging.info(f"embedding store {self.path} opened with {self.rows} vectors")
+
+    def _vectors(self):
+        if self._mmap is None or self._mmap.shape[0] != self.rows:
+            self._mmap = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        return self._mmap
+
+    def lookup(self, digests):
+        # row per digest, -1 for digests that are not stored
+        return np.array([self.index.get(digest, -1) for digest in digests], dtype=np.int64)
+
+    def take(self, rows):
+        with self._lock:
+            return np.array(self._vectors()[rows], dtype=np.float32)
+
+    def add(self, digests, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+        with self._lock:
+            new = [i for i, digest in enumerate(digests) if digest not in self.index]
+            if not new:
+                return
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w") as _file:
+                    json.dump({"dim": self.dim, "dtype": self.dtype.name}, _file)
+            with open(self.vectors_path, "ab") as _file:
+                _file.write(vectors[new].tobytes())
+            with open(self.keys_path, "ab") as _file:
+                _file.write(b"".join(digests[i] for i in new))
+            for i in new:
+                self.index[digests[i]] = self.rows
+                self.rows += 1
+
+    def size_bytes(self):
+        return self.rows * (self.dim or 0) * self.dtype.itemsize
+
+
+class CachedEmbeddings:
+    """
+    Wraps HuggingFaceInstructEmbeddings so every embedding goes through a persistent, content-addressed
+    cache keyed on (embedding model, instruction, text hash).
+
+    It keeps the langchain embeddings interface (embed_documents / embed_query) so it can be handed to
+    Chroma, and adds encode / encode_pairs returning numpy arrays for the clustering and /embed paths.
+    Only texts that are not cached yet go through the model, in one forward pass. Attributes it does not
+    define (client, embed_instruction, query_instruction, ...) come from the wrapped embeddings.
+
+    Parameters:
+    - embeddings (HuggingFaceInstructEmbeddings): The model to wrap.
+    - model_name (str): The embedding model name, selects the store folder.
+    - cache_dir (str): Root folder of the stores.
+    """
+
+    def __init__(self, embeddings, model_name, cache_dir=EMBEDDING_CACHE_DIR, logging=logging):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store = EmbeddingStore(os.path.join(cache_dir, model_name.replace("/", "__")), logging=logging)
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.embeddings, name)
+
+    def _forward(self, pairs):
+        encode_kwargs = getattr(self.embeddings, "encode_kwargs", {}) or {}
+        return np.asarray(self.embeddings.client.encode(pairs, **encode_kwargs), dtype=np.float32)
+
+    def encode_pairs(self, pairs):
+        """
+        Embed [instruction, text] pairs.
+
+        Returns:
+        - numpy.ndarray: float32 array of shape (len(pairs), dim).
+        """
+        if not pairs:
+            return np.zeros((0, self.store.dim or 0), dtype=np.float32)
+        digests = [text_digest(instruction, text) for instruction, text in pairs]
+        rows = self.store.lookup(digests)
+        missing = np.flatnonzero(rows < 0)
+        self.hits += len(pairs) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            # duplicates inside one call are only embedded once
+            first = {}
+            for i in missing:
+                first.setdefault(digests[i], i)
+            unique = list(first.values())
+            self.store.add([digests[i] for i in unique], self._forward([pairs[i] for i in unique]))
+            rows = self.store.lookup(digests)
+        return self.store.take(rows)
+
+    def encode(self, texts, instruction=None):
+        instruction = self.embeddings.embed_instruction if instruction is None else instruction
+        return self.encode_pairs([[instruction, text] for text in texts])
+
+    def embed_documents(self, texts):
+        return self.encode(texts, self.embeddings.embed_instruction).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text], self.embeddings.query_instruction)[0].tolist()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "vectors": self.store.rows,
+            "bytes": self.store.size_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
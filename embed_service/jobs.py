@@ -0,0 +1,133 @@
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RESULT_TTL
+
+_current = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def check_cancelled():
+    # called by long running tasks between units of work, raises if the job running on this thread was cancelled
+    job = getattr(_current, "job", None)
+    if job is not None and job.cancel_requested:
+        raise JobCancelled(f"job {job.id} cancelled")
+
+
+class Job:
+    def __init__(self, kind, payload):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.error_type = None
+        self.cancel_requested = False
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error,
+            "error_type": self.error_type,
+        }
+
+
+class JobManager:
+    """
+    Runs long requests (rag, ingestion, vector db builds) in a bounded worker pool.
+
+    Clients submit a job, poll it by id and may cancel it. Queued jobs are dropped right away, running
+    jobs stop at the next check_cancelled() call. Finished jobs are kept for ttl seconds.
+
+    Parameters:
+    - tasks (dict): Maps a job kind to a function taking the json payload and returning the result message.
+    - max_workers (int): Number of jobs run at the same time.
+    - max_queued (int): Submissions are refused once this many jobs are waiting.
+    - ttl (int): Seconds a finished job's result is kept.
+    """
+
+    def __init__(self, tasks, max_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE, ttl=JOB_RESULT_TTL, logging=logging):
+        self.tasks = tasks
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.logging = logging
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+
+    def submit(self, kind, payload):
+        if kind not in self.tasks:
+            raise ValueError(f"unknown job kind '{kind}', expected one of {sorted(self.tasks)}")
+        self._purge_expired()
+        with self._lock:
+            queued = sum(1 for job in self.jobs.values() if job.state == "queued")
+            if queued >= self.max_queued:
+                raise RuntimeError(f"job queue is full ({queued} jobs waiting), retry later")
+            job = Job(kind, payload)
+            self.jobs[job.id] = job
+        job.future = self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        self._purge_expired()
+        return self.jobs.get(job_id)
+
+    def list(self):
+        self._purge_expired()
+        return [job.to_dict() for job in list(self.jobs.values())]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested = True
+        if job.future is not None and job.future.cancel():
+            self._finish(job, "cancelled")
+        return job
+
+    def _run(self, job):
+        if job.cancel_requested:
+            return self._finish(job, "cancelled")
+        job.state = "running"
+        job.started_at = time.time()
+        _current.job = job
+        try:
+            job.result = self.tasks[job.kind](job.payload)
+            self._finish(job, "succeeded")
+        except JobCancelled:
+            self._finish(job, "cancelled")
+        except Exception as e:
+            self.logging.error(f"job {job.id} ({job.kind}) failed - {type(e).__name__}: {e}")
+            job.error_type = type(e).__name__
+            # an exception without a message still says what went wrong
+            job.error = str(e) or repr(e)
+            self._finish(job, "failed")
+        finally:
+            _current.job = None
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for job_id in [i for i, job in self.jobs.items() if job.finished_at and now - job.finished_at > self.ttl]:
+                del self.jobs[job_id]
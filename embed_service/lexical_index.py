@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import math
+import shutil
+
+import numpy as np
+
+from constants import PERSIST_DIRECTORY, BM25_K1, BM25_B
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def lexical_index_dir(path):
+    # next to the Chroma collections, keyed by the source folder the chunks came from
+    return os.path.join(PERSIST_DIRECTORY, "lexical", path.strip("/").replace("/", "__") or "root")
+
+
+class BM25Index:
+    """
+    Compact BM25 inverted index over text chunks.
+
+    Postings are kept in CSR form: term t's chunks are postings_docs[term_offsets[t]:term_offsets[t + 1]]
+    with matching term frequencies in postings_tf. Saved as .npy files that are memory-mapped on load, plus
+    the vocabulary and chunk ids as json.
+
+    Parameters:
+    - chunk_ids (list): Id of every chunk, the ids the Chroma collection uses (see index_manifest.chunk_id).
+    - vocabulary (dict): term -> term number.
+    - term_offsets, postings_docs, postings_tf, doc_lengths (numpy.ndarray): The index arrays.
+    """
+
+    ARRAYS = ("term_offsets", "postings_docs", "postings_tf", "doc_lengths")
+
+    def __init__(self, chunk_ids, vocabulary, term_offsets, postings_docs, postings_tf, doc_lengths, k1=BM25_K1, b=BM25_B):
+        self.chunk_ids = chunk_ids
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.postings_docs = postings_docs
+        self.postings_tf = postings_tf
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, chunk_ids, texts):
+        postings = {}
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            counts = {}
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+            doc_lengths[doc] = sum(counts.values())
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc, count))
+        vocabulary = {}
+        term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        docs, tfs = [], []
+        for term, (token, token_postings) in enumerate(sorted(postings.items())):
+            vocabulary[token] = term
+            term_offsets[term + 1] = term_offsets[term] + len(token_postings)
+            docs.extend(doc for doc, _ in token_postings)
+            tfs.extend(min(count, 65535) for _, count in token_postings)
+        return cls(
+            list(chunk_ids),
+            vocabulary,
+            term_offsets,
+            np.asarray(docs, dtype=np.int32),
+            np.asarray(tfs, dtype=np.uint16),
+            doc_lengths,
+        )
+
+    def save(self, index_dir):
+        tmp_dir = f"{index_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "index.json"), "w") as _file:
+            json.dump({"chunk_ids": self.chunk_ids, "vocabulary": self.vocabulary}, _file)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "index.json")) as _file:
+            meta = json.load(_file)
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in cls.ARRAYS}
+        return cls(meta["chunk_ids"], meta["vocabulary"], **arrays)
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def scores(self, query):
+        # BM25 score of every chunk for a query, chunks without a query term score 0
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        n_docs = len(self.chunk_ids)
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end].astype(np.float32)
+            idf = math.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[docs] / max(self.avg_length, 1e-9))
+            scores[docs] += idf * tf * (self.k1 + 1.0) / (tf + norm)
+        return scores
+
+    def search(self, query, k):
+        """
+        Returns:
+        - list: (chunk_id, bm25 score) of the best k chunks with a score above 0, best first.
+        """
+        scores = self.scores(query)
+        k = min(k, int((scores > 0).sum()))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.chunk_ids[i], float(scores[i])) for i in best]
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=60):
+    """
+    Fuse ranked id lists, an id scores sum(1 / (rrf_k + rank)) over the lists it appears in (rank from 1).
+
+    Returns:
+    - list: (id, fused score), best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda pair: -pair[1])
@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from constants import (
+    EMBEDDING_MODEL_NAME,
+    EMBEDDING_MODEL_PATH,
+    EMBEDDING_ONNX_INT8,
+    EMBEDDING_ONNX_THREADS,
+    EMBEDDING_ONNX_MIN_COSINE,
+)
+
+# texts the export is checked on, documents and questions so both instructions are covered
+VERIFY_TEXTS = [
+    "The quarterly report shows revenue grew by twelve percent while operating costs stayed flat.",
+    "Install the package with pip and set the DEVICE environment variable before starting the service.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "def add(a, b):\n    return a + b",
+    "What were the main causes of the revenue growth?",
+    "How do I configure the device the model runs on?",
+    "短い日本語の文章も埋め込みに使えます。",
+    "x",
+]
+
+
+def _encoder_only(auto_model):
+    # wraps the T5 encoder so the export has a single tensor output
+    import torch
+
+    class EncoderOnly(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+    return EncoderOnly()
+
+
+def export_paths(model_name, cache_folder):
+    export_dir = os.path.join(cache_folder, "onnx", model_name.replace("/", "__"))
+    return {
+        "dir": export_dir,
+        "fp32": os.path.join(export_dir, "encoder.onnx"),
+        "int8": os.path.join(export_dir, "encoder.int8.onnx"),
+        "meta": os.path.join(export_dir, "export.json"),
+    }
+
+
+def export_encoder(model, paths, quantize, logging=logging):
+    """
+    Export the transformer of an INSTRUCTOR model to ONNX, and its int8 dynamically quantized copy.
+    Pooling, the dense layer and normalization stay in the sentence-transformers model.
+    """
+    import torch
+
+    os.makedirs(paths["dir"], exist_ok=True)
+    if not os.path.exists(paths["fp32"]):
+        started = time.time()
+        features = model.tokenize([["Represent the document for retrieval: ", "export sample"]])
+        torch.onnx.export(
+            _encoder_only(model[0].auto_model.eval()),
+            (features["input_ids"], features["attention_mask"]),
+            paths["fp32"],
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_embeddings": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14,
+        )
+        logging.info(f"exported {paths['fp32']} in {time.time() - started:.1f}s")
+    if quantize and not os.path.exists(paths["int8"]):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantize_dynamic(paths["fp32"], paths["int8"], weight_type=QuantType.QInt8)
+        logging.info(f"quantized {paths['int8']}")
+
+
+class OnnxInstructor:
+    """
+    Drop-in for the INSTRUCTOR client of HuggingFaceInstructEmbeddings with the transformer run on ONNX Runtime.
+
+    Tokenization, the instruction-excluding mean pooling, the dense layer and normalization are the
+    INSTRUCTOR model's own modules, only the encoder forward pass (nearly all of the compute) is replaced.
+    The torch encoder weights are dropped once the session is open.
+
+    Parameters:
+    - model (INSTRUCTOR): The sentence-transformers model, its encoder is released.
+    - onnx_path (str): The exported encoder.
+    - n_threads (int): ONNX Runtime intra-op threads.
+    """
+
+    def __init__(self, model, onnx_path, n_threads=EMBEDDING_ONNX_THREADS):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = n_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.onnx_path = onnx_path
+        self.model = model
+        self.head = list(model)[1:]
+        model[0].auto_model = None
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        # sentences are [instruction, text] pairs, as passed by HuggingFaceInstructEmbeddings
+        import torch
+
+        if not sentences:
+            return np.zeros((0, 0), dtype=np.float32)
+        # similar lengths are batched together so little time goes into padding
+        order = np.argsort([-len(text) for _, text in sentences], kind="stable")
+        vectors = [None] * len(sentences)
+        with torch.no_grad():
+            for start in range(0, len(sentences), batch_size):
+                rows = order[start:start + batch_size]
+                features = self.model.tokenize([sentences[i] for i in rows])
+                token_embeddings = self.session.run(None, {
+                    "input_ids": features["input_ids"].numpy().astype(np.int64),
+                    "attention_mask": features["attention_mask"].numpy().astype(np.int64),
+                })[0]
+                features["token_embeddings"] = torch.from_numpy(token_embeddings)
+                context_masks = features.get("context_masks")
+                if context_masks is not None:
+                    # as INSTRUCTOR_Transformer.forward, the instruction tokens are attended to but left out of the pooling
+                    features["attention_mask"] = features["attention_mask"].clone()
+                    for i, context_mask in enumerate(context_masks):
+                        features["attention_mask"][i][:int(context_mask)] = 0
+                for module in self.head:
+                    features = module(features)
+                for i, vector in zip(rows, features["sentence_embedding"].numpy()):
+                    vectors[i] = vector
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class OnnxInstructEmbeddings:
+    """
+    The embed_documents / embed_query interface of HuggingFaceInstructEmbeddings over an OnnxInstructor.
+
+    Parameters:
+    - client (OnnxInstructor): The ONNX backed model.
+    - model_name (str): Names the backend in the embedding cache, its vectors are not mixed with torch ones.
+    """
+
+    def __init__(self, client, model_name, embed_instruction=None, query_instruction=None, encode_kwargs=None):
+        from langchain.embeddings.huggingface import DEFAULT_EMBED_INSTRUCTION, DEFAULT_QUERY_INSTRUCTION
+
+        self.client = client
+        self.model_name = model_name
+        self.embed_instruction = embed_instruction or DEFAULT_EMBED_INSTRUCTION
+        self.query_instruction = query_instruction or DEFAULT_QUERY_INSTRUCTION
+        self.encode_kwargs = encode_kwargs or {}
+
+    def embed_documents(self, texts):
+        return self.client.encode([[self.embed_instruction, text] for text in texts], **self.encode_kwargs).tolist()
+
+    def embed_query(self, text):
+        return self.client.encode([[self.query_instruction, text]], **self.encode_kwargs)[0].tolist()
+
+
+def cosine_report(reference, candidate):
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    cosine = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1) + 1e-12
+    )
+    return {"min_cosine": round(float(cosine.min()), 6), "mean_cosine": round(float(cosine.mean()), 6)}
+
+
+def verify(torch_model, onnx_client, texts=VERIFY_TEXTS, min_cosine=EMBEDDING_ONNX_MIN_COSINE):
+    """
+    Compare ONNX and PyTorch embeddings of the same [instruction, text] pairs.
+
+    Returns:
+    - dict: min_cosine, mean_cosine and passed (min_cosine >= min_cosine).
+    """
+    from langchain.embeddings.huggingface import DEFAULT_EMBED_INSTRUCTION, DEFAULT_QUERY_INSTRUCTION
+
+    pairs = [[DEFAULT_EMBED_INSTRUCTION, text] for text in texts] + [[DEFAULT_QUERY_INSTRUCTION, text] for text in texts]
+    report = cosine_report(torch_model.encode(pairs), onnx_client.encode(pairs))
+    report["threshold"] = min_cosine
+    report["passed"] = report["min_cosine"] >= min_cosine
+    return report
+
+
+def load_onnx_embeddings(model_name=EMBEDDING_MODEL_NAME, cache_folder=EMBEDDING_MODEL_PATH, quantize=EMBEDDING_ONNX_INT8,
+                         n_threads=EMBEDDING_ONNX_THREADS, logging=logging):
+    """
+    Load the ONNX embedding backend, exporting (and quantizing) the encoder on first use.
+
+    A fresh export is verified against the PyTorch model before it is used and the result is kept next to
+    the export, so later starts skip the check. An export that failed the check raises, the caller falls
+    back to PyTorch.
+
+    Returns:
+    - OnnxInstructEmbeddings: The embeddings, or raises RuntimeError if the export is out of tolerance.
+    """
+    from InstructorEmbedding import INSTRUCTOR
+
+    paths = export_paths(model_name, cache_folder)
+    model = INSTRUCTOR(model_name, cache_folder=cache_folder, device="cpu")
+    onnx_path = paths["int8"] if quantize else paths["fp32"]
+    meta = {}
+    if os.path.exists(paths["meta"]):
+        with open(paths["meta"]) as _file:
+            meta = json.load(_file)
+    report = meta.get(os.path.basename(onnx_path))
+    if report is None:
+        export_encoder(model, paths, quantize, logging)
+        # the session drops the torch encoder of the model it gets, the check runs on the original
+        import copy
+
+        onnx_client = OnnxInstructor(copy.deepcopy(model), onnx_path, n_threads)
+        report = verify(model, onnx_client)
+        meta[os.path.basename(onnx_path)] = report
+        with open(paths["meta"], "w") as _file:
+            json.dump(meta, _file, indent=2)
+        logging.info(f"onnx embeddings {onnx_path} vs torch - {report}")
+        del model
+    else:
+        onnx_client = OnnxInstructor(model, onnx_path, n_threads)
+    if not report["passed"]:
+        raise RuntimeError(f"onnx export {onnx_path} is out of tolerance - {report}")
+    return OnnxInstructEmbeddings(onnx_client, f"{model_name}-onnx{'-int8' if quantize else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX and check it against PyTorch")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--cache-folder", default=EMBEDDING_MODEL_PATH)
+    parser.add_argument("--fp32", action="store_true", help="skip int8 quantization")
+    parser.add_argument("--threads", type=int, default=EMBEDDING_ONNX_THREADS)
+    parser.add_argument("--texts", help="file with one test text per line, defaults to a built-in sample")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    from InstructorEmbedding import INSTRUCTOR
+
+    texts = VERIFY_TEXTS
+    if args.texts:
+        with open(args.texts) as _file:
+            texts = [line.strip() for line in _file if line.strip()]
+    paths = export_paths(args.model, args.cache_folder)
+    torch_model = INSTRUCTOR(args.model, cache_folder=args.cache_folder, device="cpu")
+    export_encoder(torch_model, paths, not args.fp32, logging)
+    import copy
+
+    onnx_client = OnnxInstructor(copy.deepcopy(torch_model), paths["fp32"] if args.fp32 else paths["int8"], args.threads)
+    report = verify(torch_model, onnx_client, texts)
+    pairs = [["Represent the document for retrieval: ", text] for text in texts] * 8
+    for name, client in (("torch", torch_model), ("onnx", onnx_client)):
+        started = time.time()
+        client.encode(pairs)
+        report[f"{name}_texts_per_second"] = round(len(pairs) / (time.time() - started), 2)
+    print(json.dumps(report))
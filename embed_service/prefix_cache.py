@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+
+from constants import PREFIX_CACHE_BYTES, PREFIX_CACHE_MIN_TOKENS
+
+
+def _common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _state_bytes(state):
+    # the KV state plus the logits (scores) and token ids stored with it
+    return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+
+class PrefixKVCache:
+    """
+    LRU cache of llama KV states keyed by token prefix, bounded in bytes.
+
+    It follows the llama_cpp cache interface and is attached to a llama context with attach. Before a
+    completion llama looks up the longest cached prefix of the prompt tokens and restores that state, so
+    only the tokens after the shared prefix are evaluated. llama skips the restore when the context already
+    holds a longer prefix of the prompt, so a lookup only counts as a hit once the state is loaded. Templated prompts (rag and doc prompts) share
+    everything up to the first |question| or |context| placeholder, so a batch of questions pays the
+    template prefill once. The cache may be shared by several llama contexts of the same model.
+
+    Parameters:
+    - capacity_bytes (int): Upper bound on the summed size of the stored states.
+    - min_prefix_tokens (int): Shorter matches are reported as misses, restoring them costs more than it saves.
+    """
+
+    def __init__(self, capacity_bytes=PREFIX_CACHE_BYTES, min_prefix_tokens=PREFIX_CACHE_MIN_TOKENS):
+        self.capacity_bytes = capacity_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.cache_state = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.unused = 0
+        self.saved_tokens = 0
+        self.evictions = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # the state the last lookup on this thread returned and its prefix length, a slot looks up and
+        # restores on the same thread
+        self._lookup = threading.local()
+
+    @property
+    def cache_size(self):
+        return self._size
+
+    def _find_longest_prefix_key(self, key):
+        best_key, best_len = None, 0
+        for cached_key in self.cache_state:
+            prefix_len = _common_prefix_len(cached_key, key)
+            if prefix_len > best_len:
+                best_key, best_len = cached_key, prefix_len
+        if best_len < self.min_prefix_tokens:
+            return None, 0
+        return best_key, best_len
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        with self._lock:
+            best_key, best_len = self._find_longest_prefix_key(key)
+            if best_key is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+            self.cache_state.move_to_end(best_key)
+            state = self.cache_state[best_key]
+        self._settle()
+        self._lookup.pending = (state, best_len)
+        return state
+
+    def _settle(self):
+        # the previous lookup on this thread was not restored, the context already held the prefix
+        if getattr(self._lookup, "pending", None) is not None:
+            self._lookup.pending = None
+            with self._lock:
+                self.unused += 1
+
+    def _restored(self, state):
+        pending = getattr(self._lookup, "pending", None)
+        if pending is None or pending[0] is not state:
+            return
+        self._lookup.pending = None
+        with self._lock:
+            self.hits += 1
+            self.saved_tokens += pending[1]
+
+    def attach(self, llama):
+        # Llama.set_cache, with load_state wrapped so restored states are counted as hits
+        load_state = llama.load_state
+
+        def counted_load_state(state):
+            load_state(state)
+            self._restored(state)
+
+        llama.load_state = counted_load_state
+        llama.set_cache(self)
+        return self
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._find_longest_prefix_key(tuple(key))[0] is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        self._settle()
+        with self._lock:
+            if key in self.cache_state:
+                self._size -= _state_bytes(self.cache_state.pop(key))
+            self.cache_state[key] = value
+            self._size += _state_bytes(value)
+            while self._size > self.capacity_bytes and len(self.cache_state) > 1:
+                _, evicted = self.cache_state.popitem(last=False)
+                self._size -= _state_bytes(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.unused
+        return {
+            "entries": len(self.cache_state),
+            "bytes": self._size,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            # found but not restored, the context already held a longer prefix
+            "unused": self.unused,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "saved_tokens": self.saved_tokens,
+            "evictions": self.evictions,
+        }
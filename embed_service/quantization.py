@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from constants import (
+    EMBEDDING_MODEL_NAME,
+    EMBEDDING_CACHE_DIR,
+    VECTOR_QUANTIZATION,
+    RESCORE_FACTOR,
+)
+
+QUANTIZATION_MODES = ("float32", "float16", "int8")
+DOT_BLOCK_ROWS = 65536
+
+
+class QuantizedVectors:
+    """
+    A vector matrix stored as float32, float16 or scalar int8 codes with a per-dimension scale and offset.
+
+    int8 maps every dimension's [min, max] onto [-127, 127], v ~= offset + scale * code. Dot products with a
+    query are taken on the codes directly (q . offset + (q * scale) . code), the matrix is never decoded.
+
+    Parameters:
+    - vectors (numpy.ndarray): float32 array of shape (n, dim).
+    - mode (str): One of QUANTIZATION_MODES.
+    """
+
+    def __init__(self, vectors, mode="int8"):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"unknown quantization mode '{mode}', expected one of {QUANTIZATION_MODES}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.mode = mode
+        self.scale = None
+        self.offset = None
+        # squared norms stay full precision, they are needed for l2 distances and cost 4 bytes per vector
+        self.sq_norms = (vectors * vectors).sum(axis=1)
+        if mode == "float32":
+            self.codes = vectors
+        elif mode == "float16":
+            self.codes = vectors.astype(np.float16)
+        else:
+            low = vectors.min(axis=0) if len(vectors) else np.zeros(vectors.shape[1], dtype=np.float32)
+            high = vectors.max(axis=0) if len(vectors) else np.zeros(vectors.shape[1], dtype=np.float32)
+            self.scale = np.maximum((high - low) / 254.0, 1e-12).astype(np.float32)
+            self.offset = ((high + low) / 2.0).astype(np.float32)
+            self.codes = np.clip(np.rint((vectors - self.offset) / self.scale), -127, 127).astype(np.int8)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        extra = sum(a.nbytes for a in (self.scale, self.offset) if a is not None)
+        return self.codes.nbytes + self.sq_norms.nbytes + extra
+
+    def _blocked_dot(self, query):
+        # numpy has no float16 or int8 BLAS, blocks are widened to float32 so memory stays bounded
+        return np.concatenate([
+            self.codes[start:start + DOT_BLOCK_ROWS].astype(np.float32) @ query
+            for start in range(0, len(self), DOT_BLOCK_ROWS)
+        ] or [np.zeros(0, dtype=np.float32)])
+
+    def dot(self, query):
+        query = np.asarray(query, dtype=np.float32)
+        if self.mode == "float32":
+            return self.codes @ query
+        if self.mode == "int8":
+            return float(query @ self.offset) + self._blocked_dot(query * self.scale)
+        return self._blocked_dot(query)
+
+    def l2_distances(self, query):
+        # squared l2 distance, the same measure Chroma ranks by
+        query = np.asarray(query, dtype=np.float32)
+        return self.sq_norms - 2.0 * self.dot(query) + float(query @ query)
+
+
+def top_k(distances, k):
+    # indices of the k smallest distances, smallest first
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.argpartition(distances, k - 1)[:k]
+    return candidates[np.argsort(distances[candidates])]
+
+
+class QuantizedIndex:
+    """
+    Approximate nearest neighbour search on quantized vectors, rescored in full precision.
+
+    search() ranks every vector on the quantized codes, keeps the best k * rescore_factor candidates and
+    reranks those on their float32 vectors, fetched through get_full so full precision vectors do not have
+    to stay in memory.
+
+    Parameters:
+    - vectors (numpy.ndarray): float32 array of shape (n, dim).
+    - mode (str): One of QUANTIZATION_MODES.
+    - get_full: Maps an array of row numbers to their float32 vectors, defaults to keeping `vectors`.
+    - rescore_factor (int): Candidates rescored per result, 0 disables rescoring.
+    """
+
+    def __init__(self, vectors, mode=VECTOR_QUANTIZATION, get_full=None, rescore_factor=RESCORE_FACTOR):
+        self.vectors = QuantizedVectors(vectors, mode)
+        if get_full is None:
+            full = np.asarray(vectors, dtype=np.float32)
+            get_full = lambda rows: full[rows]
+        self.get_full = get_full
+        self.rescore_factor = rescore_factor
+
+    def candidates(self, query, k):
+        return top_k(self.vectors.l2_distances(query), k * max(self.rescore_factor, 1))
+
+    def rescore(self, query, rows, k, full=None):
+        # full precision l2 distances of the candidate rows, returns (rows, distances) of the best k
+        full = self.get_full(rows) if full is None else np.asarray(full, dtype=np.float32)
+        distances = ((full - np.asarray(query, dtype=np.float32)) ** 2).sum(axis=1)
+        best = top_k(distances, k)
+        return rows[best], distances[best]
+
+    def search(self, query, k):
+        rows = self.candidates(query, k)
+        if not self.rescore_factor:
+            rows = rows[:k]
+            return rows, self.vectors.l2_distances(query)[rows]
+        return self.rescore(query, rows, k)
+
+
+class QuantizedStoreRetriever:
+    """
+    Retrieves from a vector db through a QuantizedIndex of its embeddings.
+
+    Only the quantized codes and the chunk ids are kept in memory. The candidates' documents, metadata and
+    float32 embeddings are read back from the db for rescoring. Has the get_relevant_documents
+    method of a langchain retriever, so build_rag_prompt can use it unchanged.
+
+    Parameters:
+    - db (VectorStore): The vector db, see vector_store.
+    - mode (str): float16 or int8.
+    - k (int): Documents returned per query.
+    """
+
+    def __init__(self, db, mode=VECTOR_QUANTIZATION, k=4, rescore_factor=RESCORE_FACTOR):
+        self.db = db
+        self.k = k
+        stored = db.get(include=["embeddings"])
+        self.ids = np.array(stored["ids"], dtype=object)
+        vectors = np.asarray(stored["embeddings"], dtype=np.float32) if len(self.ids) else np.zeros((0, 1), dtype=np.float32)
+        self.index = QuantizedIndex(vectors, mode, get_full=self._get_full, rescore_factor=rescore_factor)
+        logging.info(f"quantized index of {db.name}: {len(self.ids)} vectors, {self.index.vectors.nbytes} bytes ({mode})")
+
+    def _get_full(self, rows):
+        stored = self.db.get(ids=list(self.ids[rows]), include=["embeddings"])
+        by_id = dict(zip(stored["ids"], stored["embeddings"]))
+        return np.asarray([by_id[i] for i in self.ids[rows]], dtype=np.float32)
+
+    def search(self, query_vector, k=None, with_embeddings=False):
+        # (documents, l2 distances, float32 embeddings or None, chunk ids) of the k nearest chunks to an embedded query
+        from langchain.docstore.document import Document
+
+        k = k or self.k
+        if not len(self.ids):
+            return [], [], None, []
+        rows, distances = self.index.search(query_vector, k)
+        include = ["documents", "metadatas"] + (["embeddings"] if with_embeddings else [])
+        stored = self.db.get(ids=list(self.ids[rows]), include=include)
+        position = {i: n for n, i in enumerate(stored["ids"])}
+        order = [position[i] for i in self.ids[rows]]
+        docs = [Document(page_content=stored["documents"][n], metadata=stored["metadatas"][n] or {}) for n in order]
+        embeddings = np.asarray([stored["embeddings"][n] for n in order], dtype=np.float32) if with_embeddings else None
+        return docs, distances.tolist(), embeddings, list(self.ids[rows])
+
+    def get_relevant_documents(self, query):
+        return self.search(self.db.embedding_function.embed_query(query))[0]
+
+
+def recall_report(vectors, queries, k=4, modes=QUANTIZATION_MODES, rescore_factor=RESCORE_FACTOR):
+    """
+    Recall@k and memory per quantization mode, against exact float32 search.
+
+    Returns:
+    - list: One dict per mode with bytes, bytes_per_vector, recall without and with rescoring and latency.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    exact = [set(top_k(((vectors - q) ** 2).sum(axis=1), k).tolist()) for q in queries]
+    report = []
+    for mode in modes:
+        index = QuantizedIndex(vectors, mode, rescore_factor=rescore_factor)
+        raw_hits = rescored_hits = 0
+        start = time.time()
+        for q, truth in zip(queries, exact):
+            raw_hits += len(truth & set(top_k(index.vectors.l2_distances(q), k).tolist()))
+            rescored_hits += len(truth & set(index.search(q, k)[0].tolist()))
+        elapsed = time.time() - start
+        report.append({
+            "mode": mode,
+            "bytes": index.vectors.nbytes,
+            "bytes_per_vector": round(index.vectors.nbytes / max(len(vectors), 1), 1),
+            f"recall@{k}": round(raw_hits / (k * len(queries)), 4),
+            f"recall@{k}_rescored": round(rescored_hits / (k * len(queries)), 4),
+            "ms_per_query": round(elapsed * 1000 / max(len(queries), 1), 3),
+        })
+    return report
+
+
+def load_benchmark_corpus(store_dir):
+    # the vectors of an embedding cache store (see embedding_cache.EmbeddingStore)
+    from embedding_cache import EmbeddingStore
+
+    store = EmbeddingStore(store_dir)
+    if not store.rows:
+        raise RuntimeError(f"no vectors in {store_dir}, embed a corpus first")
+    return store.take(np.arange(store.rows))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall vs memory of the quantized vector storage modes")
+    parser.add_argument("--store", default=os.path.join(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL_NAME.replace("/", "__")))
+    parser.add_argument("--queries", type=int, default=200, help="corpus vectors held out and used as queries")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--rescore-factor", type=int, default=RESCORE_FACTOR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    corpus = load_benchmark_corpus(args.store)
+    rng = np.random.default_rng(42)
+    held_out = rng.choice(len(corpus), size=min(args.queries, len(corpus) // 2), replace=False)
+    mask = np.ones(len(corpus), dtype=bool)
+    mask[held_out] = False
+    for row in recall_report(corpus[mask], corpus[held_out], args.k, rescore_factor=args.rescore_factor):
+        print(json.dumps(row))
@@ -0,0 +1,122 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# python object overhead of a langchain Document beyond its text and metadata, a rough per chunk estimate
+DOCUMENT_OVERHEAD = 400
+
+
+def documents_bytes(docs):
+    # approximate resident size of a list of Documents
+    return sum(len(doc.page_content) + len(str(doc.metadata)) + DOCUMENT_OVERHEAD for doc in docs)
+
+
+class ResourceCache:
+    """
+    Least recently used map of open resources (vector dbs, processed corpora) under a byte budget.
+
+    Sizes are approximate, from size_of. An entry is measured when it is added, and again when its owner
+    calls resize because it grew (a quantized index, cluster results) and on report. size_of may be slow
+    (a chroma count), it is never called under the cache lock. Adding or growing an entry that takes the
+    cache over max_bytes evicts the least recently used entries, never that one. Evicted entries are only
+    dropped, callers reopen them from disk on their next use.
+
+    Parameters:
+    - name (str): Used in logs and the report.
+    - max_bytes (int): The byte budget.
+    - size_of (callable): Approximate resident bytes of a value.
+    """
+
+    def __init__(self, name, max_bytes, size_of, logging=logging):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.logging = logging
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.last_used = {}
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self.entries[key]
+            self.entries.move_to_end(key)
+            self.last_used[key] = time.time()
+            return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self[key] if key in self.entries else default
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def _measure(self, key, value):
+        try:
+            return int(self.size_of(value))
+        except Exception as e:
+            self.logging.warning(f"{self.name} cache - unable to size {key} - {e}")
+            return 0
+
+    def _evict(self, keep):
+        # drops least recently used entries other than keep until the cache fits its budget
+        total = sum(self.sizes.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            evicted = next(key for key in self.entries if key != keep)
+            total -= self.sizes.get(evicted, 0)
+            self.pop(evicted)
+            self.evictions += 1
+            self.logging.info(f"{self.name} cache evicted {evicted}, {total} of {self.max_bytes} bytes used")
+
+    def __setitem__(self, key, value):
+        size = self._measure(key, value)
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.last_used[key] = time.time()
+            self.sizes[key] = size
+            self._evict(keep=key)
+
+    def resize(self, key):
+        # re-measures one entry after it grew, evicting others if it no longer fits
+        value = self.entries.get(key)
+        if value is None:
+            return
+        size = self._measure(key, value)
+        with self._lock:
+            if self.entries.get(key) is value:
+                self.sizes[key] = size
+                self._evict(keep=key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self.sizes.pop(key, None)
+            self.last_used.pop(key, None)
+            return self.entries.pop(key, default)
+
+    def report(self):
+        with self._lock:
+            entries = list(self.entries.items())
+        sizes = {key: self._measure(key, value) for key, value in entries}
+        with self._lock:
+            for key, value in entries:
+                if self.entries.get(key) is value:
+                    self.sizes[key] = sizes[key]
+            return {
+                "max_bytes": self.max_bytes,
+                "bytes": sum(self.sizes.values()),
+                "evictions": self.evictions,
+                # most recently used first
+                "entries": [
+                    {"key": key, "bytes": self.sizes[key], "last_used": round(self.last_used[key], 3)}
+                    for key in reversed(self.entries)
+                ],
+            }
@@ -0,0 +1,155 @@
+import numpy as np
+
+from constants import VECTOR_QUANTIZATION, SEARCH_MAX_K, RETRIEVAL_MODE, RRF_K
+from lexical_index import reciprocal_rank_fusion
+
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+
+
+def embed_queries(db, queries):
+    # one batch for all queries, through the embedding cache when the db has it
+    embeddings = db.embedding_function
+    if hasattr(embeddings, "encode"):
+        return embeddings.encode(queries, embeddings.query_instruction)
+    return np.array([embeddings.embed_query(query) for query in queries], dtype=np.float32)
+
+
+def get_quantized_retriever(db, k=4):
+    # the quantized retriever of a db, built once and kept on it (see quantization.QuantizedStoreRetriever)
+    from quantization import QuantizedStoreRetriever
+
+    retriever = getattr(db, "_quantized_retriever", None)
+    if retriever is None:
+        retriever = db._quantized_retriever = QuantizedStoreRetriever(db, VECTOR_QUANTIZATION, k=k)
+        if getattr(db, "on_resize", None) is not None:
+            db.on_resize()
+    return retriever
+
+
+def distance_to_score(distance):
+    # the stores rank by squared l2, for the unit length instructor embeddings 1 - d/2 is the cosine similarity
+    return 1.0 - distance / 2.0
+
+
+def _candidates(db, vectors, n_results, where, with_embeddings):
+    # (documents, distances, embeddings or None, chunk ids) per query vector, one multi-query call unless quantized
+    from langchain.docstore.document import Document
+
+    if VECTOR_QUANTIZATION != "none" and not where:
+        retriever = get_quantized_retriever(db, n_results)
+        return [retriever.search(vector, n_results, with_embeddings) for vector in vectors]
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if with_embeddings else [])
+    result = db.query(vectors, n_results, where=where, include=include)
+    candidates = []
+    for i in range(len(vectors)):
+        docs = [
+            Document(page_content=doc, metadata=metadata or {})
+            for doc, metadata in zip(result["documents"][i], result["metadatas"][i])
+        ]
+        embeddings = np.asarray(result["embeddings"][i], dtype=np.float32) if with_embeddings else None
+        candidates.append((docs, result["distances"][i], embeddings, result["ids"][i]))
+    return candidates
+
+
+def _get_docs(db, ids, where=None):
+    # chunk id -> Document for ids found in the collection (and matching the filter)
+    from langchain.docstore.document import Document
+
+    if not ids:
+        return {}
+    stored = db.get(ids=ids, where=where, include=["documents", "metadatas"])
+    return {
+        chunk_id: Document(page_content=doc, metadata=metadata or {})
+        for chunk_id, doc, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+    }
+
+
+def _vector_matches(vector, candidate, k, mmr, lambda_mult):
+    docs, distances, embeddings, ids = candidate
+    order = list(range(len(docs)))
+    if mmr and len(docs):
+        from langchain.vectorstores.utils import maximal_marginal_relevance
+
+        order = maximal_marginal_relevance(np.asarray(vector), embeddings, lambda_mult=lambda_mult, k=min(k, len(docs)))
+    return [(ids[i], docs[i], round(distance_to_score(distances[i]), 6), round(float(distances[i]), 6)) for i in order[:k]]
+
+
+def search(db, queries, k=4, score_threshold=None, where=None, mmr=False, fetch_k=None, lambda_mult=0.5,
+           mode=RETRIEVAL_MODE, lexical_index=None, rrf_k=RRF_K):
+    """
+    Top k chunks of a collection for every query, without calling the llm.
+
+    Modes:
+    - vector: nearest chunks by embedding, the queries are embedded in one batch and searched together.
+      With mmr the fetch_k nearest chunks are reranked by maximal marginal relevance, trading similarity
+      to the query (lambda_mult 1) for diversity among the results (lambda_mult 0).
+    - lexical: BM25 over the chunk text, see lexical_index.BM25Index.
+    - hybrid: the fetch_k best of both, fused by reciprocal rank (mmr is not applied).
+
+    Parameters:
+    - db (VectorStore): The vector db.
+    - queries (list): The query strings.
+    - k (int): Results per query.
+    - score_threshold (float): Drop results with a lower score, the mode's own score (cosine similarity,
+      bm25 or fused rrf).
+    - where (dict): Chroma style metadata filter, e.g. {"source": "/path/file.pdf"}.
+    - mmr (bool): Diversify the results.
+    - fetch_k (int): Candidates mmr or the fusion choose from, defaults to 4 * k.
+    - lexical_index (BM25Index): Needed by the lexical and hybrid modes.
+
+    Returns:
+    - list: Per query a list of (Document, score, distance), best first. distance is None for chunks only
+      the lexical index found.
+    """
+    if not queries:
+        return []
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"unknown retrieval mode '{mode}', expected one of {RETRIEVAL_MODES}")
+    if mode != "vector" and lexical_index is None:
+        raise ValueError(f"the {mode} retrieval mode needs a lexical index, process the documents first")
+    k = max(1, min(int(k), SEARCH_MAX_K))
+    fetch_k = max(k, min(int(fetch_k or 4 * k), SEARCH_MAX_K)) if (mmr or mode != "vector") else k
+    results = []
+    if mode == "lexical":
+        for query in queries:
+            ranked = lexical_index.search(query, fetch_k)
+            docs = _get_docs(db, [chunk_id for chunk_id, _ in ranked], where)
+            matches = [(docs[chunk_id], round(score, 6), None) for chunk_id, score in ranked if chunk_id in docs]
+            results.append(matches[:k])
+    else:
+        vectors = embed_queries(db, queries)
+        candidates = _candidates(db, vectors, fetch_k, where, mmr and mode == "vector")
+        for query, vector, candidate in zip(queries, vectors, candidates):
+            if mode == "vector":
+                results.append([(doc, score, distance) for _, doc, score, distance in _vector_matches(vector, candidate, k, mmr, lambda_mult)])
+                continue
+            vector_matches = _vector_matches(vector, candidate, fetch_k, False, lambda_mult)
+            by_id = {chunk_id: (doc, distance) for chunk_id, doc, _, distance in vector_matches}
+            lexical_ids = [chunk_id for chunk_id, _ in lexical_index.search(query, fetch_k)]
+            fused = reciprocal_rank_fusion([[chunk_id for chunk_id, _, _, _ in vector_matches], lexical_ids], rrf_k)[:k]
+            missing = [chunk_id for chunk_id, _ in fused if chunk_id not in by_id]
+            for chunk_id, doc in _get_docs(db, missing, where).items():
+                by_id[chunk_id] = (doc, None)
+            results.append([(by_id[chunk_id][0], round(score, 6), by_id[chunk_id][1]) for chunk_id, score in fused if chunk_id in by_id])
+    if score_threshold is not None:
+        results = [[match for match in matches if match[1] >= score_threshold] for matches in results]
+    return results
+
+
+class StoreRetriever:
+    """
+    The get_relevant_documents method of a langchain retriever over a VectorStore, see search.
+
+    Parameters:
+    - db (VectorStore): The vector db.
+    - k (int): Documents returned per query.
+    """
+
+    def __init__(self, db, k=4, mode="vector", lexical_index=None):
+        self.db = db
+        self.k = k
+        self.mode = mode
+        self.lexical_index = lexical_index
+
+    def get_relevant_documents(self, query):
+        return [doc for doc, _, _ in search(self.db, [query], self.k, mode=self.mode, lexical_index=self.lexical_index)[0]]
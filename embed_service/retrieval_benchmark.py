@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+import numpy as np
+
+import ai_calls as ac
+import retrieval
+from embedding_cache import CachedEmbeddings
+from constants import EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_PATH
+
+
+def sample_queries(texts, n_queries, n_words, seed=42):
+    """
+    Queries cut from the chunks themselves: a run of n_words consecutive words from a random chunk, the
+    chunk it came from is the one relevant result.
+
+    Returns:
+    - list: (query, relevant chunk text) pairs.
+    """
+    rng = random.Random(seed)
+    candidates = [text.page_content for text in texts if len(text.page_content.split()) > n_words]
+    queries = []
+    for content in rng.sample(candidates, min(n_queries, len(candidates))):
+        words = content.split()
+        start = rng.randrange(len(words) - n_words)
+        queries.append((" ".join(words[start:start + n_words]), content))
+    return queries
+
+
+def benchmark(db, lexical_index, queries, k, modes=retrieval.RETRIEVAL_MODES):
+    """
+    Recall@k (the query's chunk is in the top k) and single-query latency per retrieval mode.
+
+    Returns:
+    - list: One dict per mode.
+    """
+    report = []
+    for mode in modes:
+        latencies, hits = [], 0
+        for query, relevant in queries:
+            start = time.perf_counter()
+            matches = retrieval.search(db, [query], k, mode=mode, lexical_index=lexical_index)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += any(doc.page_content == relevant for doc, _, _ in matches)
+        report.append({
+            "mode": mode,
+            "queries": len(queries),
+            f"recall@{k}": round(hits / max(len(queries), 1), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3) if latencies else None,
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3) if latencies else None,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of vector, lexical and hybrid retrieval on a processed folder")
+    parser.add_argument("--path", required=True, help="folder under SOURCE_DIRECTORY")
+    parser.add_argument("--dir-name", required=True, help="vector db of the folder, built if missing")
+    parser.add_argument("--small-chunk-size", type=int, default=1000)
+    parser.add_argument("--small-chunk-overlap", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=8)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--device", default=os.getenv('DEVICE', 'cpu'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    data = {
+        "path": args.path,
+        "small_chunk_size": args.small_chunk_size,
+        "small_chunk_overlap": args.small_chunk_overlap,
+        "large_chunk_size": args.small_chunk_size,
+        "large_chunk_overlap": args.small_chunk_overlap,
+    }
+    small_texts, _ = ac.process_documents(data)
+    embeddings = ac.get_embeddings(EMBEDDING_MODEL_NAME, args.device, EMBEDDING_MODEL_PATH)
+    embeddings = CachedEmbeddings(embeddings, embeddings.model_name)
+    chunking = {"chunk_size": args.small_chunk_size, "chunk_overlap": args.small_chunk_overlap}
+    db, state = ac.get_doc_vectordb(args.dir_name, small_texts, embeddings, chunking)
+    if db is None:
+        raise SystemExit(state)
+    lexical_index = ac.build_lexical_index(args.path, small_texts)
+    logging.info(f"{len(lexical_index)} chunks, bm25 index {lexical_index.nbytes} bytes")
+    for row in benchmark(db, lexical_index, sample_queries(small_texts, args.queries, args.query_words), args.k):
+        print(json.dumps(row))
@@ -0,0 +1,338 @@
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import MAX_BATCH_SLOTS, INGEST_THREADS
+
+
+class GenerationRequest:
+    """
+    A single prompt waiting on, or being decoded by, the InferenceScheduler.
+
+    Parameters:
+    - prompt (str): The full prompt text.
+    - params (dict): Sampling overrides passed through to the model (temperature, max_tokens, stop, ...). A
+      'timeout' in seconds is kept by the scheduler, the request finishes with what it has when it runs out.
+    - sink (queue.Queue): Optional queue shared by several requests, gets (request, text) for every generated
+      piece of text and (request, None) when the request finishes, so one reader can follow all of them.
+    """
+
+    def __init__(self, prompt, params=None, sink=None):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.params = dict(params or {})
+        timeout = self.params.pop("timeout", None)
+        self.text = ""
+        self.error = None
+        self.finish_reason = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cancelled = False
+        self.cached = False
+        self.cache_key = None
+        self.submitted_at = time.time()
+        self.deadline = self.submitted_at + float(timeout) if timeout else None
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._stream = queue.Queue()
+        self._sink = sink
+
+    def done(self):
+        return self._done.is_set()
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def cancel(self):
+        # the scheduler drops cancelled requests between decode steps, freeing the slot for the next request
+        self.cancelled = True
+
+    def stream(self):
+        # yields generated text pieces as the scheduler produces them, ends when the request finishes
+        while True:
+            text = self._stream.get()
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise self.error
+
+    def usage(self):
+        # token counts and timings, sent as the final event of a streamed response
+        end = self.finished_at or time.time()
+        decode_time = end - (self.first_token_at or end)
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "finish_reason": self.finish_reason,
+            "cached": self.cached,
+            "queue_time": round((self.started_at or end) - self.submitted_at, 4),
+            "time_to_first_token": round((self.first_token_at or end) - self.submitted_at, 4),
+            "total_time": round(end - self.submitted_at, 4),
+            "tokens_per_second": round(self.completion_tokens / decode_time, 2) if decode_time > 0 and not self.cached else None,
+        }
+
+    def _add_text(self, text):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.completion_tokens += 1
+        self.text += text
+        self._stream.put(text)
+        if self._sink is not None:
+            self._sink.put((self, text))
+
+    def result(self, timeout=None):
+        # blocks until the scheduler finishes the request and returns the generated text
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"generation {self.id} did not finish within {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+    def _finish(self, finish_reason=None, error=None):
+        self.finish_reason = finish_reason
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+        self._stream.put(None)
+        if self._sink is not None:
+            self._sink.put((self, None))
+
+
+class InferenceScheduler:
+    """
+    Owns the LLM and decodes queued prompts with continuous batching.
+
+    Each batch slot is a model context. For LlamaCpp models the first slot is the loaded model and the
+    remaining slots are extra llama contexts opened on the same mmapped weights, so the weights are only
+    held in memory once. Every loop iteration advances each active slot by one token (slots run in
+    parallel, llama.cpp releases the GIL while it evaluates), and queued requests are admitted into free
+    slots between decode steps rather than waiting for the whole batch to drain.
+
+    Models that are not llama.cpp backed are driven through a single slot that calls llm(prompt).
+
+    Parameters:
+    - llm: The model returned by load_quantized_model_gguf_ggml (or any callable taking a prompt).
+    - max_batch (int): Number of sequences decoded together.
+    - completion_cache (CompletionCache): Optional cache answering repeated temperature 0 prompts without decoding.
+    - cpu_set (set): Optional cores the decode threads are pinned to, llama.cpp worker threads inherit the affinity.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+
+    def __init__(self, llm, max_batch=MAX_BATCH_SLOTS, completion_cache=None, cpu_set=None, logging=logging):
+        self.llm = llm
+        self.logging = logging
+        self.completion_cache = completion_cache
+        self.cpu_set = cpu_set
+        self.slots = self._build_slots(llm, max(1, int(max_batch)))
+        self.pending = queue.Queue()
+        self.active = {}
+        self._closed = False
+        self._closing = False
+        # submit checks _closing and enqueues under the same lock close() sets it with, so no request can be
+        # queued behind the closing sentinel
+        self._submit_lock = threading.Lock()
+        self._step_pool = ThreadPoolExecutor(max_workers=max(1, len(self.slots)), initializer=self._pin_thread)
+        self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+        self._thread.start()
+
+    def _pin_thread(self):
+        if self.cpu_set and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.cpu_set)
+
+    def _build_slots(self, llm, max_batch):
+        if llm is None:
+            return []
+        client = getattr(llm, "client", None)
+        if client is None or not hasattr(client, "create_completion"):
+            return [llm]
+        slots = [client]
+        thread_budget = len(self.cpu_set) if self.cpu_set else INGEST_THREADS
+        threads_per_slot = max(1, thread_budget // max_batch)
+        if max_batch > 1:
+            from llama_cpp import Llama
+
+            for _ in range(max_batch - 1):
+                try:
+                    slots.append(
+                        Llama(
+                            model_path=llm.model_path,
+                            n_ctx=llm.n_ctx,
+                            n_batch=llm.n_batch,
+                            n_gpu_layers=llm.n_gpu_layers or 0,
+                            n_threads=threads_per_slot,
+                            use_mmap=True,
+                            verbose=False,
+                        )
+                    )
+                except Exception as e:
+                    self.logging.warning(f"Unable to open extra batch slot, continuing with {len(slots)} - {e}")
+                    break
+        for slot in slots:
+            if hasattr(slot, "n_threads"):
+                slot.n_threads = max(1, thread_budget // len(slots))
+            # every slot shares the prefix cache, a prefix evaluated on one context can be restored on another
+            if getattr(client, "cache", None) is not None and slot is not client:
+                client.cache.attach(slot)
+        self.logging.info(f"Inference scheduler running {len(slots)} batch slot(s)")
+        return slots
+
+    def submit(self, prompt, sink=None, **params):
+        # queue a prompt and return its GenerationRequest without waiting for the result, see GenerationRequest for sink
+        if not self.slots:
+            raise RuntimeError("LLM is not loaded")
+        request = GenerationRequest(prompt, params, sink)
+        if self.completion_cache is not None:
+            sampling_params = self._sampling_params(request)
+            if self.completion_cache.cacheable(sampling_params):
+                request.cache_key = self.completion_cache.key(prompt, sampling_params)
+                entry = self.completion_cache.get(request.cache_key)
+                if entry is not None:
+                    request.cached = True
+                    request.prompt_tokens = entry["prompt_tokens"]
+                    request._add_text(entry["text"])
+                    request.completion_tokens = entry["completion_tokens"]
+                    request._finish(entry["finish_reason"])
+                    return request
+        with self._submit_lock:
+            if self._closing:
+                raise RuntimeError("scheduler is closed, the model was unloaded")
+            self.pending.put(request)
+        return request
+
+    def __call__(self, prompt, **params):
+        return self.submit(prompt, **params).result()
+
+    def count_tokens(self, text):
+        # tokens the model's tokenizer makes of text, a rough estimate for models without a llama tokenizer
+        slot = self.slots[0] if self.slots else None
+        if slot is not None and hasattr(slot, "tokenize"):
+            return len(slot.tokenize(text.encode("utf-8"), add_bos=False))
+        return len(text) // 4
+
+    def load(self):
+        # number of requests decoding or waiting, used to route between replicas
+        return len(self.active) + self.pending.qsize()
+
+    def close(self):
+        # stop the decode loop once the in-flight and already queued requests finish
+        with self._submit_lock:
+            if self._closing:
+                return
+            self._closing = True
+            self.pending.put(None)
+
+    def stats(self):
+        stats = {"slots": len(self.slots), "active": len(self.active), "queued": self.pending.qsize()}
+        if self.completion_cache is not None:
+            stats["completion_cache"] = self.completion_cache.stats()
+        prefix_cache = getattr(self.slots[0], "cache", None) if self.slots else None
+        if prefix_cache is not None:
+            stats["prefix_cache"] = prefix_cache.stats()
+        return stats
+
+    def _sampling_params(self, request):
+        # the model defaults overridden by the request
+        params = {
+            key: getattr(self.llm, key)
+            for key in ("temperature", "max_tokens", "top_p", "top_k", "repeat_penalty")
+            if getattr(self.llm, key, None) is not None
+        }
+        params.update(request.params)
+        return params
+
+    def _token_stream(self, slot, request):
+        if not hasattr(slot, "create_completion"):
+            yield slot(request.prompt), "stop"
+            return
+        request.prompt_tokens = len(slot.tokenize(request.prompt.encode("utf-8")))
+        for chunk in slot.create_completion(request.prompt, stream=True, **self._sampling_params(request)):
+            choice = chunk["choices"][0]
+            yield choice["text"], choice.get("finish_reason")
+
+    def _admit(self):
+        # fill free slots from the queue, only blocking when nothing is being decoded
+        free = [i for i in range(len(self.slots)) if i not in self.active]
+        while free:
+            try:
+                request = self.pending.get(block=not self.active, timeout=None if not self.active else 0)
+            except queue.Empty:
+                return
+            if request is None:
+                self._closed = True
+                return
+            if request.cancelled or request.expired():
+                request._finish("cancelled" if request.cancelled else "timeout")
+                continue
+            slot_index = free.pop(0)
+            request.started_at = time.time()
+            self.active[slot_index] = (request, self._token_stream(self.slots[slot_index], request))
+
+    def _step(self, slot_index):
+        request, tokens = self.active[slot_index]
+        if request.cancelled:
+            return "cancelled"
+        if request.expired():
+            return "timeout"
+        try:
+            text, finish_reason = next(tokens)
+        except StopIteration:
+            return "stop"
+        if text:
+            request._add_text(text)
+        return finish_reason
+
+    def _run(self):
+        self._pin_thread()
+        while not (self._closed and not self.active):
+            self._admit()
+            indices = list(self.active)
+            results = [self._step_pool.submit(self._step, i) for i in indices]
+            for slot_index, result in zip(indices, results):
+                request, tokens = self.active[slot_index]
+                try:
+                    finish_reason = result.result()
+                    if finish_reason is None:
+                        continue
+                    request._finish(finish_reason)
+                    if request.cache_key is not None and finish_reason in ("stop", "length"):
+                        self.completion_cache.put(request.cache_key, {
+                            "text": request.text,
+                            "finish_reason": finish_reason,
+                            "prompt_tokens": request.prompt_tokens,
+                            "completion_tokens": request.completion_tokens,
+                        })
+                except Exception as e:
+                    self.logging.error(e)
+                    request._finish("error", e)
+                tokens.close()
+                del self.active[slot_index]
+        # nothing should be queued behind the sentinel, fail anything that is rather than leave it waiting
+        while True:
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request._finish("error", RuntimeError("scheduler is closed, the model was unloaded"))
+        self._step_pool.shutdown(wait=False)
+
+
+def request_params(data):
+    """
+    The per-request generation limits a route accepts, ready to pass to InferenceScheduler.submit.
+
+    Parameters:
+    - data (dict): The request json, may hold max_tokens (int), stop (str or list of str) and timeout (seconds).
+    """
+    params = {key: data[key] for key in ("max_tokens", "stop", "timeout") if data.get(key) is not None}
+    if "max_tokens" in params:
+        params["max_tokens"] = int(params["max_tokens"])
+    return params
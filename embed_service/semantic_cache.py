@@ -0,0 +1,125 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from constants import SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_ENTRIES
+
+# only complete answers are cached, not the partial text of a timed out, cancelled or failed generation
+CACHEABLE_FINISH_REASONS = ("stop", "length")
+
+
+def cache_key(dir_name, template, retrieval_mode, params):
+    # answers are only shared by questions to the same collection, through the same template and retrieval
+    # mode, with the same generation limits (the timeout does not change an answer)
+    params = {k: v for k, v in params.items() if k not in ("timeout", "stream")}
+    return (dir_name, hashlib.sha256(template.encode("utf-8")).hexdigest()[:16], retrieval_mode, json.dumps(params, sort_keys=True))
+
+
+class SemanticCache:
+    """
+    Rag answers looked up by question similarity, so a paraphrased question gets the earlier answer
+    without retrieval or generation.
+
+    The cache is split into partitions (see cache_key), the first part of a key is the collection's
+    dir_name. A partition holds its questions' unit embeddings as one matrix, a lookup is a matrix product
+    and the best match counts when its cosine similarity is at least threshold. Entries expire ttl seconds
+    after they were added, a full partition drops its least recently used entry.
+
+    Parameters:
+    - threshold (float): Lowest cosine similarity of a hit.
+    - ttl (float): Seconds an answer is kept, 0 keeps answers until they are evicted.
+    - max_entries (int): Entries per partition.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, max_entries=SEMANTIC_CACHE_ENTRIES, logging=logging):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.logging = logging
+        self.partitions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _expire(self, partition, now):
+        if not self.ttl:
+            return
+        alive = [i for i, entry in enumerate(partition["entries"]) if now - entry["created"] < self.ttl]
+        if len(alive) < len(partition["entries"]):
+            self.evictions += len(partition["entries"]) - len(alive)
+            partition["entries"] = [partition["entries"][i] for i in alive]
+            partition["vectors"] = partition["vectors"][alive]
+
+    def lookup(self, key, vectors):
+        """
+        Returns:
+        - list: Per question vector the cached entry (question, answer, similarity) or None.
+        """
+        vectors = self._normalize(vectors)
+        now = time.time()
+        with self._lock:
+            partition = self.partitions.get(key)
+            if partition is not None:
+                self._expire(partition, now)
+            if partition is None or not partition["entries"]:
+                self.misses += len(vectors)
+                return [None] * len(vectors)
+            similarities = vectors @ partition["vectors"].T
+            found = []
+            for row in similarities:
+                best = int(np.argmax(row))
+                if row[best] < self.threshold:
+                    self.misses += 1
+                    found.append(None)
+                    continue
+                self.hits += 1
+                entry = partition["entries"][best]
+                entry["used"] = now
+                found.append({"question": entry["question"], "answer": entry["answer"], "similarity": round(float(row[best]), 4)})
+            return found
+
+    def add(self, key, vector, question, answer):
+        vector = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            partition = self.partitions.setdefault(key, {"vectors": np.zeros((0, vector.shape[1]), dtype=np.float32), "entries": []})
+            self._expire(partition, now)
+            if len(partition["entries"]) >= self.max_entries:
+                oldest = min(range(len(partition["entries"])), key=lambda i: partition["entries"][i]["used"])
+                del partition["entries"][oldest]
+                partition["vectors"] = np.delete(partition["vectors"], oldest, axis=0)
+                self.evictions += 1
+            partition["entries"].append({"question": question, "answer": answer, "created": now, "used": now})
+            partition["vectors"] = np.concatenate([partition["vectors"], vector])
+
+    def invalidate(self, dir_name=None):
+        # drops the answers of one collection, or all of them
+        with self._lock:
+            for key in [key for key in self.partitions if dir_name is None or key[0] == dir_name]:
+                del self.partitions[key]
+        self.logging.info(f"semantic cache invalidated for {dir_name or 'all collections'}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = sum(len(partition["entries"]) for partition in self.partitions.values())
+            partitions = len(self.partitions)
+        return {
+            "partitions": partitions,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "threshold": self.threshold,
+        }
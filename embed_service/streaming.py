@@ -0,0 +1,81 @@
+import json
+
+
+def sse_event(event, data):
+    """
+    Format one server-sent event.
+
+    Parameters:
+    - event (str): The event name, e.g. 'token', 'done' or 'error'.
+    - data: Any json serialisable payload.
+
+    Returns:
+    - str: The encoded event, ready to be yielded from a flask streaming response.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_generation(gen_request, done_extra=None, event_extra=None):
+    """
+    Yield a GenerationRequest as server-sent events.
+
+    One 'token' event is sent per generated piece of text and a final 'done' event carries the usage and
+    timing of the generation. If the client goes away the generator is closed and the request is
+    cancelled so the scheduler can hand its slot to the next request.
+
+    Parameters:
+    - gen_request (GenerationRequest): A request returned by InferenceScheduler.submit.
+    - done_extra (dict): Extra fields added to the 'done' event.
+    - event_extra (dict): Extra fields added to every event, e.g. the question index in a rag stream.
+    """
+    event_extra = event_extra or {}
+    try:
+        for text in gen_request.stream():
+            yield sse_event("token", {**event_extra, "text": text})
+        yield sse_event("done", {**event_extra, **(done_extra or {}), "response": gen_request.text, "usage": gen_request.usage()})
+    except Exception as e:
+        yield sse_event("error", {**event_extra, "message": str(e)})
+    finally:
+        if not gen_request.done():
+            gen_request.cancel()
+
+
+def stream_generations(gen_requests, merged, done_extras=None, event_extras=None, on_done=None):
+    """
+    Yield several GenerationRequests as one stream of server-sent events, in the order they are produced.
+
+    The requests decode concurrently, so their 'token' events interleave and every request's 'done' (or
+    'error') event is sent as soon as it finishes. They must be submitted with merged as their sink, the
+    scheduler then puts every request's text into that one queue and no thread is needed per request.
+    event_extras should identify the request, e.g. the question index. Closing the generator cancels the
+    requests that are still running.
+
+    Parameters:
+    - gen_requests (list): Requests returned by InferenceScheduler.submit(prompt, sink=merged).
+    - merged (queue.Queue): The requests' shared sink.
+    - done_extras (list): Extra fields added to each request's 'done' event.
+    - event_extras (list): Extra fields added to every event of each request.
+    - on_done (callable): Called with (i, gen_request) when the i-th request completes without error.
+    """
+    done_extras = done_extras or [{} for _ in gen_requests]
+    event_extras = event_extras or [{} for _ in gen_requests]
+    index = {gen_request.id: i for i, gen_request in enumerate(gen_requests)}
+    try:
+        finished = 0
+        while finished < len(gen_requests):
+            gen_request, text = merged.get()
+            i = index[gen_request.id]
+            if text is not None:
+                yield sse_event("token", {**event_extras[i], "text": text})
+                continue
+            finished += 1
+            if gen_request.error is None:
+                if on_done:
+                    on_done(i, gen_request)
+                yield sse_event("done", {**event_extras[i], **done_extras[i], "response": gen_request.text, "usage": gen_request.usage()})
+            else:
+                yield sse_event("error", {**event_extras[i], "message": str(gen_request.error)})
+    finally:
+        for gen_request in gen_requests:
+            if not gen_request.done():
+                gen_request.cancel()
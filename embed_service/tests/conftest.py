@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the service modules import each other by name, as they do when the service runs from its folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import threading
+import time
+
+import chunk_store
+from jobs import JobManager, check_cancelled
+
+
+def _wait(manager, job, states=("succeeded", "failed", "cancelled")):
+    deadline = time.time() + 5
+    while job.state not in states and time.time() < deadline:
+        time.sleep(0.01)
+    return manager.get(job.id).to_dict()
+
+
+def test_failed_job_keeps_the_exception_type_and_message():
+    def fail(payload):
+        raise KeyError("dir_name")
+
+    manager = JobManager({"fail": fail})
+    job = _wait(manager, manager.submit("fail", {}))
+    assert job["state"] == "failed"
+    assert job["error_type"] == "KeyError"
+    assert "dir_name" in job["error"]
+
+
+def test_exception_without_message_is_not_reported_empty():
+    def fail(payload):
+        raise RuntimeError()
+
+    manager = JobManager({"fail": fail})
+    job = _wait(manager, manager.submit("fail", {}))
+    assert job["error_type"] == "RuntimeError"
+    assert job["error"]
+
+
+class _Doc:
+    def __init__(self, page_content, source):
+        self.page_content = page_content
+        self.metadata = {"source": source}
+
+
+def test_running_ingestion_job_is_cancelled(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunk_store, "CHUNK_STORE_DIRECTORY", str(tmp_path / "chunks"))
+    source = tmp_path / "a.txt"
+    source.write_text("some text")
+    params = {"small_chunk_size": 10}
+    processing = threading.Event()
+    cancelled = threading.Event()
+
+    def process(ignored_files):
+        # stands in for loading and splitting, the job is cancelled while it runs
+        processing.set()
+        cancelled.wait(5)
+        docs = [_Doc("some text", str(source))]
+        return docs, [[doc] for doc in docs]
+
+    def ingest_task(payload):
+        return chunk_store.ingest("folder", [str(source)], params, process, check_cancelled)
+
+    manager = JobManager({"process_documents": ingest_task})
+    job = manager.submit("process_documents", {})
+    assert processing.wait(5)
+    assert job.state == "running"
+    manager.cancel(job.id)
+    cancelled.set()
+    assert _wait(manager, job)["state"] == "cancelled"
+    # nothing of the cut short ingestion was committed
+    assert chunk_store.load_chunks("folder") is None
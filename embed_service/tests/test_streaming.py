@@ -0,0 +1,32 @@
+import json
+import queue
+import threading
+
+from scheduler import InferenceScheduler
+from streaming import stream_generations
+
+
+def _events(stream):
+    for event in stream:
+        name, data = event.strip().split("\n")
+        yield name[len("event: "):], json.loads(data[len("data: "):])
+
+
+def test_stream_generations_merges_from_the_sink_without_a_thread_per_request():
+    scheduler = InferenceScheduler(lambda prompt: prompt.upper(), max_batch=1)
+    # the scheduler's own decode threads start with its first request
+    scheduler("warm up")
+    threads = threading.active_count()
+    merged = queue.Queue()
+    gen_requests = [scheduler.submit(f"question {i}", sink=merged) for i in range(20)]
+    done = []
+    events = list(_events(stream_generations(
+        gen_requests,
+        merged,
+        event_extras=[{"question_index": i} for i in range(20)],
+        on_done=lambda i, gen_request: done.append(i),
+    )))
+    assert threading.active_count() <= threads
+    assert sorted(done) == list(range(20))
+    answers = {data["question_index"]: data["response"] for name, data in events if name == "done"}
+    assert answers == {i: f"QUESTION {i}" for i in range(20)}
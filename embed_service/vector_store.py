@@ -0,0 +1,413 @@
+import os
+import json
+import logging
+import threading
+
+import numpy as np
+
+from constants import IVF_MIN_TRAIN, IVF_NPROBE, IVF_RETRAIN_GROWTH
+
+INCLUDE_DEFAULT = ("documents", "metadatas")
+
+
+class VectorStore:
+    """
+    The interface the vector dbs share, results are shaped like chromadb's so callers work with any backend.
+
+    get returns {"ids": [...], "documents": [...], "metadatas": [...], "embeddings": [...]} and query returns
+    the same keys plus "distances", with one list per query embedding. Keys not asked for in include are
+    None. Distances are squared l2.
+
+    Attributes:
+    - name (str): The collection name.
+    - embedding_function: The embeddings (embed_documents / embed_query, see embedding_cache.CachedEmbeddings).
+    - on_resize (callable): Optional, called when memory is attached to the open store (a quantized index).
+    """
+
+    name = None
+    embedding_function = None
+    on_resize = None
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        raise NotImplementedError
+
+    def get(self, ids=None, where=None, include=INCLUDE_DEFAULT):
+        raise NotImplementedError
+
+    def query(self, query_embeddings, n_results, where=None, include=INCLUDE_DEFAULT):
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def resident_bytes(self):
+        # approximate memory the open store holds
+        raise NotImplementedError
+
+    def add_documents(self, documents, ids):
+        # embeds langchain Documents with the store's embedding function and upserts them under ids
+        texts = [doc.page_content for doc in documents]
+        self.upsert(ids, self.embedding_function.embed_documents(texts), texts, [doc.metadata for doc in documents])
+
+
+class ChromaStore(VectorStore):
+    """
+    A langchain Chroma collection behind the VectorStore interface.
+
+    Parameters:
+    - db (Chroma): The langchain vector store.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db._collection
+        self.name = self.collection.name
+        self.embedding_function = db._embedding_function
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=list(ids), embeddings=[list(map(float, e)) for e in embeddings], documents=documents, metadatas=metadatas)
+
+    def add_documents(self, documents, ids):
+        self.db.add_documents(documents, ids=ids)
+
+    def get(self, ids=None, where=None, include=INCLUDE_DEFAULT):
+        return self.collection.get(ids=list(ids) if ids is not None else None, where=where or None, include=list(include))
+
+    def query(self, query_embeddings, n_results, where=None, include=INCLUDE_DEFAULT):
+        return self.collection.query(query_embeddings=np.asarray(query_embeddings).tolist(), n_results=n_results, where=where or None, include=list(include))
+
+    def delete(self, ids):
+        if ids:
+            self.collection.delete(ids=list(ids))
+
+    def count(self):
+        return self.collection.count()
+
+    def resident_bytes(self):
+        # chromadb keeps the collection's hnsw index in memory, the float32 vectors plus about 100 bytes of
+        # graph links and ids per row
+        n = self.collection.count()
+        if not n:
+            return 0
+        dim = len(self.collection.get(limit=1, include=["embeddings"])["embeddings"][0])
+        return n * (dim * 4 + 100)
+
+
+def matches_where(metadata, where):
+    # the subset of chromadb's where filter the ivf store supports: field equality, $eq, $ne, $in, $nin,
+    # $gt, $gte, $lt, $lte, and $and / $or of filters
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_where(metadata, sub) for sub in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, operand in condition.items():
+            if op == "$eq" and value != operand:
+                return False
+            if op == "$ne" and value == operand:
+                return False
+            if op == "$in" and value not in operand:
+                return False
+            if op == "$nin" and value in operand:
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if (op == "$gt" and not value > operand) or (op == "$gte" and not value >= operand) \
+                        or (op == "$lt" and not value < operand) or (op == "$lte" and not value <= operand):
+                    return False
+    return True
+
+
+class IVFStore(VectorStore):
+    """
+    In-process vector store: an inverted-file (IVF) index over a memory-mapped float32 vector file.
+
+    Rows are append-only files in the persist directory - vectors.f32 (memory-mapped, so processes that
+    open the same store share its pages), records.bin with each row's document and metadata as json,
+    addressed by records.idx (offset, length pairs), ids.txt and deleted.txt (rows dropped by delete or
+    replaced by upsert). Opening a store reads the ids and the index, not the vectors or documents.
+
+    Below IVF_MIN_TRAIN rows queries scan every vector. Above it the rows are clustered into about
+    4 * sqrt(n) lists (MiniBatchKMeans) and a query only scans the IVF_NPROBE lists with the closest
+    centroids. The lists are retrained when the store has grown IVF_RETRAIN_GROWTH times since the last
+    training, rows added in between go to their nearest existing list.
+
+    One process should write to a store at a time, any number may read it.
+
+    Parameters:
+    - persist_dir (str): Folder of the store.
+    - embedding_function: The embeddings used by add_documents and queries.
+    - nprobe (int): Lists scanned per query.
+    """
+
+    def __init__(self, persist_dir, embedding_function=None, nprobe=IVF_NPROBE, logging=logging):
+        self.persist_dir = persist_dir
+        self.name = os.path.basename(persist_dir.rstrip("/"))
+        self.embedding_function = embedding_function
+        self.nprobe = nprobe
+        self.logging = logging
+        self.paths = {name: os.path.join(persist_dir, name) for name in (
+            "meta.json", "vectors.f32", "records.bin", "records.idx", "ids.txt", "deleted.txt",
+            "centroids.npy", "assignments.i32",
+        )}
+        self.dim = None
+        self.ids = []
+        self.row_of = {}
+        self.deleted = set()
+        self.trained_rows = 0
+        self.centroids = None
+        self.lists = []
+        self._vectors = None
+        self._records = None
+        self._lock = threading.RLock()
+        os.makedirs(persist_dir, exist_ok=True)
+        self._open()
+
+    @staticmethod
+    def exists(persist_dir):
+        return os.path.exists(os.path.join(persist_dir, "meta.json"))
+
+    def _open(self):
+        if not os.path.exists(self.paths["meta.json"]):
+            return
+        with open(self.paths["meta.json"]) as _file:
+            meta = json.load(_file)
+        self.dim = meta["dim"]
+        self.trained_rows = meta.get("trained_rows", 0)
+        if not os.path.exists(self.paths["ids.txt"]):
+            return
+        with open(self.paths["ids.txt"]) as _file:
+            ids = _file.read()
+        # a line without its newline was cut by a crash
+        self.ids = ids.splitlines() if ids.endswith("\n") else ids.splitlines()[:-1]
+        # ids are appended last, a crash mid upsert leaves at most a tail of the other files uncovered
+        rows = min(len(self.ids), self._file_size("vectors.f32") // (self.dim * 4), self._file_size("records.idx") // 16)
+        self.ids = self.ids[:rows]
+        self._truncate(rows)
+        if os.path.exists(self.paths["deleted.txt"]):
+            with open(self.paths["deleted.txt"]) as _file:
+                self.deleted = {int(line) for line in _file if line.strip() and int(line) < rows}
+        self.row_of = {chunk_id: row for row, chunk_id in enumerate(self.ids) if row not in self.deleted}
+        if os.path.exists(self.paths["centroids.npy"]):
+            self.centroids = np.load(self.paths["centroids.npy"])
+            assignments = np.fromfile(self.paths["assignments.i32"], dtype=np.int32) if os.path.exists(self.paths["assignments.i32"]) else np.zeros(0, dtype=np.int32)
+            if len(assignments) < rows:
+                # a crash while training left the assignments short, the missing rows go to their nearest list
+                assignments = np.concatenate([assignments, self._nearest_centroid(np.asarray(self.vectors()[len(assignments):]))])
+                assignments.tofile(self.paths["assignments.i32"])
+            self._build_lists(assignments)
+
+    def _file_size(self, name):
+        return os.path.getsize(self.paths[name]) if os.path.exists(self.paths[name]) else 0
+
+    def _truncate(self, rows):
+        # cut every append-only file back to the rows ids.txt commits, so the next upsert writes row n at
+        # offset n in all of them
+        records_end = 0
+        if rows:
+            offset, length = np.fromfile(self.paths["records.idx"], dtype=np.int64, count=2, offset=(rows - 1) * 16)
+            records_end = int(offset + length)
+        sizes = {
+            "vectors.f32": rows * self.dim * 4,
+            "records.idx": rows * 16,
+            "records.bin": records_end,
+            "assignments.i32": rows * 4,
+            "ids.txt": sum(len(chunk_id.encode("utf-8")) + 1 for chunk_id in self.ids),
+        }
+        for name, size in sizes.items():
+            if self._file_size(name) > size:
+                self.logging.warning(f"ivf store {self.name} - truncating {name} to {rows} rows")
+                os.truncate(self.paths[name], size)
+
+    def _build_lists(self, assignments):
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def _save_meta(self):
+        with open(self.paths["meta.json"], "w") as _file:
+            json.dump({"dim": self.dim, "trained_rows": self.trained_rows, "backend": "ivf"}, _file)
+
+    def vectors(self):
+        rows = len(self.ids)
+        if self._vectors is None or self._vectors.shape[0] != rows:
+            self._vectors = np.memmap(self.paths["vectors.f32"], dtype=np.float32, mode="r", shape=(rows, self.dim)) if rows else np.zeros((0, self.dim or 1), dtype=np.float32)
+        return self._vectors
+
+    def _record_index(self):
+        rows = len(self.ids)
+        if self._records is None or self._records.shape[0] != rows:
+            self._records = np.memmap(self.paths["records.idx"], dtype=np.int64, mode="r", shape=(rows, 2)) if rows else np.zeros((0, 2), dtype=np.int64)
+        return self._records
+
+    def _read_records(self, rows):
+        index = self._record_index()
+        records = []
+        with open(self.paths["records.bin"], "rb") as _file:
+            for row in rows:
+                offset, length = index[row]
+                _file.seek(int(offset))
+                records.append(json.loads(_file.read(int(length))))
+        return records
+
+    def _nearest_centroid(self, vectors):
+        centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+        return np.argmin(centroid_norms[None, :] - 2.0 * (vectors @ self.centroids.T), axis=1).astype(np.int32)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if not len(ids):
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self._save_meta()
+            replaced = [self.row_of[chunk_id] for chunk_id in ids if chunk_id in self.row_of]
+            start_row = len(self.ids)
+            records_offset = os.path.getsize(self.paths["records.bin"]) if os.path.exists(self.paths["records.bin"]) else 0
+            index, blobs = [], []
+            for document, metadata in zip(documents, metadatas):
+                blob = json.dumps({"d": document, "m": metadata or {}}).encode("utf-8")
+                index.append((records_offset, len(blob)))
+                records_offset += len(blob)
+                blobs.append(blob)
+            with open(self.paths["vectors.f32"], "ab") as _file:
+                _file.write(embeddings.tobytes())
+            with open(self.paths["records.bin"], "ab") as _file:
+                _file.write(b"".join(blobs))
+            with open(self.paths["records.idx"], "ab") as _file:
+                _file.write(np.asarray(index, dtype=np.int64).tobytes())
+            if self.centroids is not None:
+                assignments = self._nearest_centroid(embeddings)
+                with open(self.paths["assignments.i32"], "ab") as _file:
+                    _file.write(assignments.tobytes())
+                new_rows = np.arange(start_row, start_row + len(ids), dtype=np.int64)
+                for list_id in np.unique(assignments):
+                    self.lists[list_id] = np.concatenate([self.lists[list_id], new_rows[assignments == list_id]])
+            with open(self.paths["ids.txt"], "a") as _file:
+                _file.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            # the replaced rows are only dropped once their new rows are committed
+            self._mark_deleted(replaced)
+            for i, chunk_id in enumerate(ids):
+                self.ids.append(chunk_id)
+                self.row_of[chunk_id] = start_row + i
+            if self._needs_training():
+                self.train()
+
+    def _needs_training(self):
+        alive = len(self.row_of)
+        if alive < IVF_MIN_TRAIN:
+            return False
+        return self.centroids is None or alive >= self.trained_rows * IVF_RETRAIN_GROWTH
+
+    def train(self):
+        # clusters the alive rows into ~4 * sqrt(n) lists and assigns every row to its nearest list
+        from sklearn.cluster import MiniBatchKMeans
+
+        with self._lock:
+            vectors = self.vectors()
+            alive = np.fromiter(self.row_of.values(), dtype=np.int64)
+            n_lists = max(1, int(4 * np.sqrt(len(alive))))
+            sample = np.sort(np.random.default_rng(42).choice(alive, size=min(len(alive), n_lists * 32), replace=False))
+            kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=42, batch_size=max(4096, n_lists * 4), n_init=1, max_iter=50).fit(np.asarray(vectors[sample]))
+            self.centroids = kmeans.cluster_centers_.astype(np.float32)
+            assignments = np.concatenate([
+                self._nearest_centroid(np.asarray(vectors[start:start + 65536]))
+                for start in range(0, len(self.ids), 65536)
+            ])
+            np.save(self.paths["centroids.npy"], self.centroids)
+            assignments.tofile(self.paths["assignments.i32"])
+            self._build_lists(assignments)
+            self.trained_rows = len(alive)
+            self._save_meta()
+            self.logging.info(f"ivf store {self.name} trained {n_lists} lists over {len(alive)} rows")
+
+    def _mark_deleted(self, rows):
+        if not rows:
+            return
+        self.deleted.update(rows)
+        with open(self.paths["deleted.txt"], "a") as _file:
+            _file.write("".join(f"{row}\n" for row in rows))
+
+    def delete(self, ids):
+        with self._lock:
+            rows = [self.row_of.pop(chunk_id) for chunk_id in ids if chunk_id in self.row_of]
+            self._mark_deleted(rows)
+
+    def count(self):
+        return len(self.row_of)
+
+    def resident_bytes(self):
+        # the vectors and records are memory-mapped or read on demand, what stays resident is the id maps
+        # (about 150 bytes per row as python objects), the lists and the centroids
+        lists = sum(rows.nbytes for rows in self.lists)
+        centroids = self.centroids.nbytes if self.centroids is not None else 0
+        return len(self.ids) * 150 + lists + centroids
+
+    def _result(self, rows, include, distances=None):
+        rows = list(rows)
+        records = self._read_records(rows) if ("documents" in include or "metadatas" in include) else None
+        return {
+            "ids": [self.ids[row] for row in rows],
+            "documents": [record["d"] for record in records] if "documents" in include else None,
+            "metadatas": [record["m"] for record in records] if "metadatas" in include else None,
+            "embeddings": np.asarray(self.vectors()[rows]).tolist() if "embeddings" in include else None,
+            "distances": distances,
+        }
+
+    def get(self, ids=None, where=None, include=INCLUDE_DEFAULT):
+        with self._lock:
+            rows = [self.row_of[chunk_id] for chunk_id in ids if chunk_id in self.row_of] if ids is not None else sorted(self.row_of.values())
+            if where:
+                rows = [row for row, record in zip(rows, self._read_records(rows)) if matches_where(record["m"], where)]
+            result = self._result(rows, include)
+            result.pop("distances")
+            return result
+
+    def _candidate_rows(self, query):
+        if self.centroids is None:
+            return np.fromiter(self.row_of.values(), dtype=np.int64)
+        centroid_distances = (self.centroids * self.centroids).sum(axis=1) - 2.0 * (self.centroids @ query)
+        probe = np.argpartition(centroid_distances, min(self.nprobe, len(self.centroids)) - 1)[:self.nprobe]
+        rows = np.concatenate([self.lists[i] for i in probe]) if len(probe) else np.zeros(0, dtype=np.int64)
+        if self.deleted:
+            rows = rows[~np.isin(rows, np.fromiter(self.deleted, dtype=np.int64))]
+        return rows
+
+    def query(self, query_embeddings, n_results, where=None, include=INCLUDE_DEFAULT):
+        results = {key: [] for key in ("ids", "documents", "metadatas", "embeddings", "distances")}
+        with self._lock:
+            vectors = self.vectors()
+            for query in np.asarray(query_embeddings, dtype=np.float32):
+                rows = np.sort(self._candidate_rows(query))
+                candidates = np.asarray(vectors[rows]) if len(rows) else np.zeros((0, self.dim or 1), dtype=np.float32)
+                distances = ((candidates - query) ** 2).sum(axis=1)
+                order = np.argsort(distances)
+                if where:
+                    # filtered after ranking, records are only read until n_results rows match
+                    chosen = []
+                    for i in order:
+                        if matches_where(self._read_records([rows[i]])[0]["m"], where):
+                            chosen.append(i)
+                            if len(chosen) == n_results:
+                                break
+                    order = np.asarray(chosen, dtype=np.int64)
+                else:
+                    order = order[:n_results]
+                result = self._result(rows[order], include, distances[order].tolist())
+                for key in results:
+                    results[key].append(result[key])
+        return {key: (value if key in include or key in ("ids", "distances") else None) for key, value in results.items()}
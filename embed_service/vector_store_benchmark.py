@@ -0,0 +1,123 @@
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from vector_store import ChromaStore, IVFStore
+
+BATCH_SIZE = 5000
+
+
+def synthetic_vectors(n, dim, seed, centers=None):
+    # clustered unit vectors, closer to real embeddings than uniform noise, which ann indexes handle poorly
+    rng = np.random.default_rng(seed)
+    if centers is None:
+        centers = rng.standard_normal((max(n // 1000, 1), dim)).astype(np.float32)
+    vectors = centers[rng.integers(len(centers), size=n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def synthetic_batches(args):
+    # the corpus batch by batch, every batch from its own seed so a second pass yields the same vectors
+    # without the whole corpus ever being in memory
+    centers = np.random.default_rng(args.seed).standard_normal((max(args.n // 1000, 1), args.dim)).astype(np.float32)
+    for batch, start in enumerate(range(0, args.n, BATCH_SIZE)):
+        yield start, synthetic_vectors(min(BATCH_SIZE, args.n - start), args.dim, args.seed + 2 + batch, centers)
+
+
+def exact_neighbours(args, queries):
+    # exact top k rows of every query, kept as a running top k over the corpus batches
+    best_scores = np.full((len(queries), args.k), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((len(queries), args.k), dtype=np.int64)
+    for start, vectors in synthetic_batches(args):
+        scores = np.concatenate([best_scores, queries @ vectors.T], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(vectors)), (len(queries), len(vectors)))], axis=1)
+        top = np.argpartition(-scores, args.k - 1, axis=1)[:, :args.k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_rows = np.take_along_axis(rows, top, axis=1)
+    return best_rows
+
+
+def open_store(backend, persist_dir):
+    if backend == "ivf":
+        return IVFStore(persist_dir, None)
+    from langchain.vectorstores import Chroma
+
+    return ChromaStore(Chroma(persist_directory=persist_dir, collection_name="benchmark"))
+
+
+def run_backend(backend, args, out):
+    """
+    Build, reopen and query one backend, in its own process so ru_maxrss is that backend's peak RSS.
+
+    The corpus is generated batch by batch while it is added, so the peak RSS is the backend's and not
+    the benchmark's. Recall is against exact search over the same vectors, computed in a second pass
+    after the memory is measured.
+    """
+    queries = synthetic_vectors(args.queries, args.dim, args.seed + 1)
+    persist_dir = tempfile.mkdtemp(prefix=f"vector_store_{backend}_")
+    try:
+        store = open_store(backend, persist_dir)
+        start = time.perf_counter()
+        for i, vectors in synthetic_batches(args):
+            end = i + len(vectors)
+            store.upsert([str(j) for j in range(i, end)], vectors, [f"chunk {j}" for j in range(i, end)], [{"n": j} for j in range(i, end)])
+        build_s = time.perf_counter() - start
+        del store
+
+        start = time.perf_counter()
+        store = open_store(backend, persist_dir)
+        store.count()
+        open_s = time.perf_counter() - start
+
+        latencies, results = [], []
+        for query in queries:
+            start = time.perf_counter()
+            result = store.query([query], args.k, include=[])
+            latencies.append((time.perf_counter() - start) * 1000)
+            results.append(set(result["ids"][0]))
+        # kilobytes on linux
+        max_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        del store
+        hits = sum(len({str(i) for i in exact} & found) for exact, found in zip(exact_neighbours(args, queries), results))
+        out.put({
+            "backend": backend,
+            "vectors": args.n,
+            "dim": args.dim,
+            "build_s": round(build_s, 2),
+            "open_s": round(open_s, 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+            f"recall@{args.k}": round(hits / (len(queries) * args.k), 4),
+            "max_rss_mb": max_rss_mb,
+        })
+    finally:
+        shutil.rmtree(persist_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build time, query latency and memory of the vector store backends")
+    parser.add_argument("--n", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--backends", nargs="+", default=["chroma", "ivf"], choices=["chroma", "ivf"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    out = multiprocessing.Queue()
+    for backend in args.backends:
+        process = multiprocessing.Process(target=run_backend, args=(backend, args, out))
+        process.start()
+        row = out.get()
+        process.join()
+        print(json.dumps(row))
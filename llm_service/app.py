@@ -1,35 +1,45 @@
-from flask import Flask, request, jsonify
+import time
+_import_started=time.time()
+from flask import Flask, request, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
 import logging
-from constants import (
-    MODEL_ID,
-    MODEL_BASENAME,
-    MODEL_ID_GPTQ,
-    MODEL_BASENAME_GPTQ,
-)
+import threading
+from constants import DEFAULT_MODEL, MODEL_RELOAD_WAIT, RETRY_AFTER_SECONDS
 from load_models import (
     load_quantized_model_gguf_ggml,
     load_quantized_model_gptq,
     load_full_model,
 )
+from model_registry import ModelRegistry
+from scheduler import request_params
+from streaming import stream_generation
+from model_loader import BackgroundLoader, ModelNotReady
 
 app = Flask(__name__)
 device=os.getenv('DEVICE','cpu')
-model_type=os.getenv('MODEL_TYPE',"gguf")
-if model_type=="gptq":
-    llm=load_full_model(MODEL_ID_GPTQ, MODEL_BASENAME_GPTQ, device, logging)
-else:
-    llm=load_quantized_model_gguf_ggml(MODEL_ID, MODEL_BASENAME, device, logging)
-print("LLM loaded")
-logging.info("LLM loaded")
+# requests pick a model by name, models load on demand and are evicted under MODEL_RAM_BUDGET
+def _model_evicted(name):
+    # the loader holds the default model too, drop it so the memory is freed and /readyz reports it
+    if name==DEFAULT_MODEL:
+        models.unload("llm")
+
+registry=ModelRegistry(device, on_evict=_model_evicted, logging=logging)
+
+def _load_default_model(progress):
+    progress(0.0, f"loading {DEFAULT_MODEL}")
+    return registry.get(DEFAULT_MODEL)
+
+# the default model loads in the background so the service answers /healthz and /readyz while it loads
+models=BackgroundLoader(import_seconds=time.time()-_import_started, logging=logging)
+models.start("llm", _load_default_model)
 recent_log=""
 
 
 # Root path
 @app.route('/')
 def welcome():
-    return f'Welcome to the AI Gateway! Use /call_llm with a json message. Model is {MODEL_BASENAME}.'
+    return f'Welcome to the AI Gateway! Use /call_llm with a json message, add "stream": true for server-sent events and "model" to pick one of /models. Default model is {DEFAULT_MODEL}.'
 
 
 # call llm
@@ -38,15 +48,84 @@ def call_llm():
     try:
         data = request.json
         try:
-            resp=llm(data["prompt"])
+            name=data.get("model", DEFAULT_MODEL)
+            # optional max_tokens, stop and timeout limit the generation
+            params=request_params(data)
+            if name==DEFAULT_MODEL:
+                # an evicted default model is loaded again and waited for up to the request's timeout, while
+                # the service is still starting up requests get a 503 instead of blocking
+                status=models.reload("llm", _load_default_model)
+                models.wait("llm", params.get("timeout", MODEL_RELOAD_WAIT) if status.reloaded else 0)
+            scheduler=registry.get(name)
+            if data.get("stream"):
+                gen_request=scheduler.submit(data["prompt"], **params)
+                return Response(stream_with_context(stream_generation(gen_request)), mimetype="text/event-stream")
+            resp=scheduler(data["prompt"], **params)
             logging.info(resp)
             return jsonify({'status': 'success', 'message': resp})
+        except ModelNotReady as e:
+            logging.warning(e)
+            return jsonify({'status': 'error', 'message': str(e)}), 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}
         except Exception as e:
             logging.error(e)
             return jsonify({'status': 'error', 'message': str(e)})
     except Exception as e:
         logging.error(e)
 
+# scheduler and cache counters
+@app.route('/stats', methods=['GET'])
+def stats():
+    try:
+        message={name: model.engine.stats() for name, model in registry.models.items() if model.state == "ready"}
+        return jsonify({'status': 'success', 'message': message})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)})
+
+# registered models, their state and estimated memory
+@app.route('/models', methods=['GET'])
+def list_models():
+    return jsonify({'status': 'success', 'message': registry.stats()})
+
+# warm a model in the background - needs 'model'. The loaded models keep serving while it loads.
+@app.route('/models', methods=['POST'])
+def load_model():
+    try:
+        data = request.json
+        try:
+            name=data["model"]
+            if name not in registry.models:
+                raise KeyError(f"unknown model '{name}'")
+            threading.Thread(target=registry.get, args=(name,), daemon=True).start()
+            return jsonify({'status': 'success', 'message': f"loading {name}"})
+        except Exception as e:
+            logging.error(e)
+            return jsonify({'status': 'error', 'message': str(e)})
+    except Exception as e:
+        logging.error(e)
+
+@app.route('/models/<name>', methods=['DELETE'])
+def unload_model(name):
+    try:
+        if registry.unload(name):
+            return jsonify({'status': 'success', 'message': f"unloaded {name}"})
+        return jsonify({'status': 'error', 'message': f"{name} is not loaded"})
+    except Exception as e:
+        logging.error(e)
+        return jsonify({'status': 'error', 'message': str(e)})
+
+# liveness - the process is up, with per model load state
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'success', 'message': models.report()})
+
+# readiness - 503 until every model has loaded
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    report=models.report()
+    if report["ready"]:
+        return jsonify({'status': 'success', 'message': report})
+    return jsonify({'status': 'error', 'message': report}), 503, {'Retry-After': str(RETRY_AFTER_SECONDS)}
+
 if __name__ == "__main__":
     port = int(os.getenv('PORT', '5000'))
     app.run(debug=True, port=port)
@@ -0,0 +1,127 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from constants import COMPLETION_CACHE_DIR, COMPLETION_CACHE_ENTRIES
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Two tier cache of deterministic (temperature 0) completions.
+
+    Entries are keyed on (model id, basename, sampling params, prompt hash). The first tier is an in-memory
+    LRU, the second is one json file per entry under the workspace volume so answers survive restarts.
+    The disk tier of a model is wiped when the model file behind it changes (size or mtime).
+
+    Parameters:
+    - model_id (str): The identifier for the model on HuggingFace Hub.
+    - model_basename (str): The base name of the model file.
+    - model_path (str): The local model file, used to detect that the model changed.
+    - max_entries (int): Size of the in-memory tier.
+    - cache_dir (str): Root folder of the disk tier.
+    """
+
+    def __init__(self, model_id, model_basename, model_path=None, max_entries=COMPLETION_CACHE_ENTRIES, cache_dir=COMPLETION_CACHE_DIR, logging=logging):
+        self.model_id = model_id
+        self.model_basename = model_basename
+        self.max_entries = max_entries
+        self.logging = logging
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.model_dir = os.path.join(cache_dir, _sha256(f"{model_id}/{model_basename}")[:16])
+        self._check_model(model_path)
+
+    def _fingerprint(self, model_path):
+        if not model_path or not os.path.exists(model_path):
+            return {"model_id": self.model_id, "model_basename": self.model_basename}
+        stat = os.stat(model_path)
+        return {"model_id": self.model_id, "model_basename": self.model_basename, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def _check_model(self, model_path):
+        # drop the disk tier if it was written by a different model file
+        fingerprint = self._fingerprint(model_path)
+        fingerprint_file = os.path.join(self.model_dir, "model.json")
+        try:
+            with open(fingerprint_file) as _file:
+                if json.load(_file) == fingerprint:
+                    return
+            self.logging.info(f"Model changed, invalidating completion cache {self.model_dir}")
+        except (OSError, ValueError):
+            pass
+        self.invalidate()
+        os.makedirs(self.model_dir, exist_ok=True)
+        with open(fingerprint_file, "w") as _file:
+            json.dump(fingerprint, _file)
+
+    def invalidate(self):
+        with self._lock:
+            self.memory.clear()
+            shutil.rmtree(self.model_dir, ignore_errors=True)
+
+    @staticmethod
+    def cacheable(params):
+        return params.get("temperature", 0) == 0
+
+    def key(self, prompt, params):
+        params = {k: v for k, v in params.items() if k != "stream"}
+        return _sha256(json.dumps([self.model_id, self.model_basename, params, _sha256(prompt)], sort_keys=True))
+
+    def _path(self, key):
+        return os.path.join(self.model_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        # returns the cached entry dict or None
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        try:
+            with open(self._path(key)) as _file:
+                entry = json.load(_file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as _file:
+                json.dump(entry, _file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.logging.warning(f"Unable to write completion cache entry - {e}")
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self.memory),
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+        }
@@ -11,10 +11,28 @@ MODELS_PATH = f"{ROOT_DIRECTORY}/models"
 # Can be changed to a specific number
 INGEST_THREADS = os.cpu_count() or 8
 
+# Number of sequences the inference scheduler decodes together, each batch slot holds its own llama context
+MAX_BATCH_SLOTS = int(os.environ.get('MAX_BATCH_SLOTS', 4))
+
+# Number of gguf model replicas, each pinned to its own share of the cores. Run `python worker_pool.py` to
+# benchmark aggregate tokens/s for 1..N replicas and pick N for a machine type. Every replica opens
+# MAX_BATCH_SLOTS contexts (a KV cache each), the replicas share the weights and one prefix cache.
+LLM_REPLICAS = int(os.environ.get('LLM_REPLICAS', 1))
+
+# Byte budget of the prompt-prefix KV state cache (one per model, shared by its replicas), and the shortest
+# prefix worth restoring from it
+PREFIX_CACHE_BYTES = int(os.environ.get('PREFIX_CACHE_BYTES', 2 * 1024**3))
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get('PREFIX_CACHE_MIN_TOKENS', 32))
+
+# Cache of deterministic (temperature 0) completions, in-memory entries and the on-disk tier under the workspace
+COMPLETION_CACHE_ENTRIES = int(os.environ.get('COMPLETION_CACHE_ENTRIES', 1024))
+COMPLETION_CACHE_DIR = f"{ROOT_DIRECTORY}/completion_cache"
+
 
 # Context Window and Max New Tokens
 CONTEXT_WINDOW_SIZE = 8192 #4096
-MAX_NEW_TOKENS = CONTEXT_WINDOW_SIZE  # int(CONTEXT_WINDOW_SIZE/4)
+# default generation limit, requests may ask for a different max_tokens
+MAX_NEW_TOKENS = int(os.environ.get('MAX_NEW_TOKENS', int(CONTEXT_WINDOW_SIZE/4)))
 
 #### If you get a "not enough space in the buffer" error, you should reduce the values below, start with half of the original values and keep halving the value until the error stops appearing
 
@@ -31,3 +49,17 @@ MODEL_BASENAME = "mistral-7b-instruct-v0.1.Q4_K_M.gguf"
 MODEL_ID_GPTQ = "TheBloke/Mistral-7B-Instruct-v0.1-GPTQ"
 MODEL_BASENAME_GPTQ = "mistral-7b-instruct-v0.1.Q4_K_M.gptq"
 
+# Models /call_llm can name with "model", loaded on demand and evicted least recently used first once the
+# loaded models exceed MODEL_RAM_BUDGET bytes. type is "gguf" (LlamaCpp) or "full" (transformers).
+MODEL_REGISTRY = {
+    "mistral-7b-instruct": {"model_id": MODEL_ID, "basename": MODEL_BASENAME, "type": "gguf"},
+    "mistral-7b-instruct-gptq": {"model_id": MODEL_ID_GPTQ, "basename": MODEL_BASENAME_GPTQ, "type": "full"},
+    "phi-2": {"model_id": "TheBloke/phi-2-GGUF", "basename": "phi-2.Q4_K_M.gguf", "type": "gguf"},
+}
+# MODEL_TYPE=gptq picks the full model as the default, as the service did before the registry
+DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', "mistral-7b-instruct-gptq" if os.environ.get('MODEL_TYPE') == "gptq" else "mistral-7b-instruct")
+MODEL_RAM_BUDGET = int(os.environ.get('MODEL_RAM_BUDGET', 16 * 1024**3))
+# Seconds a request for the default model waits for it to load again after an eviction (the request's
+# timeout when it has one), and the Retry-After of the 503 answered while it is not ready
+MODEL_RELOAD_WAIT = float(os.environ.get('MODEL_RELOAD_WAIT', 300))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 5))
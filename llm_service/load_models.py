@@ -1,18 +1,29 @@
-import torch
-from auto_gptq import AutoGPTQForCausalLM
-from huggingface_hub import hf_hub_download
-from langchain.llms import LlamaCpp
-
-from transformers import (
-    AutoModelForCausalLM,
-    AutoTokenizer,
-    LlamaForCausalLM,
-    LlamaTokenizer,
-)
+import os
+import importlib
+
 from constants import CONTEXT_WINDOW_SIZE, MAX_NEW_TOKENS, N_GPU_LAYERS, N_BATCH, MODELS_PATH
+from prefix_cache import PrefixKVCache
+
+# Backend libraries are imported inside the loader that needs them, so a gguf deployment never pays for
+# importing torch, auto_gptq and transformers.
+BACKEND_MODULES = {
+    "gguf": ["huggingface_hub", "langchain.llms"],
+    "gptq": ["torch", "auto_gptq", "transformers"],
+    "full": ["torch", "transformers"],
+    "instructor": ["torch", "sentence_transformers", "InstructorEmbedding", "langchain.embeddings"],
+}
 
 
-def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, logging):
+def import_backend(model_type):
+    """
+    Import the libraries a model backend needs ahead of loading it, so import time can be reported apart
+    from model load time. The loaders import what they need themselves, this only warms the module cache.
+    """
+    for module in BACKEND_MODULES.get(model_type, BACKEND_MODULES["gguf"]):
+        importlib.import_module(module)
+
+
+def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, logging, n_threads=None):
     """
     Load a GGUF/GGML quantized model using LlamaCpp.
 
@@ -25,9 +36,11 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
     - model_basename (str): The base name of the model file.
     - device_type (str): The type of device where the model will run, e.g., 'mps', 'cuda', etc.
     - logging (logging.Logger): Logger instance for logging messages.
+    - n_threads (int): Optional number of cpu threads, defaults to the llama.cpp choice.
 
     Returns:
-    - LlamaCpp: An instance of the LlamaCpp model if successful, otherwise None.
+    - LlamaCpp: An instance of the LlamaCpp model if successful, otherwise None. A PrefixKVCache is attached
+      to the underlying llama client, its counters are available from llm.client.cache.stats().
 
     Notes:
     - The function uses the `hf_hub_download` function to download the model from the HuggingFace Hub.
@@ -35,6 +48,9 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
     """
 
     try:
+        from huggingface_hub import hf_hub_download
+        from langchain.llms import LlamaCpp
+
         logging.info("Using Llamacpp for GGUF/GGML quantized models")
         model_path = hf_hub_download(
             repo_id=model_id,
@@ -50,12 +66,17 @@ def load_quantized_model_gguf_ggml(model_id, model_basename, device_type, loggin
             "max_tokens": MAX_NEW_TOKENS,
             "n_batch": N_BATCH,  # set this based on your GPU & CPU RAM
         }
+        if n_threads:
+            kwargs["n_threads"] = n_threads
         if device_type.lower() == "mps":
             kwargs["n_gpu_layers"] = 1
         if device_type.lower() == "cuda":
             kwargs["n_gpu_layers"] = N_GPU_LAYERS  # set this based on your GPU
 
-        return LlamaCpp(**kwargs)
+        llm = LlamaCpp(**kwargs)
+        # keep the KV state of shared prompt prefixes (templates) so they are only evaluated once
+        PrefixKVCache().attach(llm.client)
+        return llm
     except:
         if "ggml" in model_basename:
             logging.INFO("If you were using GGML model, LLAMA-CPP Dropped Support, Use GGUF Instead")
@@ -83,6 +104,9 @@ def load_quantized_model_gptq(model_id, model_basename, device_type, logging):
     - The function checks for the ".safetensors" ending in the model_basename and removes it if present.
     """
 
+    from auto_gptq import AutoGPTQForCausalLM
+    from transformers import AutoTokenizer
+
     # The code supports all huggingface models that ends with GPTQ and have some variation
     # of .no-act.order or .safetensors in their HF repo.
     logging.info("Using AutoGPTQForCausalLM for quantized models")
@@ -129,6 +153,14 @@ def load_full_model(model_id, model_basename, device_type, logging):
     - Additional settings are provided for NVIDIA GPUs, such as loading in 4-bit and setting the compute dtype.
     """
 
+    import torch
+    from transformers import (
+        AutoModelForCausalLM,
+        AutoTokenizer,
+        LlamaForCausalLM,
+        LlamaTokenizer,
+    )
+
     if device_type.lower() in ["mps", "cpu"]:
         logging.info("Using LlamaTokenizer")
         tokenizer = LlamaTokenizer.from_pretrained(model_id, cache_dir=MODELS_PATH)
@@ -151,3 +183,56 @@ def load_full_model(model_id, model_basename, device_type, logging):
         )
         model.tie_weights()
     return model, tokenizer
+
+
+class FullModelPipeline:
+    """
+    A full (transformers) model and its tokenizer as a prompt -> completion callable, the interface
+    InferenceScheduler drives models that are not llama.cpp backed with (one slot, greedy decoding).
+
+    Parameters:
+    - model: The model returned by load_full_model.
+    - tokenizer: The tokenizer returned by load_full_model.
+    - max_new_tokens (int): Upper bound on the generated tokens.
+    """
+
+    def __init__(self, model, tokenizer, max_new_tokens=MAX_NEW_TOKENS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+
+    def __call__(self, prompt):
+        import torch
+
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        with torch.no_grad():
+            output = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=False)
+        # only the completion, not the prompt the model echoes back
+        return self.tokenizer.decode(output[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+    def tokenize(self, text, add_bos=False):
+        # same signature as llama's tokenize, used by the scheduler to count tokens
+        return self.tokenizer.encode(text.decode("utf-8"), add_special_tokens=add_bos)
+
+
+def load_full_pipeline(model_id, model_basename, device_type, logging):
+    # load_full_model wrapped as a callable, see FullModelPipeline
+    model, tokenizer = load_full_model(model_id, model_basename, device_type, logging)
+    return FullModelPipeline(model, tokenizer)
+
+
+def full_model_weights_bytes(model_id):
+    """
+    Size of a full model's weight files in the HuggingFace cache under MODELS_PATH, each file counted once
+    even when several snapshots link to it.
+
+    Returns:
+    - int: Bytes, 0 when the model is not downloaded yet.
+    """
+    snapshots = os.path.join(MODELS_PATH, f"models--{model_id.replace('/', '--')}", "snapshots")
+    weights = set()
+    for root, _, names in os.walk(snapshots):
+        for name in names:
+            if name.endswith((".safetensors", ".bin", ".pt")):
+                weights.add(os.path.realpath(os.path.join(root, name)))
+    return sum(os.path.getsize(path) for path in weights if os.path.exists(path))
@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+
+
+class ModelNotReady(Exception):
+    pass
+
+
+class LoadState:
+    def __init__(self, name):
+        self.name = name
+        self.state = "pending"
+        self.stage = None
+        self.progress = 0.0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.value = None
+        # started again after the model was unloaded, not the service's first load
+        self.reloaded = False
+        self.done = threading.Event()
+        self.stages = {}
+        self._stage_started = None
+
+    def set_stage(self, stage):
+        # closes the timing of the previous stage, stage durations split import time from model load time
+        now = time.time()
+        self._close_stage(now)
+        self.stage = stage
+        self._stage_started = now
+
+    def _close_stage(self, now):
+        if self.stage is not None and self._stage_started is not None:
+            self.stages[self.stage] = round(self.stages.get(self.stage, 0) + now - self._stage_started, 3)
+        self._stage_started = None
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "load_seconds": round(end - self.started_at, 3) if self.started_at else None,
+            "stage_seconds": self.stages,
+        }
+
+
+class BackgroundLoader:
+    """
+    Loads models on background threads so the service answers requests (health checks) right away.
+
+    Every model is loaded on its own thread, so independent models (the llm and the embedder) load in
+    parallel. A load function gets a progress(fraction, stage) callback it may call as it goes.
+
+    Parameters:
+    - import_seconds (float): Time the service spent importing modules before it started loading models.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+
+    def __init__(self, import_seconds=None, logging=logging):
+        self.logging = logging
+        self.import_seconds = import_seconds
+        self.started_at = time.time()
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def start(self, name, load_fn):
+        # load_fn(progress) returns the loaded model, an exception or a None result marks the model failed
+        status = self.models[name] = LoadState(name)
+
+        def progress(fraction, stage=None):
+            status.progress = fraction
+            if stage != status.stage:
+                status.set_stage(stage)
+
+        def run():
+            status.state = "loading"
+            status.started_at = time.time()
+            try:
+                status.value = load_fn(progress)
+                if status.value is None:
+                    raise RuntimeError(f"{name} loader returned nothing")
+                status.state = "ready"
+                status.progress = 1.0
+                self.logging.info(f"{name} loaded in {time.time() - status.started_at:.1f}s")
+            except Exception as e:
+                self.logging.error(f"{name} failed to load - {e}")
+                status.state = "failed"
+                status.error = str(e)
+            finally:
+                status.finished_at = time.time()
+                status._close_stage(status.finished_at)
+                status.done.set()
+
+        threading.Thread(target=run, name=f"load-{name}", daemon=True).start()
+        return status
+
+    def get(self, name):
+        # the loaded model, raises ModelNotReady while it is still loading or if it failed
+        status = self.models.get(name)
+        if status is None or status.state != "ready":
+            detail = status.to_dict() if status else {"state": "unknown"}
+            raise ModelNotReady(f"{name} is not ready - {detail['state']} ({detail.get('progress', 0) * 100:.0f}%)")
+        return status.value
+
+    def reload(self, name, load_fn):
+        # starts loading an unloaded model again, once however many requests ask for it, and returns its status
+        with self._lock:
+            status = self.models.get(name)
+            if status is not None and status.state == "unloaded":
+                status = self.start(name, load_fn)
+                status.reloaded = True
+            return status
+
+    def wait(self, name, timeout=None):
+        # the loaded model, waiting up to timeout seconds for a load in progress, then as get
+        status = self.models.get(name)
+        if status is not None:
+            status.done.wait(timeout)
+        return self.get(name)
+
+    def unload(self, name):
+        # forget a loaded model (it was evicted elsewhere), it is not ready until it is started again
+        status = self.models.get(name)
+        if status is not None and status.state == "ready":
+            status.state = "unloaded"
+            status.value = None
+
+    def ready(self):
+        return all(status.state == "ready" for status in self.models.values())
+
+    def report(self):
+        return {
+            "ready": self.ready(),
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "import_seconds": round(self.import_seconds, 3) if self.import_seconds is not None else None,
+            "models": {name: status.to_dict() for name, status in self.models.items()},
+        }
@@ -0,0 +1,181 @@
+import os
+import time
+import logging
+import threading
+
+from constants import MODEL_REGISTRY, MODEL_RAM_BUDGET, LLM_REPLICAS
+from load_models import import_backend, load_full_pipeline, full_model_weights_bytes
+from scheduler import InferenceScheduler
+from completion_cache import CompletionCache
+from worker_pool import WorkerPool, split_cores, load_replicas
+
+
+def _kv_cache_bytes(llm):
+    # the state of one llama context, its KV cache for n_ctx tokens plus logits and embeddings, as llama.cpp
+    # reports it for state saving
+    client = getattr(llm, "client", None)
+    ctx = getattr(client, "ctx", None)
+    if ctx is None:
+        # newer bindings keep the context in a wrapper
+        ctx = getattr(getattr(client, "_ctx", None), "ctx", None)
+    if ctx is None:
+        return 0
+    import llama_cpp
+
+    return int(llama_cpp.llama_get_state_size(ctx))
+
+
+class RegisteredModel:
+    def __init__(self, name, spec):
+        self.name = name
+        self.spec = spec
+        self.state = "unloaded"
+        self.engine = None
+        self.size_bytes = 0
+        self.error = None
+        self.last_used = None
+        self.load_seconds = None
+        self.loaded = threading.Event()
+
+    def to_dict(self):
+        return {
+            "model_id": self.spec["model_id"],
+            "basename": self.spec["basename"],
+            "type": self.spec["type"],
+            "state": self.state,
+            "size_bytes": self.size_bytes,
+            "last_used": self.last_used,
+            "load_seconds": self.load_seconds,
+            "error": self.error,
+        }
+
+
+class ModelRegistry:
+    """
+    Named models loaded on demand through the existing loaders, evicted least-recently-used first to stay
+    under a RAM budget.
+
+    A model loads on the thread that first asks for it, outside the registry lock, so the models that are
+    already warm keep serving while it loads. Requests for a model that is loading wait for that load
+    instead of starting another one. Eviction closes the model's scheduler, requests already decoding on
+    it finish first.
+
+    gguf models run through a WorkerPool of InferenceSchedulers. "full" (transformers) models are wrapped
+    as a prompt -> completion callable (load_models.FullModelPipeline) and run through a single slot
+    InferenceScheduler.
+
+    Parameters:
+    - device (str): The type of device the models run on.
+    - specs (dict): Maps a model name to {"model_id", "basename", "type"}, type is "gguf" or "full".
+    - ram_budget (int): Bytes the loaded models may use together, sizes are estimated (see _size_of).
+    - on_evict (callable): Optional, called with the model name after a model is evicted or unloaded.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+
+    def __init__(self, device, specs=MODEL_REGISTRY, ram_budget=MODEL_RAM_BUDGET, on_evict=None, logging=logging):
+        self.device = device
+        self.ram_budget = ram_budget
+        self.on_evict = on_evict
+        self.logging = logging
+        self.models = {}
+        for name, spec in specs.items():
+            if spec["type"] not in ("gguf", "full"):
+                self.logging.warning(f"model '{name}' has unknown type {spec['type']}, expected gguf or full, skipping it")
+                continue
+            self.models[name] = RegisteredModel(name, spec)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        # the scheduler (or worker pool) of the named model, loading it first if needed
+        if name not in self.models:
+            raise KeyError(f"unknown model '{name}', expected one of {sorted(self.models)}")
+        model = self.models[name]
+        with self._lock:
+            model.last_used = time.time()
+            if model.state == "ready":
+                return model.engine
+            should_load = model.state in ("unloaded", "failed")
+            if should_load:
+                model.state = "loading"
+                model.error = None
+                model.loaded.clear()
+        if should_load:
+            self._load(model)
+        model.loaded.wait()
+        if model.state != "ready":
+            raise RuntimeError(f"model '{name}' failed to load - {model.error}")
+        return model.engine
+
+    def unload(self, name):
+        with self._lock:
+            model = self.models[name]
+            if model.state != "ready":
+                return False
+            self._evict(model)
+            return True
+
+    def _load(self, model):
+        spec = model.spec
+        started = time.time()
+        try:
+            import_backend(spec["type"])
+            if spec["type"] == "full":
+                pipeline = load_full_pipeline(spec["model_id"], spec["basename"], self.device, self.logging)
+                engine = InferenceScheduler(pipeline, max_batch=1, completion_cache=CompletionCache(spec["model_id"], spec["basename"]), logging=self.logging)
+                size_bytes = full_model_weights_bytes(spec["model_id"])
+            else:
+                core_sets = split_cores(spec.get("replicas", LLM_REPLICAS))
+                llms = load_replicas(spec["model_id"], spec["basename"], self.device, core_sets, self.logging)
+                if any(llm is None for llm in llms):
+                    raise RuntimeError(f"unable to load {spec['basename']}")
+                completion_cache = CompletionCache(spec["model_id"], spec["basename"], getattr(llms[0], "model_path", None))
+                engine = WorkerPool(llms, core_sets, completion_cache=completion_cache, logging=self.logging)
+                size_bytes = self._size_of(llms[0], engine)
+        except Exception as e:
+            self.logging.error(f"model '{model.name}' failed to load - {e}")
+            with self._lock:
+                model.state = "failed"
+                model.error = str(e)
+            model.loaded.set()
+            return
+        with self._lock:
+            model.engine = engine
+            model.size_bytes = size_bytes
+            model.load_seconds = round(time.time() - started, 3)
+            model.state = "ready"
+            self._enforce_budget(keep=model)
+        model.loaded.set()
+        self.logging.info(f"model '{model.name}' loaded in {model.load_seconds}s ({size_bytes} bytes)")
+
+    def _size_of(self, llm, engine):
+        # gguf weights are mmapped and shared by the replicas, so the file size is counted once, but every
+        # batch slot of every replica is a llama context with its own KV cache
+        model_path = getattr(llm, "model_path", None)
+        weights = os.path.getsize(model_path) if model_path and os.path.exists(model_path) else 0
+        contexts = sum(len(replica.slots) for replica in engine.replicas)
+        # the replicas share one prefix cache, counted at its capacity
+        prefix_cache = getattr(getattr(llm, "client", None), "cache", None)
+        return weights + contexts * _kv_cache_bytes(llm) + getattr(prefix_cache, "capacity_bytes", 0)
+
+    def _enforce_budget(self, keep):
+        # evict least recently used ready models until the loaded models fit the budget
+        ready = [m for m in self.models.values() if m.state == "ready" and m is not keep]
+        ready.sort(key=lambda m: m.last_used or 0)
+        while ready and sum(m.size_bytes for m in self.models.values() if m.state == "ready") > self.ram_budget:
+            self._evict(ready.pop(0))
+
+    def _evict(self, model):
+        self.logging.info(f"evicting model '{model.name}' ({model.size_bytes} bytes)")
+        model.engine.close()
+        model.engine = None
+        model.size_bytes = 0
+        model.state = "unloaded"
+        if self.on_evict is not None:
+            self.on_evict(model.name)
+
+    def stats(self):
+        return {
+            "ram_budget": self.ram_budget,
+            "loaded_bytes": sum(m.size_bytes for m in self.models.values() if m.state == "ready"),
+            "models": {name: model.to_dict() for name, model in self.models.items()},
+        }
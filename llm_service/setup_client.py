@@ -19,11 +19,20 @@ setup_db=f"http://{url}set_db_kv"
 cluster_docs=f"http://{url}cluster_docs"
 call_llm=f"http://{url}call_llm"
 p_docs=f"http://{url}process_documents"
-sleep_time=600
-logging.info(f"Variables set sleeping for -{sleep_time}")
+readyz=f"http://{url}readyz"
+max_wait=600
+logging.info(f"Variables set polling {readyz} for up to -{max_wait}")
 
-#wait for server to start up - LLM may take 10 minutes or more to boot up.
-sleep(sleep_time)
+#wait for the models to load - the server answers right away, the LLM may take 10 minutes or more to load.
+waited=0
+while waited < max_wait:
+    try:
+        if requests.get(readyz).status_code == 200:
+            break
+    except requests.exceptions.ConnectionError:
+        pass
+    sleep(5)
+    waited+=5
 
 # Sending a POST request to the server llm with prompt
 response = requests.post(call_llm, json={'prompt': "You are a con man set out to trick the world into believing 1+1=5. Appeal to the deep inner needs that every person has. The reason 1+1=5 is"})
@@ -0,0 +1,40 @@
+import json
+
+
+def sse_event(event, data):
+    """
+    Format one server-sent event.
+
+    Parameters:
+    - event (str): The event name, e.g. 'token', 'done' or 'error'.
+    - data: Any json serialisable payload.
+
+    Returns:
+    - str: The encoded event, ready to be yielded from a flask streaming response.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_generation(gen_request, done_extra=None, event_extra=None):
+    """
+    Yield a GenerationRequest as server-sent events.
+
+    One 'token' event is sent per generated piece of text and a final 'done' event carries the usage and
+    timing of the generation. If the client goes away the generator is closed and the request is
+    cancelled so the scheduler can hand its slot to the next request.
+
+    Parameters:
+    - gen_request (GenerationRequest): A request returned by InferenceScheduler.submit.
+    - done_extra (dict): Extra fields added to the 'done' event.
+    - event_extra (dict): Extra fields added to every event, e.g. the question index in a rag stream.
+    """
+    event_extra = event_extra or {}
+    try:
+        for text in gen_request.stream():
+            yield sse_event("token", {**event_extra, "text": text})
+        yield sse_event("done", {**event_extra, **(done_extra or {}), "response": gen_request.text, "usage": gen_request.usage()})
+    except Exception as e:
+        yield sse_event("error", {**event_extra, "message": str(e)})
+    finally:
+        if not gen_request.done():
+            gen_request.cancel()
@@ -0,0 +1,64 @@
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip("flask")
+
+import model_registry
+
+
+class FakeEngine:
+    def __call__(self, prompt, **params):
+        return f"answer to {prompt}"
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    # the registry loads a fake engine, gated by an event so a test can hold a load in progress
+    release = threading.Event()
+    release.set()
+
+    def load(self, model):
+        release.wait()
+        with self._lock:
+            model.engine = FakeEngine()
+            model.size_bytes = 1
+            model.state = "ready"
+        model.loaded.set()
+
+    monkeypatch.setattr(model_registry.ModelRegistry, "_load", load)
+    sys.modules.pop("app", None)
+    import app
+
+    app.models.wait("llm", 5)
+    yield app, release
+    sys.modules.pop("app", None)
+
+
+def test_request_after_eviction_waits_for_the_reload(service):
+    app, _ = service
+    client = app.app.test_client()
+    assert app.registry.unload(app.DEFAULT_MODEL)
+    assert client.get("/readyz").status_code == 503
+    response = client.post("/call_llm", json={"prompt": "hi"})
+    assert response.status_code == 200
+    assert response.get_json() == {"status": "success", "message": "answer to hi"}
+    assert client.get("/readyz").status_code == 200
+
+
+def test_reload_slower_than_the_timeout_is_a_503(service):
+    app, release = service
+    client = app.app.test_client()
+    release.clear()
+    assert app.registry.unload(app.DEFAULT_MODEL)
+    response = client.post("/call_llm", json={"prompt": "hi", "timeout": 0.1})
+    release.set()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(app.RETRY_AFTER_SECONDS)
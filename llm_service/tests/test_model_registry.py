@@ -0,0 +1,41 @@
+import sys
+import types
+
+from model_registry import ModelRegistry, _kv_cache_bytes
+
+
+class StubClient:
+    # the llama-cpp-python 0.1.83 Llama surface the registry reads, no GGUF .metadata
+    def __init__(self):
+        self.ctx = object()
+        self.cache = types.SimpleNamespace(capacity_bytes=1000)
+
+
+class StubLlm:
+    def __init__(self, model_path=None):
+        self.client = StubClient()
+        self.model_path = model_path
+        self.n_ctx = 512
+
+
+def _llama_cpp(monkeypatch, state_size):
+    module = types.ModuleType("llama_cpp")
+    module.llama_get_state_size = lambda ctx: state_size
+    monkeypatch.setitem(sys.modules, "llama_cpp", module)
+
+
+def test_kv_cache_bytes_without_metadata(monkeypatch):
+    _llama_cpp(monkeypatch, 64 * 1024**2)
+    llm = StubLlm()
+    assert not hasattr(llm.client, "metadata")
+    assert _kv_cache_bytes(llm) == 64 * 1024**2
+
+
+def test_size_counts_every_context(monkeypatch, tmp_path):
+    _llama_cpp(monkeypatch, 100)
+    weights = tmp_path / "model.gguf"
+    weights.write_bytes(b"\0" * 5000)
+    engine = types.SimpleNamespace(replicas=[types.SimpleNamespace(slots=[1, 2, 3, 4]), types.SimpleNamespace(slots=[1, 2, 3, 4])])
+    registry = ModelRegistry("cpu", specs={})
+    # weights once, 2 replicas x 4 slots of KV state, the shared prefix cache once
+    assert registry._size_of(StubLlm(str(weights)), engine) == 5000 + 8 * 100 + 1000
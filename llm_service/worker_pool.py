@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+import threading
+
+from constants import (
+    MODEL_ID,
+    MODEL_BASENAME,
+    LLM_REPLICAS,
+    MAX_BATCH_SLOTS,
+)
+from load_models import load_quantized_model_gguf_ggml
+from scheduler import InferenceScheduler
+
+
+def split_cores(n_replicas, cores=None):
+    """
+    Split the cores this process may run on into n_replicas contiguous, equally sized sets.
+
+    Parameters:
+    - n_replicas (int): Number of core sets wanted.
+    - cores (iterable): Cores to split, defaults to the affinity of the current process.
+
+    Returns:
+    - list: One sorted list of core ids per replica. Leftover cores are given to the first sets.
+    """
+    if cores is None:
+        cores = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    cores = sorted(cores)
+    n_replicas = max(1, min(int(n_replicas), len(cores)))
+    size, extra = divmod(len(cores), n_replicas)
+    core_sets, start = [], 0
+    for i in range(n_replicas):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+
+def load_replicas(model_id, model_basename, device, core_sets, logging):
+    # one LlamaCpp instance per core set, the gguf file is mmapped so the replicas share the weight pages.
+    # They also share the first replica's prefix KV cache, so PREFIX_CACHE_BYTES bounds the whole pool
+    # rather than every replica, and a template prefix evaluated on one replica is reused by the others
+    llms = [
+        load_quantized_model_gguf_ggml(model_id, model_basename, device, logging, n_threads=len(cores))
+        for cores in core_sets
+    ]
+    prefix_cache = getattr(getattr(llms[0], "client", None), "cache", None)
+    if prefix_cache is not None:
+        for llm in llms[1:]:
+            if llm is not None:
+                prefix_cache.attach(llm.client)
+    return llms
+
+
+class WorkerPool:
+    """
+    N model replicas, each with its own InferenceScheduler pinned to its own core set.
+
+    Requests are routed to the replica with the fewest decoding plus queued requests. The pool exposes the
+    same submit / __call__ / stats interface as a single InferenceScheduler.
+
+    Every replica opens max_batch llama contexts, each with a KV cache for a full context window, so the
+    pool holds len(llms) * max_batch contexts. Lower MAX_BATCH_SLOTS when raising LLM_REPLICAS to keep
+    the memory flat.
+
+    Parameters:
+    - llms (list): The loaded replicas, see load_replicas.
+    - core_sets (list): The cores each replica is pinned to, see split_cores.
+    - completion_cache (CompletionCache): Optional cache shared by every replica.
+    - max_batch (int): Batch slots per replica.
+    - logging (logging.Logger): Logger instance for logging messages.
+    """
+
+    def __init__(self, llms, core_sets, completion_cache=None, max_batch=MAX_BATCH_SLOTS, logging=logging):
+        self.core_sets = core_sets
+        self.replicas = [
+            InferenceScheduler(llm, max_batch=max_batch, completion_cache=completion_cache, cpu_set=set(cores), logging=logging)
+            for llm, cores in zip(llms, core_sets)
+        ]
+        self._lock = threading.Lock()
+        logging.info(f"Worker pool running {len(self.replicas)} replica(s) on core sets {core_sets}, {sum(len(r.slots) for r in self.replicas)} llama contexts")
+
+    def submit(self, prompt, **params):
+        with self._lock:
+            replica = min(self.replicas, key=lambda r: r.load())
+            return replica.submit(prompt, **params)
+
+    def __call__(self, prompt, **params):
+        return self.submit(prompt, **params).result()
+
+    def count_tokens(self, text):
+        return self.replicas[0].count_tokens(text)
+
+    def load(self):
+        return sum(replica.load() for replica in self.replicas)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+
+    def stats(self):
+        return {
+            "replicas": [
+                {"cores": cores, **replica.stats()}
+                for cores, replica in zip(self.core_sets, self.replicas)
+            ]
+        }
+
+
+def benchmark(max_replicas, n_prompts, max_tokens, prompt, device, logging):
+    """
+    Report aggregate tokens/s for 1..max_replicas replicas on this machine.
+
+    Every run sends n_prompts concurrent prompts through a fresh pool, without a completion cache, and
+    measures generated tokens over wall time.
+    """
+    results = []
+    for n_replicas in range(1, max_replicas + 1):
+        core_sets = split_cores(n_replicas)
+        pool = WorkerPool(load_replicas(MODEL_ID, MODEL_BASENAME, device, core_sets, logging), core_sets, logging=logging)
+        start = time.time()
+        requests = [pool.submit(f"{prompt} ({i})", max_tokens=max_tokens) for i in range(n_prompts)]
+        for gen_request in requests:
+            gen_request.result()
+        elapsed = time.time() - start
+        tokens = sum(gen_request.completion_tokens for gen_request in requests)
+        results.append({
+            "replicas": n_replicas,
+            "threads_per_replica": [len(cores) for cores in core_sets],
+            "completion_tokens": tokens,
+            "seconds": round(elapsed, 2),
+            "tokens_per_second": round(tokens / elapsed, 2),
+        })
+        print(json.dumps(results[-1]))
+        pool.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark aggregate tokens/s for 1..N llm replicas")
+    parser.add_argument("--max-replicas", type=int, default=max(LLM_REPLICAS, 4))
+    parser.add_argument("--prompts", type=int, default=32)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--prompt", default="Write a short paragraph about the history of computing.")
+    parser.add_argument("--device", default=os.getenv('DEVICE', 'cpu'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    benchmark(args.max_replicas, args.prompts, args.max_tokens, args.prompt, args.device, logging)